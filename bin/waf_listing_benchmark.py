@@ -0,0 +1,122 @@
+'''
+Benchmark of the WAF directory listing parser
+
+Compares the regular expressions used by the WAF harvester to parse the
+directory listings with the pyparsing grammars previously used, on large
+synthetic Apache, IIS and generic listings, checking that both return the
+same links and dates.
+
+Requires pyparsing, which is not a dependency of the extension anymore:
+
+    pip install pyparsing
+    python bin/waf_listing_benchmark.py --entries 20000
+'''
+from __future__ import print_function
+
+import argparse
+import timeit
+
+import pyparsing as parse
+
+from ckanext.spatial.harvesters.waf import _parse_listing
+
+
+# Grammars used by previous versions of the WAF harvester
+
+apache  = parse.SkipTo(parse.CaselessLiteral("<a href="), include=True).suppress() \
+        + parse.quotedString.setParseAction(parse.removeQuotes).setResultsName('url') \
+        + parse.SkipTo("</a>", include=True).suppress() \
+        + parse.Optional(parse.Literal('</td><td align="right">')).suppress() \
+        + parse.Optional(parse.Combine(
+            parse.Word(parse.alphanums+'-') +
+            parse.Word(parse.alphanums+':')
+        ,adjacent=False, joinString=' ').setResultsName('date')
+        )
+
+iis =      parse.SkipTo("<br>").suppress() \
+         + parse.OneOrMore("<br>").suppress() \
+         + parse.Optional(parse.Combine(
+           parse.Word(parse.alphanums+'/') +
+           parse.Word(parse.alphanums+':') +
+           parse.Word(parse.alphas)
+         , adjacent=False, joinString=' ').setResultsName('date')
+         ) \
+         + parse.Word(parse.nums).suppress() \
+         + parse.Literal('<A HREF=').suppress() \
+         + parse.quotedString.setParseAction(parse.removeQuotes).setResultsName('url')
+
+other = parse.SkipTo(parse.CaselessLiteral("<a href="), include=True).suppress() \
+        + parse.quotedString.setParseAction(parse.removeQuotes).setResultsName('url')
+
+
+scrapers = {'apache': parse.OneOrMore(parse.Group(apache)),
+            'other': parse.OneOrMore(parse.Group(other)),
+            'iis': parse.OneOrMore(parse.Group(iis))}
+
+
+def parse_listing_pyparsing(content, scraper):
+    try:
+        parsed = scrapers[scraper].parseString(content)
+    except parse.ParseException:
+        parsed = scrapers['other'].parseString(content)
+    return [(record.url, record.date or None) for record in parsed]
+
+
+# Synthetic listings
+
+def apache_listing(entries):
+    rows = ['<tr><td valign="top"><img src="/icons/text.gif" alt="[TXT]"></td>'
+            '<td><a href="record-%i.xml">record-%i.xml</a></td>'
+            '<td align="right">2013-03-%02i 10:%02i  </td><td align="right">12K</td></tr>'
+            % (i, i, i % 28 + 1, i % 60) for i in range(entries)]
+    return ('<html><head><title>Index of /waf</title></head><body>'
+            '<h1>Index of /waf</h1><table>%s</table></body></html>' % '\n'.join(rows))
+
+
+def iis_listing(entries):
+    rows = ['<br> 3/%i/2013 10:%02i AM        12345 <A HREF="/waf/record-%i.xml">record-%i.xml</A>'
+            % (i % 28 + 1, i % 60, i, i) for i in range(entries)]
+    return ('<html><head><title>localhost - /waf/</title></head><body>'
+            '<H1>localhost - /waf/</H1><hr><pre>%s<br></pre><hr></body></html>' % ''.join(rows))
+
+
+def other_listing(entries):
+    rows = ['<li><a href="record-%i.xml">record-%i.xml</a></li>' % (i, i)
+            for i in range(entries)]
+    return '<html><body><ul>%s</ul></body></html>' % '\n'.join(rows)
+
+
+listings = {
+    'apache': apache_listing,
+    'iis': iis_listing,
+    'other': other_listing,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--entries', type=int, default=5000,
+                        help='Number of links in each listing')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Number of times each parser is run')
+    args = parser.parse_args()
+
+    print('%-8s %10s %12s %12s %8s' % ('listing', 'size (KB)', 'pyparsing (s)', 'regex (s)', 'speedup'))
+    for scraper, listing in sorted(listings.items()):
+        content = listing(args.entries)
+
+        expected = parse_listing_pyparsing(content, scraper)
+        result = _parse_listing(content, scraper)
+        if result != expected:
+            raise SystemExit('The %s listing results do not match' % scraper)
+
+        old = min(timeit.repeat(lambda: parse_listing_pyparsing(content, scraper),
+                                number=1, repeat=args.repeat))
+        new = min(timeit.repeat(lambda: _parse_listing(content, scraper),
+                                number=1, repeat=args.repeat))
+        print('%-8s %10i %12.3f %12.3f %7.0fx' % (
+            scraper, len(content) / 1024, old, new, old / new))
+
+
+if __name__ == '__main__':
+    main()
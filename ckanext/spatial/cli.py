@@ -64,10 +64,35 @@ def initdb(srid):
 
 
 @spatial.command('extents')
-def update_extents():
+@click.option('--bulk', is_flag=True,
+              help='Rebuild all extents in committed chunks, parsing them '
+                   'in parallel')
+@click.option('--workers', type=int,
+              help='Number of worker processes (bulk mode, defaults to the '
+                   'number of CPUs)')
+@click.option('--chunk-size', type=int,
+              help='Number of datasets processed at a time (bulk mode)')
+def update_extents(bulk, workers, chunk_size):
     """
     Creates or updates the extent geometry column for datasets with
     an extent defined in the 'spatial' extra.
     """
 
-    return util.update_extents()
+    return util.update_extents(bulk=bulk, workers=workers,
+                               chunk_size=chunk_size)
+
+
+@spatial.command('harvest-import')
+@click.argument('source_id')
+@click.option('--chunk-size', type=int,
+              help='Number of harvest objects written in each transaction')
+@click.option('--workers', type=int,
+              help='Number of processes validating and parsing the documents')
+def harvest_import(source_id, chunk_size, workers):
+    """
+    Imports again the current harvest objects of a spatial harvest source,
+    writing them in chunks with one transaction each and indexing the
+    datasets once per chunk.
+    """
+    return util.import_harvest_objects(source_id, chunk_size=chunk_size,
+                                       processes=workers)
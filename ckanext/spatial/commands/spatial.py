@@ -18,9 +18,17 @@ class Spatial(CkanCommand):
             and configured in the database.
             You can provide the SRID of the geometry column. Default is 4326.
 
-        spatial extents
+        spatial extents [--bulk] [--workers=N] [--chunk-size=N]
             Creates or updates the extent geometry column for datasets with
-            an extent defined in the 'spatial' extra.
+            an extent defined in the 'spatial' extra. With --bulk all
+            extents are rebuilt in committed chunks, parsing them in
+            parallel.
+
+        spatial harvest-import <source_id> [--chunk-size=N] [--workers=N]
+            Imports again the current harvest objects of a spatial harvest
+            source, writing them in chunks with one transaction each and
+            indexing the datasets once per chunk. With --workers, the
+            documents are validated and parsed by N processes.
 
     The commands should be run from the ckanext-spatial directory and expect
     a development.ini file to be present. Most of the time you will
@@ -35,6 +43,15 @@ class Spatial(CkanCommand):
     max_args = 2
     min_args = 0
 
+    def __init__(self, name):
+        super(Spatial, self).__init__(name)
+        self.parser.add_option('--bulk', dest='bulk', action='store_true',
+                               default=False, help='Bulk rebuild of the extents')
+        self.parser.add_option('--workers', dest='workers', type='int',
+                               default=None, help='Number of worker processes')
+        self.parser.add_option('--chunk-size', dest='chunk_size', type='int',
+                               default=None, help='Datasets or harvest objects processed at a time')
+
     def command(self):
         self._load_config()
 
@@ -46,6 +63,8 @@ class Spatial(CkanCommand):
             self.initdb()
         elif cmd == 'extents':
             self.update_extents()
+        elif cmd == 'harvest-import':
+            self.harvest_import()
         else:
             print('Command %s not recognized' % cmd)
 
@@ -56,5 +75,15 @@ class Spatial(CkanCommand):
             srid = None
         return util.initdb(srid)
 
+    def harvest_import(self):
+        if len(self.args) < 2:
+            print('Please provide a harvest source id')
+            sys.exit(1)
+        return util.import_harvest_objects(self.args[1],
+                                           chunk_size=self.options.chunk_size,
+                                           processes=self.options.workers)
+
     def update_extents(self):
-        return util.update_extents()
+        return util.update_extents(bulk=self.options.bulk,
+                                   workers=self.options.workers,
+                                   chunk_size=self.options.chunk_size)
@@ -7,7 +7,8 @@ from ckan.controllers.api import ApiController as BaseApiController
 from ckan.model import Session
 
 from ckanext.harvest.model import HarvestObject, HarvestObjectExtra
-from ckanext.spatial.lib import get_srid, validate_bbox, bbox_query
+from ckanext.spatial.lib import get_srid, validate_bbox, bbox_query_ids
+from ckanext.spatial.lib.cache import get_spatial_query_cache
 from ckanext.spatial import util
 
 log = logging.getLogger(__name__)
@@ -31,15 +32,17 @@ class ApiController(BaseApiController):
         srid = get_srid(request.params.get('crs')) if 'crs' in \
             request.params else None
 
-        extents = bbox_query(bbox, srid)
+        query_cache = get_spatial_query_cache()
+        bbox = query_cache.normalize_bbox(bbox)
+        ids = query_cache.get_or_run(
+            bbox, srid, 'ids', lambda: list(bbox_query_ids(bbox, srid)))
 
         format = request.params.get('format', '')
 
-        return self._output_results(extents, format)
+        return self._output_results(ids, format)
 
-    def _output_results(self, extents, format=None):
+    def _output_results(self, ids, format=None):
 
-        ids = [extent.package_id for extent in extents]
         output = dict(count=len(ids), results=ids)
 
         return self._finish_ok(output)
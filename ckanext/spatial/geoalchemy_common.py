@@ -49,7 +49,13 @@ def setup_spatial_table(package_extent_class, db_srid=None):
         package_extent_table = Table(
             'package_extent', meta.metadata,
             Column('package_id', types.UnicodeText, primary_key=True),
-            GeometryExtensionColumn('the_geom', Geometry(2, srid=db_srid))
+            GeometryExtensionColumn('the_geom', Geometry(2, srid=db_srid)),
+            Column('minx', types.Float),
+            Column('miny', types.Float),
+            Column('maxx', types.Float),
+            Column('maxy', types.Float),
+            Column('area', types.Float),
+            Column('fingerprint', types.UnicodeText)
         )
 
         meta.mapper(
@@ -72,6 +78,12 @@ def setup_spatial_table(package_extent_class, db_srid=None):
             Column('package_id', types.UnicodeText, primary_key=True),
             Column('the_geom', Geometry('GEOMETRY', srid=db_srid,
                                         management=management)),
+            Column('minx', types.Float),
+            Column('miny', types.Float),
+            Column('maxx', types.Float),
+            Column('maxy', types.Float),
+            Column('area', types.Float),
+            Column('fingerprint', types.UnicodeText),
             extend_existing=True
         )
 
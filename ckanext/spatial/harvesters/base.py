@@ -1,6 +1,5 @@
 import six
 from six.moves.urllib.parse import urlparse
-from six.moves.urllib.request import urlopen
 
 import re
 import cgitb
@@ -8,37 +7,112 @@ import warnings
 
 import sys
 import logging
+import functools
+import itertools
+from contextlib import contextmanager
 from string import Template
 from datetime import datetime
 import uuid
 import hashlib
 import dateutil
 import mimetypes
+import multiprocessing
 
 from owslib import wms
-import requests
 from lxml import etree
+from sqlalchemy import func
 
 from ckan import plugins as p
 from ckan import model
 from ckan.lib.helpers import json
 from ckan import logic
 from ckan.lib.navl.validators import not_empty
-from ckan.lib.search.index import PackageSearchIndex
 from ckanext.harvest.harvesters.base import munge_tag
 
 from ckanext.harvest.harvesters.base import HarvesterBase
 from ckanext.harvest.model import HarvestObject
+from ckanext.harvest.model import HarvestObjectExtra as HOExtra
 
 from ckanext.spatial.validation import Validators, all_validators
-from ckanext.spatial.model import ISODocument
+from ckanext.spatial.model import ISODocument, IndexQueueEntry
 from ckanext.spatial.interfaces import ISpatialHarvester
+from ckanext.spatial.lib import http_client
 from ckantoolkit import config
 
 log = logging.getLogger(__name__)
 
 DEFAULT_VALIDATOR_PROFILES = ['iso19139']
 
+# Defaults of the options controlling when the datasets queued by the
+# import stage are indexed, see SpatialHarvester._flush_index
+DEFAULT_INDEX_BATCH_SIZE = 500
+DEFAULT_INDEX_MAX_AGE = 300
+
+# (licenses_group_url, index) tuple, see SpatialHarvester._get_license_index
+_license_index = None
+
+
+# Flag set on the session info by `_deferred_indexing`
+DEFER_INDEXING = 'ckanext.spatial.defer_indexing'
+
+
+def _skip_deferred(notify):
+    '''
+    Wraps the `notify` method of the CKAN search plugin so the changes
+    committed by a session flagged by `_deferred_indexing` are not indexed
+    '''
+    @functools.wraps(notify)
+    def wrapper(self, entity, operation):
+        if model.Session().info.get(DEFER_INDEXING):
+            return
+        return notify(self, entity, operation)
+    wrapper.skips_deferred = True
+    return wrapper
+
+
+@contextmanager
+def _deferred_indexing():
+    '''
+    Turns off the automatic indexing of the datasets written with the
+    session of the current thread (ie by the harvester) while in the block.
+    The rest of the writes of the site are indexed as usual.
+    '''
+    from ckan.lib.search import SynchronousSearchPlugin
+
+    if not getattr(SynchronousSearchPlugin.notify, 'skips_deferred', False):
+        SynchronousSearchPlugin.notify = _skip_deferred(SynchronousSearchPlugin.notify)
+
+    info = model.Session().info
+    deferred = info.get(DEFER_INDEXING)
+    info[DEFER_INDEXING] = True
+    try:
+        yield
+    finally:
+        if not deferred:
+            model.Session().info.pop(DEFER_INDEXING, None)
+
+
+def log_http_stats(stage, level=logging.INFO):
+    '''
+    Decorator for the harvest stages, logging the counters of the HTTP
+    requests made by the process so far (see `http_client.get_stats`) once
+    the stage is done
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stats = http_client.get_stats()
+                total = stats.pop('total')
+                log.log(level, 'HTTP requests made by this process after the %s stage: '
+                        '%i (%i errors, %i bytes, %.1f seconds), per host: %r',
+                        stage, total['requests'], total['errors'], total['bytes'],
+                        total['seconds'], stats)
+        return wrapper
+    return decorator
+
 
 def text_traceback():
     with warnings.catch_warnings():
@@ -49,6 +123,76 @@ def text_traceback():
     return res
 
 
+def content_digest(content):
+    '''
+    Returns a SHA-1 digest of an XML document, ignoring the whitespace
+    around and between elements
+    '''
+    if isinstance(content, six.text_type):
+        content = content.encode('utf-8')
+    content = re.sub(b'>\\s+<', b'><', content.strip())
+    return hashlib.sha1(content).hexdigest()
+
+
+def _validate_xml(document_string, validator):
+    '''
+    Validates an XML document with the provided validator, returning a tuple
+    with the XML syntax error (if the document could not be parsed), whether
+    the validation passed, the profile used and the list of errors
+    '''
+    document_string = re.sub('<\?xml(.*)\?>', '', document_string)
+
+    try:
+        xml = etree.fromstring(document_string)
+    except etree.XMLSyntaxError as e:
+        return six.text_type(e), False, None, []
+
+    valid, profile, errors = validator.is_valid(xml)
+    return None, valid, profile, errors
+
+
+def analyse_document(content, validator):
+    '''
+    Validates an ISO document and reads its values, the CPU bound part of
+    the import stage. It does not use the database, so it can be run on a
+    separate process (see `SpatialHarvester.import_objects`).
+
+    Returns a dict with the result of the validation (see `_validate_xml`)
+    under the `validation` key, and the values read under `iso_values` (or
+    the error message under `iso_error` if they could not be read).
+    '''
+    analysis = {'validation': _validate_xml(content, validator)}
+    try:
+        analysis['iso_values'] = ISODocument(content).read_values()
+    except Exception as e:
+        analysis['iso_error'] = six.text_type(e)
+    return analysis
+
+
+def _analyse_document(args):
+    try:
+        return analyse_document(*args)
+    except Exception:
+        # The document is analysed again by the import stage, which
+        # records the error
+        log.error('Error analysing document: %s', text_traceback())
+        return None
+
+
+def _init_pool_process():
+    '''
+    Initializer of the processes of the `import_objects` pool. The forked
+    processes inherit the connections of the SQLAlchemy engine of the
+    importing process, so they are dropped without closing them, to make
+    sure they are never shared.
+    '''
+    try:
+        model.meta.engine.dispose(close=False)
+    except TypeError:
+        # SQLAlchemy < 1.4.33 can only close them
+        model.meta.engine.dispose()
+
+
 def guess_standard(content):
     lowered = content.lower()
     if '</gmd:MD_Metadata>'.lower() in lowered:
@@ -120,6 +264,17 @@ class SpatialHarvester(HarvesterBase):
 
     force_import = False
 
+    # Number of harvest objects written in each transaction by
+    # `import_objects`
+    import_chunk_size = 100
+
+    # Number of processes used by `import_objects` to validate and parse the
+    # documents (1 to do it in the importing process)
+    import_processes = 1
+
+    # State of the chunk being imported by `import_objects`, if any
+    _batch = None
+
     extent_template = Template('''
     {"type": "Polygon", "coordinates": [[[$xmin, $ymin], [$xmax, $ymin], [$xmax, $ymax], [$xmin, $ymax], [$xmin, $ymin]]]}
     ''')
@@ -157,6 +312,12 @@ class SpatialHarvester(HarvesterBase):
                     if not isinstance(source_config_obj[key],bool):
                         raise ValueError('%s must be boolean' % key)
 
+            if 'rate_limit' in source_config_obj:
+                rate_limit = source_config_obj['rate_limit']
+                if (not isinstance(rate_limit, (int, float)) or isinstance(rate_limit, bool)
+                        or rate_limit <= 0):
+                    raise ValueError('rate_limit must be a positive number')
+
         except ValueError as e:
             raise e
 
@@ -174,7 +335,7 @@ class SpatialHarvester(HarvesterBase):
         ckan.logic.action.create.package_create for more details
 
         Extensions willing to modify the dict should do so implementing the
-        ISpatialHarvester interface
+        ISpatialHarvester interface::
 
             import ckan.plugins as p
             from ckanext.spatial.interfaces import ISpatialHarvester
@@ -294,16 +455,10 @@ class SpatialHarvester(HarvesterBase):
         use_constraints = iso_values.get('use-constraints')
         if use_constraints:
 
-            context = {'model': model, 'session': model.Session, 'user': self._get_user_name()}
-            license_list = p.toolkit.get_action('license_list')(context, {})
+            license_index = self._get_license_index()
 
             for constraint in use_constraints:
-                package_license = None
-
-                for license in license_list:
-                    if constraint.lower() == license.get('id') or constraint == license.get('url'):
-                        package_license = license.get('id')
-                        break
+                package_license = license_index.get(constraint.lower())
 
                 if package_license:
                     package_dict['license_id'] = package_license
@@ -376,6 +531,17 @@ class SpatialHarvester(HarvesterBase):
         resource_locators = iso_values.get('resource-locator', []) +\
             iso_values.get('resource-locator-identification', [])
 
+        # Check if the WMS resources are view services, all at once
+        verified_wms = {}
+        if config.get('ckanext.spatial.harvest.validate_wms', False):
+            wms_urls = []
+            for resource_locator in resource_locators:
+                url = resource_locator.get('url', '').strip()
+                if url and guess_resource_format(url) == 'wms':
+                    wms_urls.append(url.split('?')[0])
+            if wms_urls:
+                verified_wms = self._verify_wms(wms_urls)
+
         if len(resource_locators):
             for resource_locator in resource_locators:
                 url = resource_locator.get('url', '').strip()
@@ -385,7 +551,7 @@ class SpatialHarvester(HarvesterBase):
                     if resource['format'] == 'wms' and config.get('ckanext.spatial.harvest.validate_wms', False):
                         # Check if the service is a view service
                         test_url = url.split('?')[0] if '?' in url else url
-                        if self._is_wms(test_url):
+                        if verified_wms.get(test_url):
                             resource['verified'] = True
                             resource['verified_date'] = datetime.now().isoformat()
 
@@ -435,13 +601,41 @@ class SpatialHarvester(HarvesterBase):
         self.__base_transform_to_iso_called = True
         return None
 
+    @log_http_stats('import', logging.DEBUG)
     def import_stage(self, harvest_object):
+        if self._batch is not None or not harvest_object:
+            # The datasets of a chunk of `import_objects` are indexed once
+            # the chunk is committed
+            return self._import_stage(harvest_object)
+
+        # The datasets are not indexed as they are written, but queued in
+        # the database to be indexed together once the job is done (see
+        # `_flush_index`)
+        job_id = harvest_object.harvest_job_id
+        source_id = harvest_object.harvest_source_id
+        imported = False
+        try:
+            with _deferred_indexing():
+                imported = self._import_stage(harvest_object)
+        except Exception:
+            model.Session.rollback()
+            raise
+        finally:
+            self._finish_import(harvest_object, imported)
+            self._flush_index(job_id, source_id)
+        return imported
+
+    def _import_stage(self, harvest_object):
         context = {
             'model': model,
             'session': model.Session,
             'user': self._get_user_name(),
         }
 
+        if self._batch is not None:
+            # The transaction is committed by `import_objects`
+            context['defer_commit'] = True
+
         log = logging.getLogger(__name__ + '.import')
         log.debug('Import stage for harvest object: %s', harvest_object.id)
 
@@ -467,11 +661,34 @@ class SpatialHarvester(HarvesterBase):
             context.update({
                 'ignore_auth': True,
             })
+            # Queued first, as package_delete commits
+            self._queue_index(harvest_object)
             p.toolkit.get_action('package_delete')(context, {'id': harvest_object.package_id})
             log.info('Deleted package {0} with guid {1}'.format(harvest_object.package_id, harvest_object.guid))
 
             return True
 
+        # If the document was not modified since the previous harvest (see
+        # `_get_remote_content`) or its content is the same as the one of a
+        # previous object imported successfully, there is nothing to import.
+        # The digest is only stored once the object is imported, so invalid
+        # documents are imported (and fail) again.
+        digest = self._get_content_digest(harvest_object)
+        if (status == 'change' and previous_object and not self.force_import
+                and previous_object.state == u'COMPLETE'
+                and (self._get_object_extra(harvest_object, 'unchanged') == 'true'
+                     or (digest and digest == self._get_object_extra(previous_object, 'content_digest')))):
+            if digest:
+                self._set_object_extras(harvest_object, {'content_digest': digest})
+            harvest_object.metadata_modified_date = previous_object.metadata_modified_date
+            harvest_object.current = True
+            harvest_object.add()
+            previous_object.current = False
+            previous_object.add()
+            self._set_unchanged(harvest_object, previous_object, context)
+            self._commit_import()
+            return True
+
         # Check if it is a non ISO document
         original_document = self._get_object_extra(harvest_object, 'original_document')
         original_format = self._get_object_extra(harvest_object, 'original_format')
@@ -496,8 +713,14 @@ class SpatialHarvester(HarvesterBase):
                 self._save_object_error('Empty content for object {0}'.format(harvest_object.id), harvest_object, 'Import')
                 return False
 
-            # Validate ISO document
-            is_valid, profile, errors = self._validate_document(harvest_object.content, harvest_object)
+            # Validate ISO document, unless it was already done by
+            # `import_objects`
+            analysis = self._get_analysis(harvest_object)
+            if analysis:
+                is_valid, profile, errors = self._record_validation(
+                    harvest_object, *analysis['validation'])
+            else:
+                is_valid, profile, errors = self._validate_document(harvest_object.content, harvest_object)
             if not is_valid:
                 # If validation errors were found, import will stop unless
                 # configuration per source or per instance says otherwise
@@ -507,10 +730,17 @@ class SpatialHarvester(HarvesterBase):
                     return False
 
         # Parse ISO document
+        analysis = self._get_analysis(harvest_object)
         try:
-
             iso_parser = ISODocument(harvest_object.content)
-            iso_values = iso_parser.read_values()
+            if analysis:
+                if 'iso_error' in analysis:
+                    raise Exception(analysis['iso_error'])
+                iso_values = analysis['iso_values']
+                # The tree is still passed to the get_package_dict hooks
+                iso_parser.get_xml_tree()
+            else:
+                iso_values = iso_parser.read_values()
         except Exception as e:
             self._save_object_error('Error parsing ISO document for object {0}: {1}'.format(harvest_object.id, six.text_type(e)),
                                     harvest_object, 'Import')
@@ -609,6 +839,7 @@ class SpatialHarvester(HarvesterBase):
 
             try:
                 package_id = p.toolkit.get_action('package_create')(context, package_dict)
+                self._queue_index(harvest_object)
                 log.info('Created new package %s with guid %s', package_id, harvest_object.guid)
             except p.toolkit.ValidationError as e:
                 self._save_object_error('Validation Error: %s' % six.text_type(e.error_summary), harvest_object, 'Import')
@@ -618,35 +849,7 @@ class SpatialHarvester(HarvesterBase):
 
             # Check if the modified date is more recent
             if not self.force_import and previous_object and harvest_object.metadata_modified_date <= previous_object.metadata_modified_date:
-
-                # Assign the previous job id to the new object to
-                # avoid losing history
-                harvest_object.harvest_job_id = previous_object.job.id
-                harvest_object.add()
-
-                # Delete the previous object to avoid cluttering the object table
-                previous_object.delete()
-
-                # Reindex the corresponding package to update the reference to the
-                # harvest object
-                if ((config.get('ckanext.spatial.harvest.reindex_unchanged', True) != 'False'
-                    or self.source_config.get('reindex_unchanged') != 'False')
-                    and harvest_object.package_id):
-                    context.update({'validate': False, 'ignore_auth': True})
-                    try:
-                        package_dict = logic.get_action('package_show')(context,
-                            {'id': harvest_object.package_id})
-                    except p.toolkit.ObjectNotFound:
-                        pass
-                    else:
-                        for extra in package_dict.get('extras', []):
-                            if extra['key'] == 'harvest_object_id':
-                                extra['value'] = harvest_object.id
-                        if package_dict:
-                            package_index = PackageSearchIndex()
-                            package_index.index_package(package_dict)
-
-                log.info('Document with GUID %s unchanged, skipping...' % (harvest_object.guid))
+                self._set_unchanged(harvest_object, previous_object, context)
             else:
                 package_schema = logic.schema.default_update_package_schema()
                 package_schema['tags'] = tag_schema
@@ -655,25 +858,371 @@ class SpatialHarvester(HarvesterBase):
                 package_dict['id'] = harvest_object.package_id
                 try:
                     package_id = p.toolkit.get_action('package_update')(context, package_dict)
+                    self._queue_index(harvest_object)
                     log.info('Updated package %s with guid %s', package_id, harvest_object.guid)
                 except p.toolkit.ValidationError as e:
                     self._save_object_error('Validation Error: %s' % six.text_type(e.error_summary), harvest_object, 'Import')
                     return False
 
-        model.Session.commit()
+        if digest:
+            self._set_object_extras(harvest_object, {'content_digest': digest})
+        self._commit_import()
 
         return True
+
+    @log_http_stats('import')
+    def import_objects(self, harvest_objects, chunk_size=None, processes=None):
+        '''
+        Imports a group of harvest objects, as `import_stage` does for each
+        one, but writing them in chunks of `chunk_size` objects (by default
+        `import_chunk_size`) with one transaction per chunk. The datasets
+        are not indexed as they are written, but all the ones changed in a
+        chunk are indexed once the chunk is committed.
+
+        Each object is imported in its own savepoint, so if it fails only
+        its changes are rolled back and its errors recorded, without
+        affecting the rest of the chunk.
+
+        The harvest queue consumers don't go through this method: they
+        call `import_stage` for one object at a time, with a transaction
+        per object. The chunks, savepoints and process pool are only used
+        by the callers of `import_objects`, eg the `spatial harvest-import`
+        command.
+
+        If `processes` (by default the
+        `ckanext.spatial.harvest.import_processes` config option, or
+        `import_processes`) is greater than 1, the documents of each chunk
+        are validated and parsed (see `analyse_document`) by a pool of
+        processes before the chunk is written, and only the database work
+        is done in this process.
+
+        `harvest_objects` can be any iterable, eg a generator loading the
+        objects of each chunk from the database, as it is only read
+        `chunk_size` objects at a time.
+
+        Returns the number of objects imported successfully.
+        '''
+        chunk_size = chunk_size or self.import_chunk_size
+        processes = int(processes or config.get(
+            'ckanext.spatial.harvest.import_processes', self.import_processes))
+        harvest_objects = iter(harvest_objects)
+
+        pool = None
+        imported = 0
+        try:
+            while True:
+                chunk = list(itertools.islice(harvest_objects, chunk_size))
+                if not chunk:
+                    break
+                if processes > 1 and len(chunk) > 1 and pool is None:
+                    pool = multiprocessing.Pool(processes, initializer=_init_pool_process)
+                imported += self._import_chunk(chunk, pool)
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
+        return imported
+
+    def _analyse_objects(self, harvest_objects, pool):
+        '''
+        Validates and parses the ISO documents of the harvest objects with
+        the process pool, returning a dict with the content and the result
+        of `analyse_document` for each object id
+        '''
+        # Documents transformed to ISO by the import stage are skipped
+        harvest_objects = [
+            harvest_object for harvest_object in harvest_objects
+            if harvest_object.content is not None
+            and not (self._get_object_extra(harvest_object, 'original_document')
+                     and self._get_object_extra(harvest_object, 'original_format'))]
+        if not harvest_objects:
+            return {}
+
+        self._set_source_config(harvest_objects[0].source.config)
+        validator = self._get_validator()
+        results = pool.map(
+            _analyse_document,
+            [(harvest_object.content, validator) for harvest_object in harvest_objects])
+        return dict(
+            (harvest_object.id, (harvest_object.content, analysis))
+            for harvest_object, analysis in zip(harvest_objects, results))
+
+    def _get_analysis(self, harvest_object):
+        '''
+        Returns the result of `analyse_document` for the harvest object if
+        it was worked out by `import_objects` for its current content
+        '''
+        if self._batch is None:
+            return None
+        content, analysis = self._batch['analysis'].get(harvest_object.id, (None, None))
+        if analysis is not None and content == harvest_object.content:
+            return analysis
+        return None
+
+    def _import_chunk(self, harvest_objects, pool=None):
+        log = logging.getLogger(__name__ + '.import')
+
+        analysis = self._analyse_objects(harvest_objects, pool) if pool else {}
+
+        self._batch = {'errors': [], 'analysis': analysis, 'unindexed': set()}
+        imported = 0
+        try:
+            # Datasets are indexed when the session is committed, so the
+            # chunk commit must happen with the automatic indexing off too
+            with _deferred_indexing():
+                for harvest_object in harvest_objects:
+                    harvest_object.import_started = datetime.utcnow()
+                    savepoint = model.Session.begin_nested()
+                    try:
+                        success = self.import_stage(harvest_object)
+                    except Exception as e:
+                        log.error('Error importing object %s: %s', harvest_object.id, text_traceback())
+                        success = False
+                        self._save_object_error('Error importing object {0}: {1}'.format(
+                            harvest_object.id, six.text_type(e)), harvest_object, 'Import')
+
+                    # Actions that always commit (eg package_delete) end the
+                    # savepoint themselves
+                    if savepoint.is_active:
+                        if success:
+                            savepoint.commit()
+                        else:
+                            savepoint.rollback()
+
+                    if success:
+                        imported += 1
+                    harvest_object.state = 'COMPLETE' if success else 'ERROR'
+                    harvest_object.import_finished = datetime.utcnow()
+                    harvest_object.add()
+
+                model.Session.commit()
+        except Exception:
+            model.Session.rollback()
+            raise
+        finally:
+            errors = self._batch['errors']
+            unindexed = self._batch['unindexed']
+            self._batch = None
+
+        for message, harvest_object, stage, line in errors:
+            self._save_object_error(message, harvest_object, stage, line)
+
+        self._index_chunk(
+            [harvest_object.id for harvest_object in harvest_objects
+             if harvest_object.id not in unindexed])
+
+        return imported
+
+    def _index_chunk(self, object_ids):
+        '''
+        Indexes the datasets of the harvest objects of a chunk committed
+        by `import_objects` that were imported successfully, with a single
+        commit of the search index
+        '''
+        from ckan.lib.search import rebuild, commit
+
+        log = logging.getLogger(__name__ + '.import')
+
+        if not object_ids:
+            return
+        package_ids = [package_id for package_id, in model.Session.query(HarvestObject.package_id)
+                       .filter(HarvestObject.id.in_(object_ids))
+                       .filter(HarvestObject.state == u'COMPLETE')
+                       .filter(HarvestObject.package_id != None)
+                       .distinct()]
+        if package_ids:
+            rebuild(package_ids=package_ids, force=True, defer_commit=True)
+            commit()
+            log.debug('Indexed %i datasets', len(package_ids))
+
+    def _queue_index(self, harvest_object):
+        '''
+        Queues the dataset of a harvest object imported by the import stage
+        to be indexed (see `_flush_index`). The entry is committed with the
+        rest of the changes of the import.
+        '''
+        if self._batch is None and harvest_object.package_id:
+            model.Session.add(IndexQueueEntry(
+                package_id=harvest_object.package_id,
+                harvest_source_id=harvest_object.harvest_source_id,
+                harvest_job_id=harvest_object.harvest_job_id))
+
+    def _finish_import(self, harvest_object, imported):
+        '''
+        Sets the final state of an object imported by the import stage, as
+        the harvest queue does once `import_stage` returns. It is committed
+        before checking if the job is done, so of two objects of a job
+        finishing at the same time at least one sees the other finished.
+        '''
+        harvest_object.state = u'COMPLETE' if imported else u'ERROR'
+        harvest_object.save()
+
+    def _flush_index(self, job_id, source_id):
+        '''
+        Indexes the datasets queued by the import stage for the harvest
+        source once the job has no objects left to import, or before that
+        if there are `ckanext.spatial.harvest.index_batch_size` of them
+        (500 by default) or the oldest one has been waiting for
+        `ckanext.spatial.harvest.index_max_age` seconds (300 by default).
+
+        The queue is kept in the database, so whichever process imports
+        the last object of a job indexes its datasets, and the ones left
+        by a process that stopped before indexing them are indexed with the
+        next ones of the source.
+        '''
+        from ckan.lib.search import rebuild, commit
+
+        log = logging.getLogger(__name__ + '.import')
+
+        batch_size = int(config.get('ckanext.spatial.harvest.index_batch_size',
+                                    DEFAULT_INDEX_BATCH_SIZE))
+        max_age = float(config.get('ckanext.spatial.harvest.index_max_age',
+                                   DEFAULT_INDEX_MAX_AGE))
+
+        queue = model.Session.query(IndexQueueEntry) \
+            .filter(IndexQueueEntry.harvest_source_id == source_id)
+        count, oldest = model.Session.query(
+            func.count(IndexQueueEntry.id), func.min(IndexQueueEntry.queued)) \
+            .filter(IndexQueueEntry.harvest_source_id == source_id).one()
+        if not count:
+            return
+        if count < batch_size and (datetime.utcnow() - oldest).total_seconds() < max_age:
+            remaining = model.Session.query(HarvestObject.id) \
+                .filter(HarvestObject.harvest_job_id == job_id) \
+                .filter(~HarvestObject.state.in_([u'COMPLETE', u'ERROR'])) \
+                .first()
+            if remaining:
+                return
+
+        # Processes flushing the queue at the same time skip the entries
+        # claimed by this one
+        entries = queue.with_for_update(skip_locked=True).all()
+        package_ids = sorted(set(entry.package_id for entry in entries))
+        indexed = 0
+        for i in range(0, len(package_ids), batch_size):
+            # Datasets purged since they were queued can not be indexed
+            batch = [package_id for package_id, in model.Session.query(model.Package.id)
+                     .filter(model.Package.id.in_(package_ids[i:i + batch_size]))]
+            if batch:
+                rebuild(package_ids=batch, force=True, defer_commit=True)
+                indexed += len(batch)
+        if indexed:
+            commit()
+
+        entry_ids = [entry.id for entry in entries]
+        for i in range(0, len(entry_ids), batch_size):
+            model.Session.query(IndexQueueEntry) \
+                .filter(IndexQueueEntry.id.in_(entry_ids[i:i + batch_size])) \
+                .delete(synchronize_session=False)
+        model.Session.commit()
+        log.debug('Indexed %i harvested datasets', indexed)
+
+    def _commit_import(self):
+        '''
+        Commits the changes of an import, unless it is part of a chunk of
+        `import_objects`
+        '''
+        if self._batch is None:
+            model.Session.commit()
+
+    def _save_object_error(self, message, obj, stage=u'Fetch', line=None):
+        # While importing a chunk, the errors are recorded once it is
+        # committed, as saving them commits the session
+        if self._batch is not None:
+            self._batch['errors'].append((message, obj, stage, line))
+            return
+        return super(SpatialHarvester, self)._save_object_error(
+            message, obj, stage, line)
+
+    def _get_content_digest(self, harvest_object):
+        '''
+        Returns a digest of the harvested document (the original one for
+        non ISO documents), or None if there is no content
+        '''
+        content = self._get_object_extra(harvest_object, 'original_document') \
+            or harvest_object.content
+        if not content:
+            return None
+        return content_digest(content)
+
+    def _get_license_index(self):
+        '''
+        Returns a dict mapping the lower-cased ids and URLs of the licenses
+        of the site to their ids.
+
+        The index is built once per process, and rebuilt if the
+        `licenses_group_url` config option changes.
+        '''
+        global _license_index
+        key = config.get('licenses_group_url')
+        if _license_index is None or _license_index[0] != key:
+            context = {'model': model, 'session': model.Session, 'user': self._get_user_name()}
+            license_list = p.toolkit.get_action('license_list')(context, {})
+
+            index = {}
+            for license in license_list:
+                for value in (license.get('id'), license.get('url')):
+                    if value:
+                        # The first license in the list wins, as when the
+                        # list was scanned for each object
+                        index.setdefault(value.lower(), license.get('id'))
+            _license_index = (key, index)
+
+        return _license_index[1]
+
+    def _set_unchanged(self, harvest_object, previous_object, context):
+        '''
+        Replaces the previous harvest object of a document that has not
+        changed with the current one, without updating the dataset
+        '''
+        # Assign the previous job id to the new object to
+        # avoid losing history
+        harvest_object.harvest_job_id = previous_object.job.id
+        harvest_object.add()
+
+        # Delete the previous object to avoid cluttering the object table
+        previous_object.delete()
+
+        # Reindex the corresponding package to update the reference to the
+        # harvest object, which is picked up from the database when it is
+        # indexed. The datasets of a chunk of `import_objects` are all
+        # indexed once it is committed.
+        reindex = ((config.get('ckanext.spatial.harvest.reindex_unchanged', True) != 'False'
+                    or self.source_config.get('reindex_unchanged') != 'False')
+                   and harvest_object.package_id)
+        if self._batch is not None:
+            if not reindex:
+                self._batch['unindexed'].add(harvest_object.id)
+        elif reindex:
+            self._queue_index(harvest_object)
+
+        log.info('Document with GUID %s unchanged, skipping...' % (harvest_object.guid))
     ##
 
     def _is_wms(self, url):
+        '''
+        Checks if the provided URL actually points to a Web Map Service.
+        The result is cached (see `ckanext.spatial.lib.wms_verifier`).
+        '''
+        return self._verify_wms([url])[url]
+
+    def _verify_wms(self, urls):
+        '''
+        Returns a dict with whether each of the provided URLs actually points
+        to a Web Map Service, checking the ones not cached concurrently.
+        '''
+        from ckanext.spatial.lib.wms_verifier import get_wms_verifier
+        return get_wms_verifier().verify(urls, self._check_wms)
+
+    def _check_wms(self, url):
         '''
         Checks if the provided URL actually points to a Web Map Service.
         Uses owslib WMS reader to parse the response.
         '''
         try:
             capabilities_url = wms.WMSCapabilitiesReader().capabilities_url(url)
-            res = urlopen(capabilities_url, None, 10)
-            xml = res.read()
+            # Not retried, as the result (failed or not) is cached
+            xml = self._http_get(capabilities_url, timeout=10, retries=0).content
 
             s = wms.WebMapService(url, xml=xml)
             return isinstance(s.contents, dict) and s.contents != {}
@@ -691,6 +1240,46 @@ class SpatialHarvester(HarvesterBase):
                 return extra.value
         return None
 
+    def _get_previous_object(self, guid):
+        '''
+        Returns the current harvest object for a guid, if any
+        '''
+        if not guid:
+            return None
+        return model.Session.query(HarvestObject) \
+                          .filter(HarvestObject.guid==guid) \
+                          .filter(HarvestObject.current==True) \
+                          .first()
+
+    def _set_object_extras(self, harvest_object, extras):
+        '''
+        Adds or updates extras of a harvest object, given a dict of keys and
+        values
+        '''
+        for key, value in extras.items():
+            for extra in harvest_object.extras:
+                if extra.key == key:
+                    extra.value = value
+                    break
+            else:
+                harvest_object.extras.append(HOExtra(key=key, value=value))
+
+    def _reuse_previous_content(self, harvest_object, previous_object, validators=None):
+        '''
+        Copies the content of the previous harvest object of a document not
+        modified since it was harvested, flagging the new object as
+        unchanged so the import stage skips it.
+        '''
+        harvest_object.content = previous_object.content
+        extras = {'unchanged': 'true'}
+        for key in ('original_document', 'original_format',
+                    'http_etag', 'http_last_modified'):
+            value = self._get_object_extra(previous_object, key)
+            if value:
+                extras[key] = value
+        extras.update(validators or {})
+        self._set_object_extras(harvest_object, extras)
+
     def _set_source_config(self, config_str):
         '''
         Loads the source configuration JSON object into a dict for
@@ -769,8 +1358,20 @@ class SpatialHarvester(HarvesterBase):
         DEPRECATED: Use _get_content_as_unicode instead
         '''
         url = url.replace(' ', '%20')
-        http_response = urlopen(url)
-        return http_response.read()
+        response = self._http_get(url)
+        response.raise_for_status()
+        return response.content
+
+    def _http_get(self, url, **kwargs):
+        '''
+        Makes a GET request with the shared HTTP client (see
+        `ckanext.spatial.lib.http_client.get`), limiting the requests per
+        second to the `rate_limit` of the source configuration if set
+        '''
+        rate_limit = getattr(self, 'source_config', {}).get('rate_limit')
+        if rate_limit:
+            kwargs.setdefault('rate_limit', float(rate_limit))
+        return http_client.get(url, **kwargs)
 
     def _get_content_as_unicode(self, url):
         '''
@@ -786,12 +1387,50 @@ class SpatialHarvester(HarvesterBase):
 
         [1] http://github.com/kennethreitz/requests/blob/63243b1e3b435c7736acf1e51c0f6fa6666d861d/requests/models.py#L811
 
+        '''
+        content, validators = self._get_remote_content(url)
+        return content
+
+    def _get_remote_content(self, url, previous_object=None):
+        '''
+        Get remote content as unicode (see `_get_content_as_unicode`),
+        along with the HTTP cache validators sent by the server, as a dict
+        with the `http_etag` and `http_last_modified` keys (if present).
+
+        If a previous harvest object for the same document is provided, the
+        request is made conditional on the validators stored on it. If the
+        server says that the document has not been modified, the returned
+        content is None.
         '''
         url = url.replace(' ', '%20')
-        response = requests.get(url, timeout=10)
 
-        content = response.text
+        headers = {}
+        # The content of the previous object is reused if not modified
+        if previous_object and previous_object.content:
+            etag = self._get_object_extra(previous_object, 'http_etag')
+            last_modified = self._get_object_extra(previous_object, 'http_last_modified')
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
 
+        response = self._http_get(url, timeout=10, headers=headers)
+
+        validators = {}
+        if response.headers.get('etag'):
+            validators['http_etag'] = response.headers['etag']
+        if response.headers.get('last-modified'):
+            validators['http_last_modified'] = response.headers['last-modified']
+
+        if response.status_code == 304 and headers:
+            return None, validators
+
+        return self._clean_content(response.text), validators
+
+    def _clean_content(self, content):
+        '''
+        Removes the XML declaration and anything before the root element
+        '''
         # Remove original XML declaration
         content = re.sub('<\?xml(.*)\?>', '', content)
 
@@ -816,15 +1455,18 @@ class SpatialHarvester(HarvesterBase):
         if not validator:
             validator = self._get_validator()
 
-        document_string = re.sub('<\?xml(.*)\?>', '', document_string)
+        return self._record_validation(
+            harvest_object, *_validate_xml(document_string, validator))
 
-        try:
-            xml = etree.fromstring(document_string)
-        except etree.XMLSyntaxError as e:
-            self._save_object_error('Could not parse XML file: {0}'.format(six.text_type(e)), harvest_object, 'Import')
+    def _record_validation(self, harvest_object, xml_error, valid, profile, errors):
+        '''
+        Creates the HarvestObjectErrors for the result of `_validate_xml`,
+        returning the same tuple as `_validate_document`
+        '''
+        if xml_error:
+            self._save_object_error('Could not parse XML file: {0}'.format(xml_error), harvest_object, 'Import')
             return False, None, []
 
-        valid, profile, errors = validator.is_valid(xml)
         if not valid:
             log.error('Validation errors found using profile {0} for object with GUID {1}'.format(profile, harvest_object.guid))
             for error in errors:
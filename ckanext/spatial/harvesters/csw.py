@@ -1,19 +1,26 @@
 import re
 import six
+import time
+import datetime
 from six.moves.urllib.parse import urlparse, urlunparse, urlencode
 
 import logging
 
 from ckan import model
+from ckan.lib.helpers import json
+from ckantoolkit import config
 
 from ckan.plugins.core import SingletonPlugin, implements
 
 from ckanext.harvest.interfaces import IHarvester
-from ckanext.harvest.model import HarvestObject
+from ckanext.harvest.model import HarvestObject, HarvestJob
 from ckanext.harvest.model import HarvestObjectExtra as HOExtra
 
-from ckanext.spatial.lib.csw_client import CswService
-from ckanext.spatial.harvesters.base import SpatialHarvester, text_traceback
+from ckanext.spatial.lib.csw_client import get_csw_service, paging_options
+from ckanext.spatial.model.csw_listing import CswListing
+from ckanext.spatial.harvesters.base import SpatialHarvester, text_traceback, log_http_stats
+
+log = logging.getLogger(__name__)
 
 
 class CSWHarvester(SpatialHarvester, SingletonPlugin):
@@ -24,6 +31,16 @@ class CSWHarvester(SpatialHarvester, SingletonPlugin):
 
     csw = None
 
+    # Default number of days between full listings of the catalog in
+    # incremental mode
+    full_listing_interval = 7
+
+    # Minimum number of seconds between saves of the gather checkpoint
+    checkpoint_interval = 60
+
+    # Number of seconds after which a gather checkpoint is not resumed
+    checkpoint_max_age = 24 * 3600
+
     def info(self):
         return {
             'name': 'csw',
@@ -58,9 +75,34 @@ class CSWHarvester(SpatialHarvester, SingletonPlugin):
 
         return url
 
+    def validate_config(self, source_config):
+        source_config = super(CSWHarvester, self).validate_config(source_config)
+        if not source_config:
+            return source_config
+
+        source_config_obj = json.loads(source_config)
+        for key in ('bulk_fetch', 'incremental'):
+            if key in source_config_obj:
+                if not isinstance(source_config_obj[key], bool):
+                    raise ValueError('%s must be boolean' % key)
+
+        if 'full_listing_interval' in source_config_obj:
+            value = source_config_obj['full_listing_interval']
+            if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+                raise ValueError('full_listing_interval must be a non-negative integer')
+
+        for key in ('page_size', 'max_page_size', 'workers'):
+            if key in source_config_obj:
+                value = source_config_obj[key]
+                if not isinstance(value, int) or isinstance(value, bool) or value < 1:
+                    raise ValueError('%s must be a positive integer' % key)
+
+        return source_config
+
     def output_schema(self):
         return 'gmd'
 
+    @log_http_stats('gather')
     def gather_stage(self, harvest_job):
         log = logging.getLogger(__name__ + '.CSW.gather')
         log.debug('CswHarvester gather_stage for job: %r', harvest_job)
@@ -88,17 +130,80 @@ class CSWHarvester(SpatialHarvester, SingletonPlugin):
         # extract cql filter if any
         cql = self.source_config.get('cql')
 
+        # in bulk mode the full records are requested while paging through
+        # the catalog, and stored in the harvest objects as they arrive
+        bulk = self.source_config.get('bulk_fetch', False)
+
+        paging = paging_options(self.source_config)
+
+        # in incremental mode only the records modified since the previous
+        # job are listed, so the records not listed are left untouched
+        modified_since = self._get_modified_since(harvest_job)
+        if modified_since:
+            log.info('Requesting records modified since %s', modified_since)
+        gather_started = harvest_job.gather_started or datetime.datetime.utcnow()
+
+        # if a previous job failed while listing the same records, resume
+        # the listing from where it stopped
+        listing = {
+            'url': url,
+            'cql': cql,
+            'modified_since': modified_since,
+            'output_schema': self.output_schema(),
+        }
+        checkpoint = self._get_checkpoint(harvest_job, listing)
+        if checkpoint:
+            gather_started = checkpoint.checkpoint_started
+            startposition = checkpoint.checkpoint_position
+            # the records listed by the previous jobs were already harvested
+            # by them
+            guids_in_harvest = self._get_listed_guids(harvest_job, gather_started)
+            log.info('Resuming the gathering for %s from record %i (%i identifiers already listed)',
+                     url, startposition, len(guids_in_harvest))
+        else:
+            startposition = 0
+            guids_in_harvest = set()
+
+        # the records that could not be fetched or imported since the
+        # previous listing are requested again
+        failed_guids = self._get_failed_guids(harvest_job, modified_since) \
+            if modified_since else set()
+        position = {'startposition': startposition, 'saved': time.time()}
+
+        def progress(startposition):
+            position['startposition'] = startposition
+            if time.time() - position['saved'] >= self.checkpoint_interval:
+                self._save_checkpoint(harvest_job, listing, startposition, gather_started)
+                position['saved'] = time.time()
+
         log.debug('Starting gathering for %s' % url)
-        guids_in_harvest = set()
+        ids = []
         try:
-            for identifier in self.csw.getidentifiers(page=10, outputschema=self.output_schema(), cql=cql):
+            if bulk:
+                records = self.csw.getrecordsfull(
+                    outputschema=self.output_schema(), cql=cql,
+                    modified_since=modified_since, startposition=startposition,
+                    progress=progress, **paging)
+            else:
+                records = ((identifier, None) for identifier in
+                           self.csw.getidentifiers(
+                               outputschema=self.output_schema(), cql=cql,
+                               modified_since=modified_since,
+                               startposition=startposition,
+                               progress=progress, **paging))
+            for identifier, content in records:
                 try:
                     log.info('Got identifier %s from the CSW', identifier)
                     if identifier is None:
                         log.error('CSW returned identifier %r, skipping...' % identifier)
                         continue
+                    if identifier in guids_in_harvest:
+                        continue
 
                     guids_in_harvest.add(identifier)
+
+                    ids.append(self._create_object(
+                        identifier, harvest_job, guid_to_package_id, content))
                 except Exception as e:
                     self._save_gather_error('Error for the identifier %s [%r]' % (identifier,e), harvest_job)
                     continue
@@ -106,24 +211,21 @@ class CSWHarvester(SpatialHarvester, SingletonPlugin):
         except Exception as e:
             log.error('Exception: %s' % text_traceback())
             self._save_gather_error('Error gathering the identifiers from the CSW server [%s]' % six.text_type(e), harvest_job)
-            return None
-
-        new = guids_in_harvest - guids_in_db
-        delete = guids_in_db - guids_in_harvest
-        change = guids_in_db & guids_in_harvest
-
-        ids = []
-        for guid in new:
-            obj = HarvestObject(guid=guid, job=harvest_job,
-                                extras=[HOExtra(key='status', value='new')])
-            obj.save()
-            ids.append(obj.id)
-        for guid in change:
-            obj = HarvestObject(guid=guid, job=harvest_job,
-                                package_id=guid_to_package_id[guid],
-                                extras=[HOExtra(key='status', value='change')])
-            obj.save()
-            ids.append(obj.id)
+            # the records listed so far are harvested, and the next job
+            # resumes the listing from where it stopped (without deleting
+            # anything until the listing is complete)
+            self._save_checkpoint(harvest_job, listing, position['startposition'],
+                                  gather_started)
+            return ids or None
+
+        relisted = failed_guids - guids_in_harvest
+        if relisted:
+            log.info('Requesting again %i records that failed on previous jobs', len(relisted))
+            for guid in relisted:
+                ids.append(self._create_object(guid, harvest_job, guid_to_package_id))
+            guids_in_harvest.update(relisted)
+
+        delete = guids_in_db - guids_in_harvest if not modified_since else set()
         for guid in delete:
             obj = HarvestObject(guid=guid, job=harvest_job,
                                 package_id=guid_to_package_id[guid],
@@ -134,12 +236,155 @@ class CSWHarvester(SpatialHarvester, SingletonPlugin):
             obj.save()
             ids.append(obj.id)
 
-        if len(ids) == 0:
+        self._save_listing(harvest_job, gather_started, full=not modified_since)
+
+        if not guids_in_harvest and not modified_since:
             self._save_gather_error('No records received from the CSW server', harvest_job)
             return None
 
+        if len(ids) == 0:
+            log.info('No records to harvest since %s', modified_since or gather_started)
+
         return ids
 
+    def _get_modified_since(self, harvest_job):
+        '''
+        Returns the date (as an ISO 8601 string) from which the modified
+        records should be requested in incremental mode, ie the start of the
+        last listing of the source that completed.
+
+        Returns None if all the records should be listed: if the source is
+        not incremental, if no listing completed yet or if the last full
+        listing is older than `full_listing_interval` days, as only full
+        listings can detect the records deleted from the server.
+        '''
+        if not self.source_config.get('incremental', False):
+            return None
+
+        interval = int(self.source_config.get(
+            'full_listing_interval',
+            config.get('ckanext.spatial.harvest.csw_full_listing_interval',
+                       self.full_listing_interval)))
+        listing = CswListing.get(harvest_job.source_id)
+        if not listing or not listing.last_full_listing:
+            return None
+        if datetime.datetime.utcnow() - listing.last_full_listing >= datetime.timedelta(days=interval):
+            return None
+
+        return listing.last_listing.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+    def _get_failed_guids(self, harvest_job, modified_since):
+        '''
+        Returns the guids of the records that failed on the fetch or import
+        stages of the jobs started since the last listing, as they are not
+        listed again unless they are modified.
+        '''
+        since = datetime.datetime.strptime(modified_since, '%Y-%m-%dT%H:%M:%SZ')
+        deleted = model.Session.query(HOExtra.harvest_object_id).\
+            filter(HOExtra.key == 'status').\
+            filter(HOExtra.value == 'delete')
+        query = model.Session.query(HarvestObject.guid).\
+            join(HarvestJob, HarvestObject.harvest_job_id == HarvestJob.id).\
+            filter(HarvestJob.source_id == harvest_job.source_id).\
+            filter(HarvestJob.id != harvest_job.id).\
+            filter(HarvestJob.gather_started >= since).\
+            filter(HarvestObject.state == u'ERROR').\
+            filter(~HarvestObject.id.in_(deleted))
+        return set(guid for guid, in query)
+
+    def _get_checkpoint(self, harvest_job, listing):
+        '''
+        Returns the CswListing of the source if a previous job failed while
+        listing the records, with the position to resume the listing from
+        (`checkpoint_position`) and the time the listing was started
+        (`checkpoint_started`).
+
+        Returns None if there is no checkpoint, or if it was saved for a
+        different listing (eg if the source configuration changed) or more
+        than `checkpoint_max_age` seconds ago.
+        '''
+        state = CswListing.get(harvest_job.source_id)
+        if not state or not state.checkpoint_listing:
+            return None
+        if json.loads(state.checkpoint_listing) != listing:
+            log.info('Ignoring the gather checkpoint of source %s, saved for a different listing',
+                     harvest_job.source_id)
+            return None
+        age = datetime.datetime.utcnow() - state.checkpoint_saved
+        if age > datetime.timedelta(seconds=self.checkpoint_max_age):
+            log.info('Ignoring the gather checkpoint of source %s, saved too long ago',
+                     harvest_job.source_id)
+            return None
+        return state
+
+    def _get_listed_guids(self, harvest_job, listing_started):
+        '''
+        Returns the guids of the records listed by the previous jobs of the
+        listing started at `listing_started`, from their harvest objects
+        '''
+        query = model.Session.query(HarvestObject.guid).\
+            join(HarvestJob, HarvestObject.harvest_job_id == HarvestJob.id).\
+            filter(HarvestJob.source_id == harvest_job.source_id).\
+            filter(HarvestJob.id != harvest_job.id).\
+            filter(HarvestJob.gather_started >= listing_started)
+        return set(guid for guid, in query)
+
+    def _save_checkpoint(self, harvest_job, listing, startposition, gather_started):
+        '''
+        Saves the position of the listing of the records, so a later job
+        can resume it if this one fails. The records listed so far are not
+        stored, as they can be obtained from the harvest objects created.
+        '''
+        try:
+            state = CswListing.get(harvest_job.source_id) or \
+                CswListing(source_id=harvest_job.source_id)
+            state.checkpoint_listing = json.dumps(listing, sort_keys=True)
+            state.checkpoint_started = gather_started
+            state.checkpoint_position = startposition
+            state.checkpoint_saved = datetime.datetime.utcnow()
+            state.save()
+        except Exception as e:
+            model.Session.rollback()
+            log.error('Error saving the gather checkpoint of source %s: %s',
+                      harvest_job.source_id, e)
+
+    def _save_listing(self, harvest_job, gather_started, full):
+        '''
+        Records the start of a listing of the records of the source that
+        completed, removing its checkpoint
+        '''
+        state = CswListing.get(harvest_job.source_id) or \
+            CswListing(source_id=harvest_job.source_id)
+        state.last_listing = gather_started
+        if full:
+            state.last_full_listing = gather_started
+        state.checkpoint_listing = None
+        state.checkpoint_started = None
+        state.checkpoint_position = None
+        state.checkpoint_saved = None
+        state.save()
+
+    def _create_object(self, guid, harvest_job, guid_to_package_id, content=None):
+        '''
+        Creates the harvest object for a new or changed record, returning
+        its id. If the record content is provided it is stored and the
+        object flagged with a `bulk_fetched` extra, so the fetch stage
+        doesn't need to request it again.
+        '''
+        if guid in guid_to_package_id:
+            obj = HarvestObject(guid=guid, job=harvest_job,
+                                package_id=guid_to_package_id[guid],
+                                extras=[HOExtra(key='status', value='change')])
+        else:
+            obj = HarvestObject(guid=guid, job=harvest_job,
+                                extras=[HOExtra(key='status', value='new')])
+        if content:
+            # Remove original XML declaration
+            obj.content = re.sub('<\?xml(.*)\?>', '', content).strip()
+            obj.extras.append(HOExtra(key='bulk_fetched', value='true'))
+        obj.save()
+        return obj.id
+
     def fetch_stage(self,harvest_object):
 
         # Check harvest object status
@@ -149,6 +394,11 @@ class CSWHarvester(SpatialHarvester, SingletonPlugin):
             # No need to fetch anything, just pass to the import stage
             return True
 
+        if harvest_object.content and \
+                self._get_object_extra(harvest_object, 'bulk_fetched') == 'true':
+            # Already fetched in bulk during the gather stage
+            return True
+
         log = logging.getLogger(__name__ + '.CSW.fetch')
         log.debug('CswHarvester fetch_stage for object: %s', harvest_object.id)
 
@@ -189,4 +439,4 @@ class CSWHarvester(SpatialHarvester, SingletonPlugin):
         return True
 
     def _setup_csw_client(self, url):
-        self.csw = CswService(url)
+        self.csw = get_csw_service(url)
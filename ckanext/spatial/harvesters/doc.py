@@ -9,7 +9,7 @@ from ckanext.harvest.interfaces import IHarvester
 from ckanext.harvest.model import HarvestObject
 from ckanext.harvest.model import HarvestObjectExtra as HOExtra
 
-from ckanext.spatial.harvesters.base import SpatialHarvester,  guess_standard
+from ckanext.spatial.harvesters.base import SpatialHarvester, guess_standard, log_http_stats
 
 
 class DocHarvester(SpatialHarvester, SingletonPlugin):
@@ -38,6 +38,7 @@ class DocHarvester(SpatialHarvester, SingletonPlugin):
         return obj.source.url
 
 
+    @log_http_stats('gather')
     def gather_stage(self,harvest_job):
         log = logging.getLogger(__name__ + '.individual.gather')
         log.debug('DocHarvester gather_stage for job: %r', harvest_job)
@@ -49,19 +50,20 @@ class DocHarvester(SpatialHarvester, SingletonPlugin):
 
         self._set_source_config(harvest_job.source.config)
 
-        # Get contents
+        existing_object = model.Session.query(HarvestObject).\
+                                    filter(HarvestObject.current==True).\
+                                    filter(HarvestObject.harvest_source_id==harvest_job.source.id).\
+                                    first()
+
+        # Get contents, only if modified since the previous harvest when the
+        # server supports it
         try:
-            content = self._get_content_as_unicode(url)
+            content, validators = self._get_remote_content(url, existing_object)
         except Exception as e:
             self._save_gather_error('Unable to get content for URL: %s: %r' % \
                                         (url, e),harvest_job)
             return None
 
-        existing_object = model.Session.query(HarvestObject.guid, HarvestObject.package_id).\
-                                    filter(HarvestObject.current==True).\
-                                    filter(HarvestObject.harvest_source_id==harvest_job.source.id).\
-                                    first()
-
         def create_extras(url, status):
             return [HOExtra(key='doc_location', value=url),
                     HOExtra(key='status', value=status)]
@@ -83,6 +85,14 @@ class DocHarvester(SpatialHarvester, SingletonPlugin):
 
         harvest_object.add()
 
+        if content is None:
+            log.debug('Document %s not modified', url)
+            self._reuse_previous_content(harvest_object, existing_object, validators)
+            harvest_object.save()
+            return [harvest_object.id]
+
+        self._set_object_extras(harvest_object, validators)
+
         # Check if it is an ISO document
         document_format = guess_standard(content)
         if document_format == 'iso':
@@ -34,7 +34,7 @@ from ckanext.harvest.interfaces import IHarvester
 from ckanext.harvest.model import HarvestObject
 
 from ckanext.spatial.model import GeminiDocument
-from ckanext.spatial.lib.csw_client import CswService
+from ckanext.spatial.lib.csw_client import get_csw_service, paging_options
 
 from ckanext.spatial.harvesters.base import SpatialHarvester, text_traceback
 
@@ -284,6 +284,15 @@ class GeminiHarvester(SpatialHarvester):
 
         resource_locators = gemini_values.get('resource-locator', [])
 
+        # Check if the services are view services, all at once
+        verified_wms = {}
+        if extras['resource-type'] == 'service':
+            wms_urls = [resource_locator.get('url').split('?')[0]
+                        for resource_locator in resource_locators
+                        if resource_locator.get('url')]
+            if wms_urls:
+                verified_wms = self._verify_wms(wms_urls)
+
         if len(resource_locators):
             for resource_locator in resource_locators:
                 url = resource_locator.get('url','')
@@ -293,7 +302,7 @@ class GeminiHarvester(SpatialHarvester):
                     if extras['resource-type'] == 'service':
                         # Check if the service is a view service
                         test_url = url.split('?')[0] if '?' in url else url
-                        if self._is_wms(test_url):
+                        if verified_wms.get(test_url):
                             resource['verified'] = True
                             resource['verified_date'] = datetime.now().isoformat()
                             resource_format = 'WMS'
@@ -549,7 +558,7 @@ class GeminiCswHarvester(GeminiHarvester, SingletonPlugin):
         used_identifiers = []
         ids = []
         try:
-            for identifier in self.csw.getidentifiers(page=10):
+            for identifier in self.csw.getidentifiers(**paging_options()):
                 try:
                     log.info('Got identifier %s from the CSW', identifier)
                     if identifier in used_identifiers:
@@ -618,7 +627,7 @@ class GeminiCswHarvester(GeminiHarvester, SingletonPlugin):
         return True
 
     def _setup_csw_client(self, url):
-        self.csw = CswService(url)
+        self.csw = get_csw_service(url)
 
 
 class GeminiDocHarvester(GeminiHarvester, SingletonPlugin):
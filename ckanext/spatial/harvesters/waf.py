@@ -1,12 +1,10 @@
-from __future__ import print_function
-
+import re
 import six
 from six.moves.urllib.parse import urljoin
 import logging
 import hashlib
 
 import dateutil.parser
-import pyparsing as parse
 import requests
 from sqlalchemy.orm import aliased
 from sqlalchemy.exc import DataError
@@ -20,7 +18,8 @@ from ckanext.harvest.model import HarvestObject
 from ckanext.harvest.model import HarvestObjectExtra as HOExtra
 import ckanext.harvest.queue as queue
 
-from ckanext.spatial.harvesters.base import SpatialHarvester, guess_standard
+from ckanext.spatial.harvesters.base import SpatialHarvester, guess_standard, log_http_stats
+from ckanext.spatial.lib.waf_crawler import WafCrawler
 
 log = logging.getLogger(__name__)
 
@@ -50,6 +49,7 @@ class WAFHarvester(SpatialHarvester, SingletonPlugin):
         return url[0] if url else None
 
 
+    @log_http_stats('gather')
     def gather_stage(self,harvest_job,collection_package_id=None):
         log = logging.getLogger(__name__ + '.WAF.gather')
         log.debug('WafHarvester gather_stage for job: %r', harvest_job)
@@ -61,9 +61,11 @@ class WAFHarvester(SpatialHarvester, SingletonPlugin):
 
         self._set_source_config(harvest_job.source.config)
 
+        crawler = WafCrawler(None, rate_limit=self.source_config.get('rate_limit'))
+
         # Get contents
         try:
-            response = requests.get(source_url, timeout=60)
+            response = crawler.fetch(source_url)
             response.raise_for_status()
         except requests.exceptions.RequestException as e:
             self._save_gather_error('Unable to get content for URL: %s: %r' % \
@@ -98,7 +100,7 @@ class WAFHarvester(SpatialHarvester, SingletonPlugin):
 
         url_to_modified_harvest = {} ## mapping of url to last_modified in harvest
         try:
-            for url, modified_date in _extract_waf(content,source_url,scraper):
+            for url, modified_date in _extract_waf(content, source_url, scraper, crawler):
                 url_to_modified_harvest[url] = modified_date
         except Exception as e:
             msg = 'Error extracting URLs from %s, error was %s' % (source_url, e)
@@ -196,14 +198,28 @@ class WAFHarvester(SpatialHarvester, SingletonPlugin):
                     harvest_object)
             return False
 
+        # Only request the document if it was modified since the previous
+        # harvest, when the server supports it
+        previous_object = None
+        if status == 'change':
+            previous_object = self._get_previous_object(harvest_object.guid)
+
         # Get contents
         try:
-            content = self._get_content_as_unicode(url)
+            content, validators = self._get_remote_content(url, previous_object)
         except Exception as e:
             msg = 'Could not harvest WAF link {0}: {1}'.format(url, e)
             self._save_object_error(msg, harvest_object)
             return False
 
+        if content is None:
+            log.debug('WAF link {0} not modified'.format(url))
+            self._reuse_previous_content(harvest_object, previous_object, validators)
+            harvest_object.save()
+            return True
+
+        self._set_object_extras(harvest_object, validators)
+
         # Check if it is an ISO document
         document_format = guess_standard(content)
         if document_format == 'iso':
@@ -225,35 +241,52 @@ class WAFHarvester(SpatialHarvester, SingletonPlugin):
         return True
 
 
-apache  = parse.SkipTo(parse.CaselessLiteral("<a href="), include=True).suppress() \
-        + parse.quotedString.setParseAction(parse.removeQuotes).setResultsName('url') \
-        + parse.SkipTo("</a>", include=True).suppress() \
-        + parse.Optional(parse.Literal('</td><td align="right">')).suppress() \
-        + parse.Optional(parse.Combine(
-            parse.Word(parse.alphanums+'-') +
-            parse.Word(parse.alphanums+':')
-        ,adjacent=False, joinString=' ').setResultsName('date')
-        )
-
-iis =      parse.SkipTo("<br>").suppress() \
-         + parse.OneOrMore("<br>").suppress() \
-         + parse.Optional(parse.Combine(
-           parse.Word(parse.alphanums+'/') +
-           parse.Word(parse.alphanums+':') +
-           parse.Word(parse.alphas)
-         , adjacent=False, joinString=' ').setResultsName('date')
-         ) \
-         + parse.Word(parse.nums).suppress() \
-         + parse.Literal('<A HREF=').suppress() \
-         + parse.quotedString.setParseAction(parse.removeQuotes).setResultsName('url')
-
-other = parse.SkipTo(parse.CaselessLiteral("<a href="), include=True).suppress() \
-        + parse.quotedString.setParseAction(parse.removeQuotes).setResultsName('url')
-
-
-scrapers = {'apache': parse.OneOrMore(parse.Group(apache)),
-            'other': parse.OneOrMore(parse.Group(other)),
-            'iis': parse.OneOrMore(parse.Group(iis))}
+# Regular expressions matching the links (and the modification dates, if
+# available) of the directory listings of each server type
+
+_href = r'''<a\s+href\s*=\s*(?:"(?P<url>[^"]*)"|'(?P<url_single>[^']*)')'''
+
+listings = {
+    # <a href="file.xml">file.xml</a></td><td align="right">2013-03-12 10:21
+    # or <a href="file.xml">file.xml</a>   12-Mar-2013 10:21
+    'apache': re.compile(
+        _href + r'''.*?</a>(?:\s*</td><td align="right">)?'''
+        r'''(?:\s*(?P<date>[A-Za-z0-9-]+\s+[A-Za-z0-9:]+))?''',
+        re.IGNORECASE | re.DOTALL),
+    # <br>3/12/2013 10:21 AM   1234 <A HREF="/waf/file.xml">file.xml</A>
+    'iis': re.compile(
+        r'''<br>(?:\s*<br>)*\s*'''
+        r'''(?:(?P<date>[A-Za-z0-9/]+\s+[A-Za-z0-9:]+\s+[A-Za-z]+)\s+)?'''
+        r'''[0-9]+\s*''' + _href,
+        re.IGNORECASE),
+    'other': re.compile(_href, re.IGNORECASE),
+}
+
+
+def _parse_listing(content, scraper):
+    '''
+    Returns a list of (url, date) tuples with the links of a directory
+    listing page and their modification dates (None if not available),
+    using the listing format of the `scraper` server type. If no links are
+    found, the page is parsed as a generic listing.
+    '''
+    if isinstance(content, bytes):
+        content = content.decode('utf-8', 'replace')
+
+    records = []
+    for regex in (listings[scraper], listings['other']):
+        for match in regex.finditer(content):
+            groups = match.groupdict()
+            url = groups['url'] if groups['url'] is not None else groups['url_single']
+            date = groups.get('date')
+            if date:
+                date = ' '.join(date.split())
+            records.append((url, date))
+        if records:
+            break
+
+    return records
+
 
 def _get_scraper(server):
     if not server or 'apache' in server.lower():
@@ -263,9 +296,26 @@ def _get_scraper(server):
     else:
         return 'other'
 
-def _extract_waf(content, base_url, scraper, results = None, depth=0):
-    if results is None:
-        results = []
+def _extract_waf(content, base_url, scraper, crawler=None):
+    '''
+    Returns the list of (url, modified_date) tuples of the documents in the
+    WAF, given the content and URL of its index page. The subdirectories
+    are requested with `crawler`, a `WafCrawler` instance.
+    '''
+    if crawler is None:
+        crawler = WafCrawler(None)
+    crawler.parse = lambda content, url: _parse_waf(content, url, scraper)
+    return crawler.crawl(content, base_url)
+
+
+def _parse_waf(content, base_url, scraper):
+    '''
+    Parses a WAF index page, returning a tuple with the list of
+    subdirectory URLs and the list of (url, modified_date) tuples of the
+    documents in the page.
+    '''
+    directories = []
+    results = []
 
     base_url = base_url.rstrip('/').split('/')
     if 'index' in base_url[-1]:
@@ -273,13 +323,7 @@ def _extract_waf(content, base_url, scraper, results = None, depth=0):
     base_url = '/'.join(base_url)
     base_url += '/'
 
-    try:
-        parsed = scrapers[scraper].parseString(content)
-    except parse.ParseException:
-        parsed = scrapers['other'].parseString(content)
-
-    for record in parsed:
-        url = record.url
+    for url, date in _parse_listing(content, scraper):
         if not url:
             continue
         if url.startswith('_'):
@@ -291,31 +335,19 @@ def _extract_waf(content, base_url, scraper, results = None, depth=0):
         if 'mailto:' in url:
             continue
         if '..' not in url and url[0] != '/' and url[-1] == '/':
-            new_depth = depth + 1
-            if depth > 10:
-                log.info('Max WAF depth reached')
-                continue
             new_url = urljoin(base_url, url)
             if not new_url.startswith(base_url):
                 continue
-            log.debug('WAF new_url: %s', new_url)
-            try:
-                response = requests.get(new_url)
-                content = response.content
-            except Exception as e:
-                print(six.text_type(e))
-                continue
-            _extract_waf(content, new_url, scraper, results, new_depth)
+            directories.append(new_url)
             continue
         if not url.endswith('.xml'):
             continue
-        date = record.date
         if date:
             try:
                 date = six.text_type(dateutil.parser.parse(date))
             except Exception as e:
                 raise
                 date = None
-        results.append((urljoin(base_url, record.url), date))
+        results.append((urljoin(base_url, url), date))
 
-    return results
+    return directories, results
@@ -89,3 +89,85 @@ class ISpatialHarvester(Interface):
         '''
         return None
 
+
+
+class ISpatialSearchBackend(Interface):
+    '''
+    Provides a spatial search backend for the `spatial_query` plugin
+
+    The backend is selected by setting the `ckanext.spatial.search_backend`
+    configuration option to the value returned by ``name``. Plugins can
+    extend ``ckanext.spatial.search_backends.SpatialSearchBackend`` or, for
+    backends that return the ids of the matching datasets,
+    ``ckanext.spatial.search_backends.IdsSearchBackend``, which only
+    requires the ``ids`` and ``rank`` methods to be implemented.
+
+    All bounding boxes are dicts with the ``minx``, ``miny``, ``maxx`` and
+    ``maxy`` keys, in the database projection.
+    '''
+
+    def name(self):
+        '''
+        Returns the name used to select this backend (eg ``postgis``)
+
+        :rtype: string
+        '''
+
+    def index(self, pkg_dict):
+        '''
+        Called when indexing a dataset with a ``spatial`` extra, allows to
+        add the fields needed by the backend to the Solr document
+
+        :param pkg_dict: The dict that will be indexed. The GeoJSON geometry
+            is available in the ``extras_spatial`` key.
+        :type pkg_dict: dict
+
+        :returns: The modified dict
+        :rtype: dict
+        '''
+        return pkg_dict
+
+    def query(self, bbox, search_params):
+        '''
+        Restricts a dataset search to the datasets intersecting the bbox
+
+        :param bbox: The bounding box provided in the ``ext_bbox`` parameter
+        :type bbox: dict
+        :param search_params: The search parameters, as passed to the
+            ``before_search`` method of ``IPackageController``
+        :type search_params: dict
+
+        :returns: The modified search parameters
+        :rtype: dict
+        '''
+        return search_params
+
+    def rank(self, bbox, limit=None, offset=0):
+        '''
+        Returns the datasets intersecting the bbox ordered by how well their
+        extent matches it
+
+        Backends that don't support ranking should raise
+        ``NotImplementedError``.
+
+        :param bbox: The bounding box to rank the datasets against
+        :type bbox: dict
+        :param limit: Maximum number of results to return
+        :type limit: int
+        :param offset: Number of results to skip
+        :type offset: int
+
+        :returns: A list of ``(package_id, spatial_ranking)`` tuples, best
+            match first
+        :rtype: list
+        '''
+
+    def count(self, bbox):
+        '''
+        Returns the number of datasets intersecting the bbox
+
+        :param bbox: The bounding box
+        :type bbox: dict
+
+        :rtype: int
+        '''
@@ -1,7 +1,10 @@
 import six
+import hashlib
 import logging
 from string import Template
 
+from sqlalchemy import func
+
 from ckan.model import Session, Package
 import ckantoolkit as tk
 
@@ -12,6 +15,7 @@ from shapely.geometry import asShape
 from ckanext.spatial.geoalchemy_common import (WKTElement, ST_Transform,
                                                compare_geometry_fields,
                                                )
+from ckanext.spatial.lib.cache import invalidate_on_commit
 config = tk.config
 
 log = logging.getLogger(__name__)
@@ -49,38 +53,83 @@ def save_package_extent(package_id, geometry = None, srid = None):
     '''
     db_srid = int(config.get('ckan.spatial.srid', '4326'))
 
+    # Only the fingerprint of the existing extent is loaded, which is
+    # enough to know if it changed without comparing the geometries
+    existing = Session.query(PackageExtent.fingerprint) \
+        .filter(PackageExtent.package_id==package_id).first()
 
-    existing_package_extent = Session.query(PackageExtent).filter(PackageExtent.package_id==package_id).first()
-
-    if geometry:
-        shape = asShape(geometry)
+    if not geometry:
+        # If extent exists but we received no geometry, we'll delete the existing one
+        if existing:
+            Session.query(PackageExtent) \
+                .filter(PackageExtent.package_id==package_id).delete()
+            invalidate_on_commit()
+            log.debug('Deleted extent for package %s' % package_id)
+        return
 
-        if not srid:
-            srid = db_srid
+    shape = asShape(geometry)
 
-        package_extent = PackageExtent(package_id=package_id,
-                                       the_geom=WKTElement(shape.wkt, srid))
+    if not srid:
+        srid = db_srid
 
-    # Check if extent exists
-    if existing_package_extent:
+    values = _extent_values(shape, srid)
 
-        # If extent exists but we received no geometry, we'll delete the existing one
-        if not geometry:
-            existing_package_extent.delete()
-            log.debug('Deleted extent for package %s' % package_id)
-        else:
-            # Check if extent changed
-            if not compare_geometry_fields(package_extent.the_geom, existing_package_extent.the_geom):
-                # Update extent
-                existing_package_extent.the_geom = package_extent.the_geom
-                existing_package_extent.save()
-                log.debug('Updated extent for package %s' % package_id)
-            else:
-                log.debug('Extent for package %s unchanged' % package_id)
-    elif geometry:
+    if not existing:
         # Insert extent
-        Session.add(package_extent)
+        Session.add(PackageExtent(package_id=package_id, **values))
+        invalidate_on_commit()
         log.debug('Created new extent for package %s' % package_id)
+        return
+
+    if existing.fingerprint == values['fingerprint']:
+        log.debug('Extent for package %s unchanged' % package_id)
+        return
+
+    existing_package_extent = Session.query(PackageExtent) \
+        .filter(PackageExtent.package_id==package_id).first()
+
+    if existing.fingerprint is None and existing_package_extent.area is not None \
+       and compare_geometry_fields(values['the_geom'], existing_package_extent.the_geom):
+        # Extent created before fingerprints were stored, just record it
+        existing_package_extent.fingerprint = values['fingerprint']
+        existing_package_extent.save()
+        log.debug('Extent for package %s unchanged' % package_id)
+        return
+
+    # Update extent
+    for key, value in values.items():
+        setattr(existing_package_extent, key, value)
+    existing_package_extent.save()
+    invalidate_on_commit()
+    log.debug('Updated extent for package %s' % package_id)
+
+def extent_fingerprint(shape, srid):
+    '''
+    Returns a hash identifying a Shapely geometry in a particular srid,
+    computed from its normalized WKB. Used to know if an extent changed
+    without comparing the geometries in the database.
+    '''
+    if hasattr(shape, 'normalize'):
+        shape = shape.normalize()
+    return hashlib.sha1(
+        six.ensure_binary('%s:' % srid) + shape.wkb).hexdigest()
+
+def _extent_values(shape, srid):
+    '''
+    Returns the values of the PackageExtent columns for a Shapely geometry:
+    the geometry itself, its precomputed bounds and area and its
+    fingerprint.
+    '''
+    minx, miny, maxx, maxy = shape.bounds
+    return {
+        'the_geom': WKTElement(shape.wkt, srid),
+        'minx': minx,
+        'miny': miny,
+        'maxx': maxx,
+        'maxy': maxy,
+        'area': shape.area,
+        'fingerprint': extent_fingerprint(shape, srid),
+    }
 
 def validate_bbox(bbox_values):
     '''
@@ -157,15 +206,62 @@ def bbox_query(bbox,srid=None):
               .filter(Package.state==u'active')
     return extents
 
-def bbox_query_ordered(bbox, srid=None):
+def bbox_query_ids(bbox, srid=None, batch_size=1000):
+    '''
+    Performs a spatial query of a bounding box, selecting only the ids of
+    the matching packages.
+
+    bbox - bounding box dict
+
+    Unlike `bbox_query`, no PackageExtent objects (or geometries) are
+    loaded. The query is run once when the result is first iterated and the
+    ids are streamed from the database in batches of `batch_size`.
+
+    Returns a generator of package ids.
+    '''
+
+    input_geometry = _bbox_2_wkt(bbox, srid)
+
+    query = Session.query(PackageExtent.package_id) \
+        .filter(PackageExtent.package_id==Package.id) \
+        .filter(PackageExtent.the_geom.intersects(input_geometry)) \
+        .filter(Package.state==u'active')
+
+    for row in query.yield_per(batch_size):
+        yield row[0]
+
+def bbox_count(bbox, srid=None):
+    '''
+    Returns the number of active packages with an extent intersecting the
+    bounding box, without loading any of them.
+
+    bbox - bounding box dict
+    '''
+
+    input_geometry = _bbox_2_wkt(bbox, srid)
+
+    return Session.query(func.count(PackageExtent.package_id)) \
+        .filter(PackageExtent.package_id==Package.id) \
+        .filter(PackageExtent.the_geom.intersects(input_geometry)) \
+        .filter(Package.state==u'active') \
+        .scalar()
+
+def bbox_query_ordered(bbox, srid=None, limit=None, offset=0, exact=False):
     '''
     Performs a spatial query of a bounding box. Returns packages in order
     of how similar the data\'s bounding box is to the search box (best first).
 
     bbox - bounding box dict
+    limit - maximum number of results to return (all if None)
+    offset - number of results to skip
+    exact - if True the ranking is computed with the actual extent
+            geometries, which is expensive for detailed polygons. By default
+            the precomputed envelope of the extents is used instead.
 
-    Returns a query object of PackageExtents, which each reference a package
-    by ID.
+    The paging is done in the database, so only the requested page is
+    transferred. Use `bbox_count` to get the total number of results.
+
+    Returns a list of rows with package_id and spatial_ranking values.
     '''
 
     input_geometry = _bbox_2_wkt(bbox, srid)
@@ -173,19 +269,32 @@ def bbox_query_ordered(bbox, srid=None):
     params = {'query_bbox': six.text_type(input_geometry),
               'query_srid': input_geometry.srid}
 
-    # First get the area of the query box
-    sql = "SELECT ST_Area(ST_GeomFromText(:query_bbox, :query_srid));"
-    params['search_area'] = Session.execute(sql, params).fetchone()[0]
-
-    # Uses spatial ranking method from "USGS - 2006-1279" (Lanfear)
-    sql = """SELECT ST_AsBinary(package_extent.the_geom) AS package_extent_the_geom,
-                    POWER(ST_Area(ST_Intersection(package_extent.the_geom, ST_GeomFromText(:query_bbox, :query_srid))),2)/ST_Area(package_extent.the_geom)/:search_area as spatial_ranking,
-                    package_extent.package_id AS package_id
-             FROM package_extent, package
+    # Uses spatial ranking method from "USGS - 2006-1279" (Lanfear):
+    # intersection area squared / extent area / query area
+    if exact:
+        select = """ST_AsBinary(package_extent.the_geom) AS package_extent_the_geom,
+                    COALESCE(POWER(ST_Area(ST_Intersection(package_extent.the_geom, query.geom)),2)
+                             / NULLIF(COALESCE(package_extent.area, ST_Area(package_extent.the_geom)), 0)
+                             / NULLIF(ST_Area(query.geom), 0), 0) AS spatial_ranking"""
+    else:
+        select = """COALESCE(POWER(GREATEST(0, LEAST(package_extent.maxx, ST_XMax(query.geom)) - GREATEST(package_extent.minx, ST_XMin(query.geom)))
+                                   * GREATEST(0, LEAST(package_extent.maxy, ST_YMax(query.geom)) - GREATEST(package_extent.miny, ST_YMin(query.geom))), 2)
+                             / NULLIF((package_extent.maxx - package_extent.minx) * (package_extent.maxy - package_extent.miny), 0)
+                             / NULLIF(ST_Area(query.geom), 0), 0) AS spatial_ranking"""
+
+    sql = """SELECT package_extent.package_id AS package_id,
+                    {select}
+             FROM package_extent, package,
+                  (SELECT ST_GeomFromText(:query_bbox, :query_srid) AS geom) AS query
              WHERE package_extent.package_id = package.id
-                AND ST_Intersects(package_extent.the_geom, ST_GeomFromText(:query_bbox, :query_srid))
+                AND ST_Intersects(package_extent.the_geom, query.geom)
                 AND package.state = 'active'
-             ORDER BY spatial_ranking desc"""
+             ORDER BY spatial_ranking desc, package_extent.package_id""".format(select=select)
+    if limit is not None:
+        sql += """
+             LIMIT :limit OFFSET :offset"""
+        params['limit'] = int(limit)
+        params['offset'] = int(offset or 0)
     extents = Session.execute(sql, params).fetchall()
     log.debug('Spatial results: %r',
               [('%.2f' % extent.spatial_ranking, extent.package_id) for extent in extents[:20]])
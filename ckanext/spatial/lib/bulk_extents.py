@@ -0,0 +1,237 @@
+'''
+Bulk rebuild of the `package_extent` table from the `spatial` extras
+
+Unlike `save_package_extent`, which is called for each dataset as it is
+saved, this is meant to regenerate the extents of all datasets at once (eg
+after enabling the extension on an existing site):
+
+* The extras are streamed from the database with a server-side cursor, in
+  chunks of `chunk_size` rows.
+* The GeoJSON of each chunk is parsed in a pool of worker processes.
+* The parsed geometries are loaded into a temporary staging table, and
+  applied to `package_extent` with set-based upserts and deletes.
+* Each chunk is committed on its own, so progress is kept if the process
+  is interrupted and no long running transaction is held.
+'''
+from __future__ import print_function
+
+import time
+import logging
+import multiprocessing
+
+import six
+
+from sqlalchemy import text
+
+import ckantoolkit as tk
+from ckan.lib.helpers import json
+from ckan.model import meta
+
+config = tk.config
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 1000
+
+
+def _parse_extent(row):
+    '''
+    Parses the value of a spatial extra, given a (package_id, value, srid)
+    tuple. Runs in the worker processes.
+
+    Returns a tuple with the package id, a dict with the staging table
+    values (None if the extent should be deleted) and an error message (None
+    if there were no errors).
+    '''
+    from shapely.geometry import asShape
+    from ckanext.spatial.lib import extent_fingerprint
+
+    package_id, value, srid = row
+    if not value:
+        return package_id, None, None
+
+    try:
+        shape = asShape(json.loads(value))
+        minx, miny, maxx, maxy = shape.bounds
+        values = {
+            'package_id': package_id,
+            'geom': shape.wkb_hex,
+            'minx': minx,
+            'miny': miny,
+            'maxx': maxx,
+            'maxy': maxy,
+            'area': shape.area,
+            'fingerprint': extent_fingerprint(shape, srid),
+        }
+    except Exception as e:
+        # Report any problem with a geometry without stopping the rebuild
+        return package_id, None, u'Error creating geometry: %s' % six.text_type(e)
+
+    return package_id, values, None
+
+
+class BulkExtentsRebuild(object):
+    '''
+    Regenerates the extents of all the datasets with a `spatial` extra.
+
+    workers - number of worker processes used to parse the GeoJSON (defaults
+              to the number of CPUs). If 1, no worker processes are started.
+    chunk_size - number of datasets processed and committed at a time
+    progress - function called after each chunk with the number of extras
+               processed so far and the number of seconds elapsed
+    '''
+
+    def __init__(self, workers=None, chunk_size=DEFAULT_CHUNK_SIZE,
+                 progress=None):
+        self.workers = workers or multiprocessing.cpu_count()
+        self.chunk_size = int(chunk_size)
+        self.progress = progress
+        self.srid = int(config.get('ckan.spatial.srid', '4326'))
+
+        self.processed = 0
+        self.upserted = 0
+        self.deleted = 0
+        self.errors = []
+
+    def run(self):
+        # Start the workers before opening any database connection, so
+        # they are not inherited by the forked processes
+        pool = multiprocessing.Pool(self.workers) if self.workers > 1 else None
+
+        started = time.time()
+        read_conn = meta.engine.connect()
+        write_conn = meta.engine.connect()
+        try:
+            self._create_staging_table(write_conn)
+
+            result = read_conn.execution_options(stream_results=True).execute(text(
+                '''SELECT package_id, value FROM package_extra
+                   WHERE key = 'spatial' AND state = 'active' '''))
+            while True:
+                rows = result.fetchmany(self.chunk_size)
+                if not rows:
+                    break
+                rows = [(package_id, value, self.srid) for package_id, value in rows]
+                if pool:
+                    parsed = pool.map(
+                        _parse_extent, rows,
+                        chunksize=max(1, len(rows) // (self.workers * 4)))
+                else:
+                    parsed = [_parse_extent(row) for row in rows]
+
+                self._apply_chunk(write_conn, parsed)
+
+                self.processed += len(rows)
+                if self.progress:
+                    self.progress(self.processed, time.time() - started)
+
+            result.close()
+
+            self._delete_orphans(write_conn)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+            read_conn.close()
+            write_conn.close()
+
+        from ckanext.spatial.lib.cache import get_spatial_query_cache
+        get_spatial_query_cache().invalidate()
+
+        return self
+
+    def _create_staging_table(self, conn):
+        conn.execute(text(
+            '''CREATE TEMPORARY TABLE package_extent_staging (
+                   package_id text PRIMARY KEY,
+                   geom text,
+                   minx double precision,
+                   miny double precision,
+                   maxx double precision,
+                   maxy double precision,
+                   area double precision,
+                   fingerprint text
+               ) ON COMMIT DELETE ROWS'''))
+
+    def _apply_chunk(self, conn, parsed):
+        # Keyed by package id, as a package should only have one spatial
+        # extra but the upsert fails if it gets the same one twice
+        upserts = {}
+        deletes = {}
+        for package_id, values, error in parsed:
+            if error:
+                self.errors.append(u'Package %s - %s' % (package_id, error))
+            elif values is None:
+                upserts.pop(package_id, None)
+                deletes[package_id] = True
+            else:
+                deletes.pop(package_id, None)
+                upserts[package_id] = values
+        upserts = list(upserts.values())
+        deletes = list(deletes.keys())
+
+        trans = conn.begin()
+        try:
+            if upserts:
+                conn.execute(text(
+                    '''INSERT INTO package_extent_staging
+                       (package_id, geom, minx, miny, maxx, maxy, area,
+                        fingerprint)
+                       VALUES (:package_id, :geom, :minx, :miny, :maxx, :maxy,
+                               :area, :fingerprint)'''), upserts)
+                result = conn.execute(text(
+                    '''INSERT INTO package_extent
+                       (package_id, the_geom, minx, miny, maxx, maxy, area,
+                        fingerprint)
+                       SELECT package_id,
+                              ST_GeomFromWKB(decode(geom, 'hex'), :srid),
+                              minx, miny, maxx, maxy, area, fingerprint
+                       FROM package_extent_staging
+                       ON CONFLICT (package_id) DO UPDATE SET
+                           the_geom = EXCLUDED.the_geom,
+                           minx = EXCLUDED.minx,
+                           miny = EXCLUDED.miny,
+                           maxx = EXCLUDED.maxx,
+                           maxy = EXCLUDED.maxy,
+                           area = EXCLUDED.area,
+                           fingerprint = EXCLUDED.fingerprint
+                       WHERE package_extent.fingerprint IS DISTINCT FROM EXCLUDED.fingerprint'''),
+                    srid=self.srid)
+                self.upserted += result.rowcount
+            if deletes:
+                result = conn.execute(text(
+                    'DELETE FROM package_extent WHERE package_id = ANY(:package_ids)'),
+                    package_ids=deletes)
+                self.deleted += result.rowcount
+            trans.commit()
+        except:
+            trans.rollback()
+            raise
+
+    def _delete_orphans(self, conn):
+        '''
+        Deletes the extents of datasets that no longer have a spatial extra
+        '''
+        trans = conn.begin()
+        try:
+            result = conn.execute(text(
+                '''DELETE FROM package_extent
+                   WHERE NOT EXISTS (
+                       SELECT 1 FROM package_extra
+                       WHERE package_extra.package_id = package_extent.package_id
+                           AND package_extra.key = 'spatial'
+                           AND package_extra.state = 'active')'''))
+            self.deleted += result.rowcount
+            trans.commit()
+        except:
+            trans.rollback()
+            raise
+
+
+def rebuild_extents(workers=None, chunk_size=DEFAULT_CHUNK_SIZE, progress=None):
+    '''
+    Regenerates the extents of all the datasets with a `spatial` extra.
+    See `BulkExtentsRebuild`.
+    '''
+    return BulkExtentsRebuild(workers=workers, chunk_size=chunk_size,
+                              progress=progress).run()
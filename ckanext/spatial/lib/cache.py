@@ -0,0 +1,325 @@
+'''
+Small in-process caches used to avoid repeating expensive lookups
+'''
+import time
+import json
+import logging
+import threading
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+
+class TTLCache(object):
+    '''
+    A thread-safe Least Recently Used cache whose entries expire after a
+    number of seconds.
+
+    max_size - maximum number of entries kept (the least recently used ones
+               are evicted first)
+    ttl - number of seconds after which an entry is considered stale. If
+          0 or None entries never expire.
+    '''
+
+    def __init__(self, max_size=1000, ttl=60):
+        self.max_size = int(max_size)
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._data.pop(key)
+            except KeyError:
+                return default
+            if expires and expires < time.time():
+                return default
+            # Re-insert to flag it as the most recently used
+            self._data[key] = (expires, value)
+            return value
+
+    def set(self, key, value):
+        expires = time.time() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (expires, value)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        return self.get(key, _missing) is not _missing
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+
+_missing = object()
+
+
+class MemoryCacheBackend(object):
+    '''
+    Stores the cached values in the memory of the current process.
+
+    Note that each process (eg each web server worker) keeps its own copy of
+    the cache and generation counter, so changes made by other processes
+    are only picked up when the entries expire. It should only be used when
+    a single process serves the site and writes the extents.
+    '''
+
+    def __init__(self, max_size=1000, ttl=300):
+        self._cache = TTLCache(max_size=max_size, ttl=ttl)
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        return self._cache.get(key)
+
+    def set(self, key, value):
+        self._cache.set(key, value)
+
+    def get_counter(self, key):
+        return self._counters.get(key, 0)
+
+    def incr(self, key):
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            value = self._counters[key]
+        # Entries from previous generations can not be reached anymore
+        self._cache.clear()
+        return value
+
+
+class RedisCacheBackend(object):
+    '''
+    Stores the cached values in Redis (or any server implementing its
+    protocol), so they are shared by all processes.
+
+    Values are serialized as JSON and expire after `ttl` seconds. Eviction
+    of least recently used keys when memory is full is handled by the
+    server `maxmemory-policy` setting.
+    '''
+
+    def __init__(self, url=None, ttl=300, connection=None):
+        if connection is None:
+            import redis
+            connection = redis.StrictRedis.from_url(url or 'redis://localhost:6379/0')
+        self._redis = connection
+        self.ttl = int(ttl)
+
+    def get(self, key):
+        value = self._redis.get(key)
+        if value is None:
+            return None
+        return json.loads(value)
+
+    def set(self, key, value):
+        value = json.dumps(value)
+        if self.ttl:
+            self._redis.setex(key, self.ttl, value)
+        else:
+            self._redis.set(key, value)
+
+    def get_counter(self, key):
+        return int(self._redis.get(key) or 0)
+
+    def incr(self, key):
+        return self._redis.incr(key)
+
+
+class NullCacheBackend(object):
+    '''
+    Does not store anything, used when the cache is disabled
+    '''
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def get_counter(self, key):
+        return 0
+
+    def incr(self, key):
+        return 0
+
+
+class SpatialQueryCache(object):
+    '''
+    Caches the results of spatial queries, keyed by the normalized bounding
+    box, the srid of the bbox and a query mode (eg 'ids' or a results page of
+    a ranked query).
+
+    All keys include a generation number, which is incremented each time
+    a package extent is changed with `invalidate`, so results computed
+    before the change are never returned afterwards.
+
+    backend - object implementing the get, set, get_counter and incr methods
+    precision - if set, the bbox coordinates are rounded to this number of
+                decimal places, so bboxes that only differ slightly share the
+                same cached results. The queries should be run with the
+                normalized bbox returned by `normalize_bbox`.
+    '''
+
+    prefix = 'ckanext-spatial:query'
+
+    def __init__(self, backend, precision=None):
+        self.backend = backend
+        self.precision = precision
+
+    @property
+    def enabled(self):
+        return not isinstance(self.backend, NullCacheBackend)
+
+    def normalize_bbox(self, bbox):
+        keys = ('minx', 'miny', 'maxx', 'maxy')
+        if self.precision is None:
+            return dict((k, float(bbox[k])) for k in keys)
+        return dict((k, round(float(bbox[k]), self.precision)) for k in keys)
+
+    def key(self, bbox, srid, mode):
+        bbox = self.normalize_bbox(bbox)
+        return '{prefix}:{generation}:{mode}:{srid}:{minx!r},{miny!r},{maxx!r},{maxy!r}'.format(
+            prefix=self.prefix,
+            generation=self.backend.get_counter(self.prefix + ':generation'),
+            mode=mode,
+            srid=srid or '',
+            **bbox)
+
+    def get_or_run(self, bbox, srid, mode, func):
+        '''
+        Returns the cached value for the provided bbox, srid and mode,
+        calling `func` (with no arguments) to compute and store it if not
+        present.
+        '''
+        if not self.enabled:
+            return func()
+
+        key = self.key(bbox, srid, mode)
+        value = self.backend.get(key)
+        if value is None:
+            value = func()
+            self.backend.set(key, value)
+        return value
+
+    def invalidate(self):
+        return self.backend.incr(self.prefix + ':generation')
+
+
+_query_cache = None
+
+_INVALIDATE_KEY = 'ckanext-spatial:invalidate_query_cache'
+
+_listening = False
+
+
+def _in_savepoint(session):
+    if hasattr(session, 'in_nested_transaction'):
+        return session.in_nested_transaction()
+    return session.transaction is not None and session.transaction.nested
+
+
+def _after_commit(session):
+    if _INVALIDATE_KEY not in session.info or _in_savepoint(session):
+        return
+    session.info.pop(_INVALIDATE_KEY, None)
+    get_spatial_query_cache().invalidate()
+
+
+def invalidate_on_commit(session=None):
+    '''
+    Invalidates the spatial query cache once the current transaction of the
+    session (by default the CKAN one) is committed.
+
+    Invalidating it before the changes are committed would allow other
+    processes to compute and cache the results of the queries with the old
+    extents under the new generation.
+    '''
+    global _listening
+
+    if session is None:
+        from ckan import model
+        session = model.Session()
+
+    if not _listening:
+        from sqlalchemy import event
+        from sqlalchemy.orm import Session
+        event.listen(Session, 'after_commit', _after_commit)
+        _listening = True
+
+    session.info[_INVALIDATE_KEY] = True
+
+
+def _worker_processes():
+    '''
+    Returns the number of worker processes of the web server, if known
+    '''
+    try:
+        import uwsgi
+        return uwsgi.numproc
+    except (ImportError, AttributeError):
+        return None
+
+
+def get_spatial_query_cache():
+    '''
+    Returns the spatial query cache configured for this process.
+
+    The backend is set with the `ckanext.spatial.query_cache.backend` option,
+    which can be `memory`, `redis` or the path to a custom backend class in
+    the form `module:Class`. By default the cache is disabled.
+    '''
+    global _query_cache
+
+    if _query_cache is None:
+        from ckantoolkit import config
+
+        backend = config.get('ckanext.spatial.query_cache.backend')
+        ttl = int(config.get('ckanext.spatial.query_cache.ttl', 300))
+        precision = config.get('ckanext.spatial.query_cache.precision')
+        precision = int(precision) if precision not in (None, '') else None
+
+        if not backend:
+            backend = NullCacheBackend()
+        elif backend == 'memory':
+            workers = _worker_processes()
+            if workers and workers > 1:
+                raise ValueError(
+                    'The memory backend of the spatial query cache can not be '
+                    'used with {0} worker processes, as changes are not seen '
+                    'by the other processes. Use the redis backend '
+                    'instead'.format(workers))
+            log.warning(
+                'The memory backend of the spatial query cache only sees the '
+                'changes done by this process. Use the redis backend if the '
+                'site is served by several processes or the extents are '
+                'changed by other ones (eg harvesters)')
+            backend = MemoryCacheBackend(
+                max_size=int(config.get('ckanext.spatial.query_cache.max_size', 1000)),
+                ttl=ttl)
+        elif backend == 'redis':
+            backend = RedisCacheBackend(
+                url=config.get('ckanext.spatial.query_cache.redis_url',
+                               config.get('ckan.redis.url')),
+                ttl=ttl)
+        elif ':' in backend:
+            module_name, class_name = backend.split(':', 1)
+            module = __import__(module_name, fromlist=[class_name])
+            backend = getattr(module, class_name)(ttl=ttl)
+        else:
+            raise ValueError(
+                'Unknown value for ckanext.spatial.query_cache.backend: {0}'.format(backend))
+
+        _query_cache = SpatialQueryCache(backend, precision=precision)
+
+    return _query_cache
@@ -3,10 +3,15 @@ Some very thin wrapper classes around those in OWSLib
 for convenience.
 """
 import six
+import copy
+import time
 import logging
+import threading
+from collections import OrderedDict
 
 from owslib.etree import etree
-from owslib.fes import PropertyIsEqualTo, SortBy, SortProperty
+from owslib.fes import (
+    PropertyIsEqualTo, PropertyIsGreaterThanOrEqualTo, SortBy, SortProperty)
 
 log = logging.getLogger(__name__)
 
@@ -101,7 +106,68 @@ class CswService(OwsService):
 
     def getidentifiers(self, qtype=None, typenames="csw:Record", esn="brief",
                        keywords=[], limit=None, page=10, outputschema="gmd",
-                       startposition=0, cql=None, **kw):
+                       startposition=0, cql=None, max_page=None, workers=1,
+                       modified_since=None, progress=None, **kw):
+        for records in self._getrecords_pages(
+                qtype=qtype, typenames=typenames, esn=esn, limit=limit,
+                page=page, outputschema=outputschema,
+                startposition=startposition, cql=cql, max_page=max_page,
+                workers=workers, modified_since=modified_since,
+                progress=progress, **kw):
+            for ident in records.keys():
+                yield ident
+
+    def getrecordsfull(self, qtype=None, typenames="csw:Record", esn="full",
+                       keywords=[], limit=None, page=10, outputschema="gmd",
+                       startposition=0, cql=None, max_page=None, workers=1,
+                       modified_since=None, progress=None, **kw):
+        """
+        Pages through the catalog like `getidentifiers`, but requesting the
+        full records, so they don't need to be requested one by one with
+        `getrecordbyid`.
+
+        Yields (identifier, xml) tuples, where xml is the metadata document
+        serialized as a string, or None if it could not be obtained from the
+        response.
+        """
+        for records in self._getrecords_pages(
+                qtype=qtype, typenames=typenames, esn=esn, limit=limit,
+                page=page, outputschema=outputschema,
+                startposition=startposition, cql=cql, max_page=max_page,
+                workers=workers, modified_since=modified_since,
+                progress=progress, **kw):
+            for ident, record in records.items():
+                xml = getattr(record, "xml", None)
+                if isinstance(xml, bytes):
+                    xml = xml.decode("utf-8")
+                yield ident, xml
+
+    def _getrecords_pages(self, qtype=None, typenames="csw:Record", esn="brief",
+                          limit=None, page=10, outputschema="gmd",
+                          startposition=0, cql=None, max_page=None, workers=1,
+                          modified_since=None, progress=None, **kw):
+        """
+        Makes GetRecords requests until all the records matching the query
+        (or `limit` records) have been returned, yielding an ordered dict of
+        identifiers and records for each page. Records already returned in
+        a previous page are not returned again.
+
+        page - number of records requested on the first request
+        max_page - if larger than `page`, the page size is doubled after
+                   each request up to this value, until the server returns
+                   fewer records than requested or an error, in which case
+                   the largest page size accepted is kept
+        workers - once the page size is settled, the remaining pages are
+                  requested with up to this number of concurrent requests.
+                  Pages are still yielded in order.
+        modified_since - if provided (as an ISO 8601 string), only the
+                         records with an `apiso:Modified` date equal or
+                         later than it are requested
+        progress - function called once all the records of a page have been
+                   consumed, with the startposition of the next page. A
+                   later call with this startposition resumes the paging
+                   from there.
+        """
         from owslib.csw import namespaces
         constraints = []
         csw = self._ows(**kw)
@@ -109,6 +175,19 @@ class CswService(OwsService):
         if qtype is not None:
            constraints.append(PropertyIsEqualTo("dc:type", qtype))
 
+        if modified_since is not None:
+            if cql:
+                # OWSLib ignores the filter constraints if a CQL query is
+                # provided
+                cql = "(%s) AND apiso:Modified >= '%s'" % (cql, modified_since)
+            else:
+                constraints.append(
+                    PropertyIsGreaterThanOrEqualTo("apiso:Modified", modified_since))
+
+        if len(constraints) > 1:
+            # A nested list is combined with And rather than Or
+            constraints = [constraints]
+
         kwa = {
             "constraints": constraints,
             "typenames": typenames,
@@ -119,39 +198,110 @@ class CswService(OwsService):
             "cql": cql,
             "sortby": self.sortby
             }
-        i = 0
-        matches = 0
+
+        max_page = max(page, max_page or page)
+        accepted_page = None
+        seen = set()
+        remaining = [limit]
+
+        def new_records(records):
+            new = OrderedDict()
+            for ident, record in records.items():
+                if ident in seen:
+                    continue
+                if remaining[0] is not None:
+                    if remaining[0] <= 0:
+                        break
+                    remaining[0] -= 1
+                seen.add(ident)
+                new[ident] = record
+            return new
+
         while True:
-            log.info('Making CSW request: getrecords2 %r', kwa)
-
-            csw.getrecords2(**kwa)
-            if csw.exceptionreport:
-                err = 'Error getting identifiers: %r' % \
-                      csw.exceptionreport.exceptions
-                #log.error(err)
-                raise CswError(err)
-
-            if matches == 0:
-                matches = csw.results['matches']
-
-            identifiers = list(csw.records.keys())
-            if limit is not None:
-                identifiers = identifiers[:(limit-startposition)]
-            for ident in identifiers:
-                yield ident
+            kwa["startposition"] = startposition
+            kwa["maxrecords"] = page
+            try:
+                results, records = self._getrecords_page(csw, kwa)
+            except CswError:
+                if accepted_page is None or page <= accepted_page:
+                    raise
+                # The server does not accept pages this large
+                log.info('CSW request with %i records failed, using pages '
+                         'of %i records', page, accepted_page)
+                page = max_page = accepted_page
+                continue
 
-            if len(identifiers) == 0:
-                break
+            matches = results['matches']
+            returned = len(records)
+            accepted_page = max(accepted_page or 0, returned)
 
-            i += len(identifiers)
-            if limit is not None and i > limit:
-                break
+            yield new_records(records)
 
-            startposition += page
+            if returned == 0 or remaining[0] == 0:
+                return
+
+            # Servers not returning nextRecord are paged with the number of
+            # records actually returned, so none is skipped if the server
+            # returned less records than requested
+            nextrecord = results.get('nextrecord') or 0
+            if nextrecord > startposition:
+                startposition = nextrecord
+            else:
+                startposition += returned
+            if progress:
+                progress(startposition)
             if startposition >= (matches + 1):
+                return
+
+            if returned < page:
+                # The server returned less records than requested but there
+                # are more left, so this is the maximum it allows
+                page = max_page = returned
+            elif page < max_page:
+                page = min(page * 2, max_page)
+                continue
+
+            if workers > 1:
                 break
 
-            kwa["startposition"] = startposition
+        # The page size is settled, request the remaining windows
+        # concurrently, each one with its own copy of the OWSLib client as
+        # it keeps the state of the last request
+        from multiprocessing.pool import ThreadPool
+
+        windows = list(range(startposition, matches + 1, page))
+
+        def fetch(start):
+            window_kwa = dict(kwa, startposition=start, maxrecords=page)
+            return self._getrecords_page(copy.copy(csw), window_kwa)[1]
+
+        pool = ThreadPool(workers)
+        try:
+            # Only a few windows are requested ahead of the ones being
+            # consumed, to bound the number of records held in memory
+            batch_size = workers * 2
+            for i in range(0, len(windows), batch_size):
+                starts = windows[i:i + batch_size]
+                for start, records in six.moves.zip(starts, pool.imap(fetch, starts)):
+                    yield new_records(records)
+                    if remaining[0] == 0:
+                        return
+                    if progress:
+                        progress(min(start + page, matches + 1))
+        finally:
+            pool.terminate()
+
+    def _getrecords_page(self, csw, kwa):
+        log.info('Making CSW request: getrecords2 %r', kwa)
+
+        csw.getrecords2(**kwa)
+        if csw.exceptionreport:
+            err = 'Error getting identifiers: %r' % \
+                  csw.exceptionreport.exceptions
+            #log.error(err)
+            raise CswError(err)
+
+        return csw.results, OrderedDict(csw.records)
 
     def getrecordbyid(self, ids=[], esn="full", outputschema="gmd", **kw):
         from owslib.csw import namespaces
@@ -189,3 +339,86 @@ class CswService(OwsService):
         record["xml"] = '<?xml version="1.0" encoding="UTF-8"?>\n' + record["xml"]
         record["tree"] = mdtree
         return record
+
+
+# Default paging options of the harvesters, see `paging_options`
+DEFAULT_PAGE_SIZE = 10
+DEFAULT_MAX_PAGE_SIZE = 100
+DEFAULT_WORKERS = 1
+
+# Number of seconds the capabilities of a CSW server are reused for
+DEFAULT_CAPABILITIES_TTL = 3600
+
+_capabilities = {}
+_capabilities_lock = threading.Lock()
+
+
+def get_csw_service(endpoint, ttl=None):
+    """
+    Returns a new CswService for the provided endpoint.
+
+    Creating a CswService issues a GetCapabilities request, so the OWSLib
+    client holding the parsed capabilities of each endpoint is kept for
+    the process and each service returned gets its own copy of it, without
+    the records, results or request of any previous call. This halves the
+    number of requests made when fetching records one by one.
+    The capabilities are requested again after `ttl` seconds, by default
+    the value of the `ckanext.spatial.harvest.csw_capabilities_ttl` config
+    option.
+    """
+    if ttl is None:
+        from ckantoolkit import config
+        ttl = int(config.get('ckanext.spatial.harvest.csw_capabilities_ttl',
+                             DEFAULT_CAPABILITIES_TTL))
+
+    now = time.time()
+    with _capabilities_lock:
+        capabilities, created = _capabilities.get(endpoint, (None, None))
+    if capabilities is None or now - created >= ttl:
+        capabilities = CswService._Implementation(endpoint)
+        with _capabilities_lock:
+            _capabilities[endpoint] = (capabilities, now)
+
+    csw = copy.copy(capabilities)
+    csw.request = None
+    csw.response = None
+    csw.records = OrderedDict()
+    csw.results = {}
+    csw.exceptionreport = None
+    csw._exml = None
+
+    service = CswService()
+    service.__ows_obj__ = csw
+    return service
+
+
+def clear_csw_services():
+    """
+    Removes the capabilities kept for all the endpoints
+    """
+    with _capabilities_lock:
+        _capabilities.clear()
+
+
+def paging_options(source_config=None):
+    """
+    Returns the `page`, `max_page` and `workers` arguments for
+    `getidentifiers` and `getrecordsfull`, as defined in the `page_size`,
+    `max_page_size` and `workers` keys of a harvest source configuration,
+    or otherwise in the `ckanext.spatial.harvest.csw_page_size`,
+    `ckanext.spatial.harvest.csw_max_page_size` and
+    `ckanext.spatial.harvest.csw_workers` config options.
+    """
+    from ckantoolkit import config
+
+    source_config = source_config or {}
+
+    def option(key, default):
+        return int(source_config.get(
+            key, config.get('ckanext.spatial.harvest.csw_' + key, default)))
+
+    return {
+        'page': option('page_size', DEFAULT_PAGE_SIZE),
+        'max_page': option('max_page_size', DEFAULT_MAX_PAGE_SIZE),
+        'workers': option('workers', DEFAULT_WORKERS),
+    }
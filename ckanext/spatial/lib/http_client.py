@@ -0,0 +1,187 @@
+'''
+HTTP client shared by the spatial harvesters
+
+All the requests made by the harvesters (except the CSW ones, which are made
+by OWSLib) go through `get`, which:
+
+* Reuses connections with a `requests.Session` per process, with a
+  configurable connection pool size.
+* Retries connection errors, timeouts and server errors with an exponential
+  backoff.
+* Asks for gzip compressed responses.
+* Optionally limits the number of requests per second made to each host.
+* Keeps counters of the number of requests made, bytes received and time
+  spent, per host (see `get_stats`).
+'''
+import os
+import time
+import logging
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from six.moves.urllib.parse import urlparse
+
+import ckantoolkit as tk
+
+config = tk.config
+
+log = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = 30
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 0.5
+DEFAULT_POOL_SIZE = 10
+
+_session = None
+_session_pid = None
+_lock = threading.Lock()
+
+
+def _option(key, default, type_=int):
+    return type_(config.get('ckanext.spatial.harvest.http.' + key, default))
+
+
+def get_session():
+    '''
+    Returns the `requests.Session` of the current process, creating it if
+    needed (sessions are not shared with forked processes)
+    '''
+    global _session, _session_pid
+    with _lock:
+        if _session is None or _session_pid != os.getpid():
+            pool_size = _option('pool_size', DEFAULT_POOL_SIZE)
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size,
+                                  pool_maxsize=pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.headers['Accept-Encoding'] = 'gzip, deflate'
+            _session = session
+            _session_pid = os.getpid()
+        return _session
+
+
+def get(url, timeout=None, retries=None, backoff=None, rate_limit=None,
+        **kwargs):
+    '''
+    Makes a GET request with the shared session, returning the response.
+
+    timeout - seconds to wait for the server to respond
+              (`ckanext.spatial.harvest.http.timeout`, 30 by default)
+    retries - number of times a request failing with a connection error,
+              a timeout or a server error (5xx) is retried
+              (`ckanext.spatial.harvest.http.retries`, 3 by default)
+    backoff - seconds to wait before the first retry, doubled on each of
+              the next ones (`ckanext.spatial.harvest.http.backoff`, 0.5 by
+              default)
+    rate_limit - maximum number of requests per second to the host of the
+                 URL (`ckanext.spatial.harvest.http.rate_limit`, no limit by
+                 default)
+
+    Any other keyword arguments are passed to `requests.Session.get`. If all
+    the attempts fail, the last error is raised (for server errors, the
+    last response is returned).
+    '''
+    if timeout is None:
+        timeout = _option('timeout', DEFAULT_TIMEOUT, float)
+    if retries is None:
+        retries = _option('retries', DEFAULT_RETRIES)
+    if backoff is None:
+        backoff = _option('backoff', DEFAULT_BACKOFF, float)
+    if rate_limit is None:
+        rate_limit = _option('rate_limit', 0, float)
+
+    host = urlparse(url).netloc
+    attempt = 0
+    while True:
+        if rate_limit:
+            rate_limiter.wait(host, rate_limit)
+        started = time.time()
+        try:
+            response = get_session().get(url, timeout=timeout, **kwargs)
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout) as e:
+            stats.add(host, time.time() - started, error=True)
+            if attempt >= retries:
+                raise
+            error = e
+        else:
+            stats.add(host, time.time() - started, len(response.content),
+                      error=response.status_code >= 500)
+            if response.status_code < 500 or attempt >= retries:
+                return response
+            error = 'HTTP %s' % response.status_code
+
+        wait = backoff * (2 ** attempt)
+        attempt += 1
+        log.debug('Request to %s failed (%s), retrying in %.1fs', url, error, wait)
+        time.sleep(wait)
+
+
+class RateLimiter(object):
+    '''
+    Spaces the requests made to each host
+    '''
+    def __init__(self):
+        self._next = {}
+        self._lock = threading.Lock()
+
+    def wait(self, host, rate_limit):
+        interval = 1.0 / rate_limit
+        with self._lock:
+            now = time.time()
+            start = max(now, self._next.get(host, now))
+            self._next[host] = start + interval
+        if start > now:
+            time.sleep(start - now)
+
+
+class HttpStats(object):
+    '''
+    Counters of the requests made to each host
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._hosts = {}
+
+    def add(self, host, seconds, size=0, error=False):
+        with self._lock:
+            counters = self._hosts.setdefault(
+                host, {'requests': 0, 'errors': 0, 'bytes': 0, 'seconds': 0.0})
+            counters['requests'] += 1
+            counters['errors'] += 1 if error else 0
+            counters['bytes'] += size
+            counters['seconds'] += seconds
+
+    def get(self):
+        '''
+        Returns a dict with the counters of each host and their totals
+        (under the `total` key)
+        '''
+        with self._lock:
+            result = dict((host, dict(counters))
+                          for host, counters in self._hosts.items())
+        total = {'requests': 0, 'errors': 0, 'bytes': 0, 'seconds': 0.0}
+        for counters in result.values():
+            for key in total:
+                total[key] += counters[key]
+        result['total'] = total
+        return result
+
+
+rate_limiter = RateLimiter()
+
+stats = HttpStats()
+
+
+def get_stats():
+    '''
+    Returns the counters of the requests made by this process, see
+    `HttpStats.get`
+    '''
+    return stats.get()
@@ -0,0 +1,263 @@
+'''
+In-memory spatial index of the package extents, used by the `memory` spatial
+search backend.
+
+Each process keeps a Shapely STRtree with the extents of all the active
+packages, loaded lazily from the `package_extent` table the first time it is
+queried. Packages modified by the current process are flagged with
+`mark_dirty` (from the `SpatialMetadata` hooks) and reloaded before the next
+query, and every `ckanext.spatial.memory_index.refresh_interval` seconds the
+packages modified by other processes since the last refresh are reloaded too,
+and the ones deleted, purged or without an extent anymore are removed.
+'''
+import numbers
+import logging
+import datetime
+import threading
+
+from shapely import wkb
+from shapely.geometry import box
+from shapely.strtree import STRtree
+
+try:
+    # Shapely >= 2.0 provides vectorized operations
+    import numpy
+    from shapely import area as _vectorized_area
+    from shapely import intersection as _vectorized_intersection
+    from shapely import intersects as _vectorized_intersects
+except ImportError:
+    numpy = None
+
+import ckantoolkit as tk
+from ckan.model import Session, Package
+
+config = tk.config
+
+log = logging.getLogger(__name__)
+
+DEFAULT_REFRESH_INTERVAL = 60
+
+
+class SpatialMemoryIndex(object):
+
+    def __init__(self, refresh_interval=DEFAULT_REFRESH_INTERVAL):
+        self.refresh_interval = refresh_interval
+        self.loaded = False
+        self._geometries = {}
+        self._dirty = set()
+        self._tree = None
+        self._tree_ids = []
+        self._tree_geometries = []
+        self._tree_positions = {}
+        self._last_refresh = None
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._geometries)
+
+    def mark_dirty(self, package_id):
+        '''
+        Flags a package whose extent or state changed, so it is reloaded
+        from the database before the next query (once the changes have been
+        committed).
+        '''
+        if self.loaded:
+            with self._lock:
+                self._dirty.add(package_id)
+
+    def load(self):
+        '''
+        Loads the extents of all the active packages
+        '''
+        with self._lock:
+            started = datetime.datetime.utcnow()
+            self._geometries = dict(self._select_extents())
+            self._dirty = set()
+            self._tree = None
+            self._last_refresh = started
+            self.loaded = True
+            log.debug('Loaded %i extents in the spatial memory index', len(self._geometries))
+
+    def refresh(self, force=False):
+        '''
+        Reloads the packages flagged as dirty and, if the refresh interval
+        has passed, the packages modified since the last refresh, removing
+        the ones that are not active or do not have an extent anymore.
+        '''
+        with self._lock:
+            if not self.loaded:
+                return self.load()
+
+            now = datetime.datetime.utcnow()
+            package_ids = set(self._dirty)
+            if force or (now - self._last_refresh).total_seconds() >= self.refresh_interval:
+                # Look back an extra interval to catch changes committed
+                # after their modification date was set
+                since = self._last_refresh - datetime.timedelta(seconds=self.refresh_interval)
+                package_ids.update(
+                    package_id for (package_id,) in
+                    Session.query(Package.id).filter(Package.metadata_modified >= since))
+
+                # Packages purged or deleted don't always get a new
+                # modification date, so the indexed ones are checked against
+                # the active packages with an extent
+                indexed = set(self._active_extent_ids())
+                removed = [package_id for package_id in self._geometries
+                           if package_id not in indexed]
+                for package_id in removed:
+                    self._geometries.pop(package_id)
+                if removed:
+                    self._tree = None
+                    log.debug('Removed %i packages from the spatial memory index', len(removed))
+                # Extents added since the last refresh but missed by the
+                # modification date check
+                package_ids.update(indexed.difference(self._geometries))
+                self._last_refresh = now
+
+            if not package_ids:
+                return
+
+            for package_id in package_ids:
+                self._geometries.pop(package_id, None)
+            self._geometries.update(self._select_extents(package_ids))
+            self._dirty.difference_update(package_ids)
+            self._tree = None
+            log.debug('Refreshed %i packages in the spatial memory index', len(package_ids))
+
+    def query(self, bbox):
+        '''
+        Returns the ids of the active packages with an extent intersecting the
+        bounding box (in the database projection).
+        '''
+        return [package_id for package_id, geometry in self._candidates(bbox)]
+
+    def count(self, bbox):
+        return len(self.query(bbox))
+
+    def rank(self, bbox, limit=None, offset=0):
+        '''
+        Returns (package_id, spatial_ranking) tuples for the packages
+        intersecting the bounding box, best first, using the same ranking
+        method as `bbox_query_ordered` (USGS - 2006-1279, Lanfear).
+        '''
+        query_geometry = box(bbox['minx'], bbox['miny'], bbox['maxx'], bbox['maxy'])
+        search_area = query_geometry.area
+        candidates = self._candidates(bbox)
+        if not candidates or not search_area:
+            return []
+
+        package_ids = [package_id for package_id, geometry in candidates]
+        geometries = [geometry for package_id, geometry in candidates]
+
+        if numpy is not None:
+            geometries = _object_array(geometries)
+            areas = _vectorized_area(geometries)
+            intersection_areas = _vectorized_area(
+                _vectorized_intersection(geometries, query_geometry))
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                rankings = numpy.where(
+                    areas > 0,
+                    intersection_areas ** 2 / areas / search_area,
+                    0.0).tolist()
+        else:
+            rankings = []
+            for geometry in geometries:
+                area = geometry.area
+                rankings.append(
+                    geometry.intersection(query_geometry).area ** 2 / area / search_area
+                    if area else 0.0)
+
+        results = sorted(zip(package_ids, rankings), key=lambda r: (-r[1], r[0]))
+        if limit is not None:
+            return results[offset:offset + limit]
+        return results[offset:]
+
+    def _candidates(self, bbox):
+        self.refresh()
+
+        with self._lock:
+            if self._tree is None:
+                self._build_tree()
+            tree = self._tree
+            tree_ids = self._tree_ids
+            tree_geometries = self._tree_geometries
+            tree_positions = self._tree_positions
+
+        if tree is None:
+            return []
+
+        query_geometry = box(bbox['minx'], bbox['miny'], bbox['maxx'], bbox['maxy'])
+        hits = tree.query(query_geometry)
+        if len(hits) and isinstance(hits[0], numbers.Integral):
+            indexes = list(hits)
+        else:
+            # Shapely < 2.0 returns the geometries themselves
+            indexes = [tree_positions[id(g)] for g in hits]
+
+        indexes.sort()
+        geometries = [tree_geometries[i] for i in indexes]
+        if numpy is not None:
+            matches = _vectorized_intersects(
+                _object_array(geometries), query_geometry).tolist()
+        else:
+            matches = [g.intersects(query_geometry) for g in geometries]
+
+        return [(tree_ids[i], g) for i, g, match in zip(indexes, geometries, matches) if match]
+
+    def _build_tree(self):
+        self._tree_ids = list(self._geometries.keys())
+        self._tree_geometries = [self._geometries[package_id] for package_id in self._tree_ids]
+        self._tree_positions = dict(
+            (id(g), i) for i, g in enumerate(self._tree_geometries))
+        self._tree = STRtree(self._tree_geometries) if self._tree_geometries else None
+
+    def _active_extent_ids(self):
+        rows = Session.execute(
+            '''SELECT package_extent.package_id
+               FROM package_extent, package
+               WHERE package_extent.package_id = package.id
+                  AND package.state = 'active' ''')
+        return [package_id for (package_id,) in rows]
+
+    def _select_extents(self, package_ids=None):
+        sql = '''SELECT package_extent.package_id, ST_AsBinary(package_extent.the_geom)
+                 FROM package_extent, package
+                 WHERE package_extent.package_id = package.id
+                    AND package.state = 'active' '''
+        if package_ids is None:
+            rows = Session.execute(sql)
+        else:
+            rows = []
+            package_ids = list(package_ids)
+            for i in range(0, len(package_ids), 1000):
+                rows.extend(Session.execute(
+                    sql + ' AND package.id = ANY(:package_ids)',
+                    {'package_ids': package_ids[i:i + 1000]}))
+
+        for package_id, geometry in rows:
+            if geometry is None:
+                continue
+            yield package_id, wkb.loads(bytes(geometry))
+
+
+def _object_array(geometries):
+    array = numpy.empty(len(geometries), dtype=object)
+    array[:] = geometries
+    return array
+
+
+_memory_index = None
+
+
+def get_memory_index():
+    '''
+    Returns the spatial memory index of this process
+    '''
+    global _memory_index
+
+    if _memory_index is None:
+        _memory_index = SpatialMemoryIndex(refresh_interval=int(config.get(
+            'ckanext.spatial.memory_index.refresh_interval',
+            DEFAULT_REFRESH_INTERVAL)))
+
+    return _memory_index
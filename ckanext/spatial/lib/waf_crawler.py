@@ -0,0 +1,174 @@
+'''
+Concurrent crawler for Web Accessible Folders (WAF)
+
+Walks the subdirectories of a WAF index page, requesting the pages of each
+level of the tree concurrently with a pool of threads:
+
+* The number of concurrent requests to the same host is limited, and all
+  requests have a timeout.
+* Failed requests (connection errors, timeouts and server errors) are
+  retried with an exponential backoff, by the shared HTTP client (see
+  `ckanext.spatial.lib.http_client`).
+* Each directory is only requested once, and directories deeper than
+  `max_depth` are not followed.
+
+The records are returned in the same order as a sequential, depth-first
+crawl would return them.
+'''
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+
+from six.moves.urllib.parse import urlparse, urldefrag
+
+import ckantoolkit as tk
+
+from ckanext.spatial.lib import http_client
+
+config = tk.config
+
+log = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 8
+DEFAULT_PER_HOST = 4
+DEFAULT_TIMEOUT = 60
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 0.5
+DEFAULT_MAX_DEPTH = 10
+
+
+class WafCrawler(object):
+    '''
+    Crawls a WAF, using `parse` to extract the contents of each index page.
+
+    parse - function called with the content and URL of an index page,
+            returning a tuple with the list of subdirectory URLs and the list
+            of (url, modified_date) tuples of the documents in the page
+    workers - maximum number of concurrent requests
+    per_host - maximum number of concurrent requests to the same host
+    timeout - number of seconds to wait for a server response
+    retries - number of times a failed request is retried
+    backoff - seconds to wait before the first retry, doubled on each one
+    max_depth - index pages deeper than this are parsed but their
+                subdirectories are not followed
+    rate_limit - maximum number of requests per second to the same host
+
+    Unless provided, the options are read from the
+    `ckanext.spatial.harvest.waf_*` config options.
+    '''
+
+    def __init__(self, parse, workers=None, per_host=None, timeout=None,
+                 retries=None, backoff=None, max_depth=None, rate_limit=None):
+        def option(value, key, default, type_=int):
+            if value is not None:
+                return value
+            return type_(config.get('ckanext.spatial.harvest.waf_' + key, default))
+
+        self.parse = parse
+        self.workers = option(workers, 'workers', DEFAULT_WORKERS)
+        self.per_host = option(per_host, 'per_host', DEFAULT_PER_HOST)
+        self.timeout = option(timeout, 'timeout', DEFAULT_TIMEOUT, float)
+        self.retries = option(retries, 'retries', DEFAULT_RETRIES)
+        self.backoff = option(backoff, 'backoff', DEFAULT_BACKOFF, float)
+        self.max_depth = option(max_depth, 'max_depth', DEFAULT_MAX_DEPTH)
+        self.rate_limit = rate_limit
+
+        self._host_limits = {}
+        self._lock = threading.Lock()
+
+    def fetch(self, url):
+        '''
+        Requests a URL, retrying it if it fails. Returns the response, or
+        raises a requests.exceptions.RequestException if all attempts fail.
+        '''
+        with self._host_limit(url):
+            return http_client.get(url, timeout=self.timeout,
+                                   retries=self.retries, backoff=self.backoff,
+                                   rate_limit=self.rate_limit)
+
+    def crawl(self, content, base_url):
+        '''
+        Returns the list of (url, modified_date) tuples of the documents in
+        the WAF, given the content and URL of its root index page.
+        '''
+        seen = set([self._normalize(base_url)])
+        pool = ThreadPool(self.workers) if self.workers > 1 else None
+        try:
+            return self._crawl_level([(base_url, content)], 0, seen, pool)
+        finally:
+            if pool:
+                pool.terminate()
+
+    def _crawl_level(self, pages, depth, seen, pool):
+        '''
+        Parses the index pages of a level of the tree, requesting the
+        pages of the next level concurrently.
+
+        pages - list of (url, content) tuples, with None as content for the
+                pages that could not be requested
+        '''
+        parsed = []
+        subdirectories = []
+        for url, content in pages:
+            if content is None:
+                parsed.append(([], []))
+                continue
+            directories, records = self.parse(content, url)
+            children = []
+            if depth > self.max_depth:
+                if directories:
+                    log.info('Max WAF depth reached')
+            else:
+                for directory in directories:
+                    normalized = self._normalize(directory)
+                    if normalized in seen:
+                        continue
+                    seen.add(normalized)
+                    children.append(directory)
+            subdirectories.extend(children)
+            parsed.append((children, records))
+
+        if subdirectories:
+            if pool:
+                contents = pool.map(self._fetch_content, subdirectories)
+            else:
+                contents = [self._fetch_content(url) for url in subdirectories]
+            results = self._crawl_level(
+                list(zip(subdirectories, contents)), depth + 1, seen, pool)
+        else:
+            results = []
+
+        # Put the documents of each page before the ones of its
+        # subdirectories, as a depth-first crawl would
+        by_directory = {}
+        for directory, records in results:
+            by_directory.setdefault(directory, []).extend(records)
+        ordered = []
+        for (url, content), (children, records) in zip(pages, parsed):
+            page_records = list(records)
+            for child in children:
+                page_records.extend(by_directory.get(child, []))
+            ordered.append((url, page_records))
+        if depth == 0:
+            return [record for url, records in ordered for record in records]
+        return ordered
+
+    def _fetch_content(self, url):
+        log.debug('WAF new_url: %s', url)
+        try:
+            response = self.fetch(url)
+            response.raise_for_status()
+            return response.content
+        except Exception as e:
+            log.warning('Could not get the WAF subdirectory %s: %s', url, e)
+            return None
+
+    def _host_limit(self, url):
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._host_limits:
+                self._host_limits[host] = threading.BoundedSemaphore(self.per_host)
+            return self._host_limits[host]
+
+    def _normalize(self, url):
+        return urldefrag(url)[0].rstrip('/')
@@ -0,0 +1,142 @@
+'''
+Cached verification of Web Map Service (WMS) endpoints
+
+Checking whether a resource URL is an actual WMS involves requesting its
+GetCapabilities document, which can be slow, and many harvested records
+point to the same few endpoints. The results of the checks are cached per
+process, keyed by the normalized endpoint URL, for
+`ckanext.spatial.harvest.wms_cache_ttl` seconds (3600 by default). Failed
+checks are cached too, for `ckanext.spatial.harvest.wms_negative_cache_ttl`
+seconds (300 by default), so an endpoint that is down does not slow down
+every import.
+
+Endpoints not in the cache are checked concurrently, with up to
+`ckanext.spatial.harvest.wms_workers` (4 by default) requests at a time.
+'''
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+
+from six.moves.urllib.parse import urlparse, urlunparse
+
+import ckantoolkit as tk
+
+from ckanext.spatial.lib.cache import TTLCache
+
+config = tk.config
+
+log = logging.getLogger(__name__)
+
+DEFAULT_TTL = 3600
+DEFAULT_NEGATIVE_TTL = 300
+DEFAULT_WORKERS = 4
+DEFAULT_CACHE_SIZE = 1000
+
+
+def normalize_wms_url(url):
+    '''
+    Returns the endpoint of a WMS URL, without query string or fragment and
+    with the scheme and host lowercased
+    '''
+    parts = urlparse(url.strip())
+    return urlunparse((parts.scheme.lower(), parts.netloc.lower(),
+                       parts.path.rstrip('/') or '/', '', '', ''))
+
+
+class WmsVerifier(object):
+    '''
+    Caches the results of a function checking whether a URL is a WMS.
+
+    check - function called with a URL, returning True if it is a WMS.
+            Exceptions raised are logged and count as a failed check.
+    '''
+
+    def __init__(self, check=None, ttl=None, negative_ttl=None, workers=None,
+                 max_size=None):
+        self.check = check
+        self.workers = int(workers or config.get(
+            'ckanext.spatial.harvest.wms_workers', DEFAULT_WORKERS))
+        max_size = int(max_size or config.get(
+            'ckanext.spatial.harvest.wms_cache_size', DEFAULT_CACHE_SIZE))
+        self._positive = TTLCache(max_size=max_size, ttl=float(
+            ttl if ttl is not None else config.get(
+                'ckanext.spatial.harvest.wms_cache_ttl', DEFAULT_TTL)))
+        self._negative = TTLCache(max_size=max_size, ttl=float(
+            negative_ttl if negative_ttl is not None else config.get(
+                'ckanext.spatial.harvest.wms_negative_cache_ttl', DEFAULT_NEGATIVE_TTL)))
+
+    def is_wms(self, url, check=None):
+        '''
+        Returns True if the URL is a WMS
+        '''
+        return self.verify([url], check)[url]
+
+    def verify(self, urls, check=None):
+        '''
+        Returns a dict with whether each of the provided URLs is a WMS,
+        checking the endpoints not cached concurrently
+        '''
+        check = check or self.check
+        endpoints = {}
+        for url in urls:
+            endpoints[url] = normalize_wms_url(url)
+
+        results = {}
+        pending = {}
+        for url, endpoint in endpoints.items():
+            if endpoint in results or endpoint in pending:
+                continue
+            if endpoint in self._positive:
+                results[endpoint] = True
+            elif endpoint in self._negative:
+                results[endpoint] = False
+            else:
+                # The check is made with the URL as provided, as servers
+                # might not handle the normalized one
+                pending[endpoint] = url
+
+        if pending:
+            pending = list(pending.items())
+            checked = self._check_all([url for endpoint, url in pending], check)
+            for (endpoint, url), is_wms in zip(pending, checked):
+                cache = self._positive if is_wms else self._negative
+                cache.set(endpoint, is_wms)
+                results[endpoint] = is_wms
+
+        return dict((url, results[endpoint]) for url, endpoint in endpoints.items())
+
+    def _check_all(self, urls, check):
+        def safe_check(url):
+            try:
+                return bool(check(url))
+            except Exception as e:
+                log.error('WMS check for %s failed with exception: %s', url, e)
+                return False
+
+        if len(urls) == 1 or self.workers <= 1:
+            return [safe_check(url) for url in urls]
+
+        pool = ThreadPool(min(self.workers, len(urls)))
+        try:
+            return pool.map(safe_check, urls)
+        finally:
+            pool.terminate()
+
+    def clear(self):
+        self._positive.clear()
+        self._negative.clear()
+
+
+_verifier = None
+_lock = threading.Lock()
+
+
+def get_wms_verifier():
+    '''
+    Returns the WmsVerifier shared by the harvesters of this process
+    '''
+    global _verifier
+    with _lock:
+        if _verifier is None:
+            _verifier = WmsVerifier()
+        return _verifier
@@ -9,3 +9,5 @@ except ImportError:
 
 from .package_extent import *
 from .harvested_metadata import *
+from .csw_listing import *
+from .index_queue import *
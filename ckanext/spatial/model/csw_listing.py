@@ -0,0 +1,65 @@
+from logging import getLogger
+
+from sqlalchemy import types, Column, Table
+
+from ckan.model import meta, Session
+from ckan.model.domain_object import DomainObject
+
+log = getLogger(__name__)
+
+__all__ = ['CswListing']
+
+csw_listing_table = None
+
+
+def setup():
+    '''
+    Defines the table storing the listings of the CSW harvest sources and
+    creates it if it doesn't exist.
+    '''
+    if csw_listing_table is None:
+        define_csw_listing_table()
+
+    if not csw_listing_table.exists():
+        csw_listing_table.create()
+        log.debug('CSW listing table created')
+
+
+class CswListing(DomainObject):
+    '''
+    State of the listings of the records of a CSW harvest source, used by
+    the CSW harvester:
+
+    last_listing - start of the last listing of the records that completed
+    last_full_listing - start of the last listing of all the records (ie
+                        not only the modified ones) that completed
+    checkpoint_listing - parameters of the listing that failed, as JSON
+    checkpoint_started - start of the listing that failed
+    checkpoint_position - position to resume the listing that failed from
+    checkpoint_saved - time the checkpoint was saved
+    '''
+
+    def __init__(self, source_id=None):
+        self.source_id = source_id
+
+    @classmethod
+    def get(cls, source_id):
+        return Session.query(cls).filter(cls.source_id == source_id).first()
+
+
+def define_csw_listing_table():
+
+    global csw_listing_table
+
+    csw_listing_table = Table(
+        'spatial_csw_listing', meta.metadata,
+        Column('source_id', types.UnicodeText, primary_key=True),
+        Column('last_listing', types.DateTime),
+        Column('last_full_listing', types.DateTime),
+        Column('checkpoint_listing', types.UnicodeText),
+        Column('checkpoint_started', types.DateTime),
+        Column('checkpoint_position', types.Integer),
+        Column('checkpoint_saved', types.DateTime),
+    )
+
+    meta.mapper(CswListing, csw_listing_table)
@@ -0,0 +1,62 @@
+from logging import getLogger
+from datetime import datetime
+
+from sqlalchemy import types, Column, Table, Index
+
+from ckan.model import meta
+from ckan.model.types import make_uuid
+from ckan.model.domain_object import DomainObject
+
+log = getLogger(__name__)
+
+__all__ = ['IndexQueueEntry']
+
+index_queue_table = None
+
+
+def setup():
+    '''
+    Defines the table storing the datasets waiting to be indexed and
+    creates it if it doesn't exist.
+    '''
+    if index_queue_table is None:
+        define_index_queue_table()
+
+    if not index_queue_table.exists():
+        index_queue_table.create()
+        log.debug('Index queue table created')
+
+
+class IndexQueueEntry(DomainObject):
+    '''
+    Dataset written by the import stage of the spatial harvesters, waiting
+    to be indexed with the rest of the datasets of its harvest source (see
+    `SpatialHarvester._flush_index`):
+
+    package_id - id of the dataset
+    harvest_source_id - source of the harvest object imported
+    harvest_job_id - job of the harvest object imported
+    queued - time the dataset was written
+    '''
+
+    def __init__(self, package_id=None, harvest_source_id=None, harvest_job_id=None):
+        self.package_id = package_id
+        self.harvest_source_id = harvest_source_id
+        self.harvest_job_id = harvest_job_id
+
+
+def define_index_queue_table():
+
+    global index_queue_table
+
+    index_queue_table = Table(
+        'spatial_index_queue', meta.metadata,
+        Column('id', types.UnicodeText, primary_key=True, default=make_uuid),
+        Column('package_id', types.UnicodeText, nullable=False),
+        Column('harvest_source_id', types.UnicodeText, nullable=False),
+        Column('harvest_job_id', types.UnicodeText),
+        Column('queued', types.DateTime, default=datetime.utcnow),
+        Index('idx_spatial_index_queue_source', 'harvest_source_id'),
+    )
+
+    meta.mapper(IndexQueueEntry, index_queue_table)
@@ -9,6 +9,8 @@ from ckan.model import meta
 from ckan.model.domain_object import DomainObject
 
 from ckanext.spatial.geoalchemy_common import setup_spatial_table
+from ckanext.spatial.model.csw_listing import setup as setup_csw_listing
+from ckanext.spatial.model.index_queue import setup as setup_index_queue
 
 log = getLogger(__name__)
 
@@ -16,7 +18,15 @@ package_extent_table = None
 
 DEFAULT_SRID = 4326 #(WGS 84)
 
-def setup(srid=None):
+def setup(srid=None, migrate=False):
+    '''
+    Defines the spatial tables and creates them if they don't exist.
+
+    Tables created by previous versions are only migrated if `migrate` is
+    True (from the `spatial initdb` command), as migrating them can take a
+    while on large tables and should not be done by every web server
+    process when starting.
+    '''
 
     if package_extent_table is None:
         define_spatial_tables(srid)
@@ -43,18 +53,90 @@ def setup(srid=None):
                 raise e
 
             log.debug('Spatial tables created')
-        else:
+        elif migrate:
             log.debug('Spatial tables already exist')
             # Future migrations go here
+            migrate_bounds_columns()
+            migrate_fingerprint_column()
+        elif _missing_columns():
+            raise Exception('The package_extent table needs to be upgraded. ' + \
+                    'Please run the "spatial initdb" command.')
+
+        setup_csw_listing()
+        setup_index_queue()
 
     else:
         log.debug('Spatial tables creation deferred')
 
 
+def _package_extent_columns():
+    return [row[0] for row in Session.execute(
+        "SELECT column_name FROM information_schema.columns "
+        "WHERE table_name = 'package_extent'")]
+
+
+def _missing_columns():
+    columns = _package_extent_columns()
+    return [column for column in ('minx', 'miny', 'maxx', 'maxy', 'area', 'fingerprint')
+            if column not in columns]
+
+
+def migrate_bounds_columns():
+    '''
+    Adds the columns with the precomputed bounds and area of the extents
+    (used to rank the spatial queries) to tables created by previous
+    versions, and populates them for the existing rows.
+    '''
+    if 'minx' in _package_extent_columns():
+        return
+
+    log.info('Adding the bounds columns to the package_extent table')
+    Session.execute('''ALTER TABLE package_extent
+                         ADD COLUMN minx double precision,
+                         ADD COLUMN miny double precision,
+                         ADD COLUMN maxx double precision,
+                         ADD COLUMN maxy double precision,
+                         ADD COLUMN area double precision''')
+
+    result = Session.execute('''UPDATE package_extent SET
+                                    minx = ST_XMin(the_geom),
+                                    miny = ST_YMin(the_geom),
+                                    maxx = ST_XMax(the_geom),
+                                    maxy = ST_YMax(the_geom),
+                                    area = ST_Area(the_geom)
+                                WHERE the_geom IS NOT NULL''')
+    Session.commit()
+    log.info('Computed the bounds of %i existing extents', result.rowcount)
+
+
+def migrate_fingerprint_column():
+    '''
+    Adds the column storing the fingerprint of the extent geometries to
+    tables created by previous versions.
+
+    The fingerprints of the existing extents are computed in Python, so
+    they are not backfilled here but set the next time each dataset is
+    saved or with the `spatial extents` command.
+    '''
+    if 'fingerprint' in _package_extent_columns():
+        return
+
+    log.info('Adding the fingerprint column to the package_extent table')
+    Session.execute('ALTER TABLE package_extent ADD COLUMN fingerprint text')
+    Session.commit()
+
+
 class PackageExtent(DomainObject):
-    def __init__(self, package_id=None, the_geom=None):
+    def __init__(self, package_id=None, the_geom=None, minx=None, miny=None,
+                 maxx=None, maxy=None, area=None, fingerprint=None):
         self.package_id = package_id
         self.the_geom = the_geom
+        self.minx = minx
+        self.miny = miny
+        self.maxx = maxx
+        self.maxy = maxy
+        self.area = area
+        self.fingerprint = fingerprint
 
 
 def define_spatial_tables(db_srid=None):
@@ -1,5 +1,6 @@
 import os
 import re
+import copy
 import mimetypes
 from logging import getLogger
 
@@ -101,9 +102,27 @@ class SpatialMetadata(p.SingletonPlugin):
 
     def create(self, package):
         self.check_spatial_extra(package)
+        self._mark_dirty(package)
 
     def edit(self, package):
         self.check_spatial_extra(package)
+        self._mark_dirty(package)
+        if package.state != 'active' or package.extras.get('spatial'):
+            # The extent is kept if the package is deleted (or made a
+            # draft), but it won't be returned by the spatial queries
+            # anymore. If it becomes active again with the same extent,
+            # `save_package_extent` sees no change, and the previous state
+            # is not known here as the session has been flushed, so any
+            # active package with an extent invalidates the cache too.
+            from ckanext.spatial.lib.cache import invalidate_on_commit
+            invalidate_on_commit()
+
+    def _mark_dirty(self, package):
+        # Make sure the in-memory index of this process (if used) picks up
+        # the change
+        from ckanext.spatial.lib.memory_index import get_memory_index
+        if package.id:
+            get_memory_index().mark_dirty(package.id)
 
     def check_spatial_extra(self,package):
         '''
@@ -151,7 +170,10 @@ class SpatialMetadata(p.SingletonPlugin):
 
     def delete(self, package):
         from ckanext.spatial.lib import save_package_extent
+        from ckanext.spatial.lib.cache import invalidate_on_commit
         save_package_extent(package.id,None)
+        invalidate_on_commit()
+        self._mark_dirty(package)
 
     ## ITemplateHelpers
 
@@ -170,73 +192,22 @@ class SpatialQuery(SpatialQueryMixin, p.SingletonPlugin):
 
     search_backend = None
 
+    backend = None
+
     def configure(self, config):
+        from ckanext.spatial.search_backends import get_search_backend
 
         self.search_backend = config.get('ckanext.spatial.search_backend', 'postgis')
-        if self.search_backend != 'postgis' and not tk.check_ckan_version('2.0.1'):
+        if self.search_backend in ('solr', 'solr-spatial-field') and not tk.check_ckan_version('2.0.1'):
             msg = 'The Solr backends for the spatial search require CKAN 2.0.1 or higher. ' + \
                   'Please upgrade CKAN or select the \'postgis\' backend.'
             raise tk.CkanVersionException(msg)
 
-    def before_index(self, pkg_dict):
-        import shapely
-        import shapely.geometry
-
-        if pkg_dict.get('extras_spatial', None) and self.search_backend in ('solr', 'solr-spatial-field'):
-            try:
-                geometry = json.loads(pkg_dict['extras_spatial'])
-            except ValueError as e:
-                log.error('Geometry not valid GeoJSON, not indexing')
-                return pkg_dict
-
-            if self.search_backend == 'solr':
-                # Only bbox supported for this backend
-                if not (geometry['type'] == 'Polygon'
-                   and len(geometry['coordinates']) == 1
-                   and len(geometry['coordinates'][0]) == 5):
-                    log.error('Solr backend only supports bboxes (Polygons with 5 points), ignoring geometry {0}'.format(pkg_dict['extras_spatial']))
-                    return pkg_dict
-
-                coords = geometry['coordinates']
-                pkg_dict['maxy'] = max(coords[0][2][1], coords[0][0][1])
-                pkg_dict['miny'] = min(coords[0][2][1], coords[0][0][1])
-                pkg_dict['maxx'] = max(coords[0][2][0], coords[0][0][0])
-                pkg_dict['minx'] = min(coords[0][2][0], coords[0][0][0])
-                pkg_dict['bbox_area'] = (pkg_dict['maxx'] - pkg_dict['minx']) * \
-                                        (pkg_dict['maxy'] - pkg_dict['miny'])
-
-            elif self.search_backend == 'solr-spatial-field':
-                wkt = None
-
-                # Check potential problems with bboxes
-                if geometry['type'] == 'Polygon' \
-                   and len(geometry['coordinates']) == 1 \
-                   and len(geometry['coordinates'][0]) == 5:
-
-                    # Check wrong bboxes (4 same points)
-                    xs = [p[0] for p in geometry['coordinates'][0]]
-                    ys = [p[1] for p in geometry['coordinates'][0]]
-
-                    if xs.count(xs[0]) == 5 and ys.count(ys[0]) == 5:
-                        wkt = 'POINT({x} {y})'.format(x=xs[0], y=ys[0])
-                    else:
-                        # Check if coordinates are defined counter-clockwise,
-                        # otherwise we'll get wrong results from Solr
-                        lr = shapely.geometry.polygon.LinearRing(geometry['coordinates'][0])
-                        if not lr.is_ccw:
-                            lr.coords = list(lr.coords)[::-1]
-                        polygon = shapely.geometry.polygon.Polygon(lr)
-                        wkt = polygon.wkt
-
-                if not wkt:
-                    shape = shapely.geometry.asShape(geometry)
-                    if not shape.is_valid:
-                        log.error('Wrong geometry, not indexing')
-                        return pkg_dict
-                    wkt = shape.wkt
-
-                pkg_dict['spatial_geom'] = wkt
+        self.backend = get_search_backend(self.search_backend, config)
 
+    def before_index(self, pkg_dict):
+        if pkg_dict.get('extras_spatial', None) and self.backend:
+            pkg_dict = self.backend.index(pkg_dict)
 
         return pkg_dict
 
@@ -258,143 +229,81 @@ class SpatialQuery(SpatialQueryMixin, p.SingletonPlugin):
                 bbox['minx'] -= 360
                 bbox['maxx'] -= 360
 
-            if self.search_backend == 'solr':
-                search_params = self._params_for_solr_search(bbox, search_params)
-            elif self.search_backend == 'solr-spatial-field':
-                search_params = self._params_for_solr_spatial_field_search(bbox, search_params)
-            elif self.search_backend == 'postgis':
-                search_params = self._params_for_postgis_search(bbox, search_params)
-
-        return search_params
-
-    def _params_for_solr_search(self, bbox, search_params):
-        '''
-        This will add the following parameters to the query:
-
-            defType - edismax (We need to define EDisMax to use bf)
-            bf - {function} A boost function to influence the score (thus
-                 influencing the sorting). The algorithm can be basically defined as:
-
-                    2 * X / Q + T
-
-                 Where X is the intersection between the query area Q and the
-                 target geometry T. It gives a ratio from 0 to 1 where 0 means
-                 no overlap at all and 1 a perfect fit
-
-             fq - Adds a filter that force the value returned by the previous
-                  function to be between 0 and 1, effectively applying the
-                  spatial filter.
-
-        '''
-
-        variables =dict(
-            x11=bbox['minx'],
-            x12=bbox['maxx'],
-            y11=bbox['miny'],
-            y12=bbox['maxy'],
-            x21='minx',
-            x22='maxx',
-            y21='miny',
-            y22='maxy',
-            area_search = abs(bbox['maxx'] - bbox['minx']) * abs(bbox['maxy'] - bbox['miny'])
-        )
-
-        bf = '''div(
-                   mul(
-                   mul(max(0, sub(min({x12},{x22}) , max({x11},{x21}))),
-                       max(0, sub(min({y12},{y22}) , max({y11},{y21})))
-                       ),
-                   2),
-                   add({area_search}, mul(sub({y22}, {y21}), sub({x22}, {x21})))
-                )'''.format(**variables).replace('\n','').replace(' ','')
-
-        search_params['fq_list'] = ['{!frange incl=false l=0 u=1}%s' % bf]
-
-        search_params['bf'] = bf
-        search_params['defType'] = 'edismax'
-
-        return search_params
-
-    def _params_for_solr_spatial_field_search(self, bbox, search_params):
-        '''
-        This will add an fq filter with the form:
-
-            +spatial_geom:"Intersects(ENVELOPE({minx}, {miny}, {maxx}, {maxy}))
-
-        '''
-        search_params['fq_list'] = search_params.get('fq_list', [])
-        search_params['fq_list'].append('+spatial_geom:"Intersects(ENVELOPE({minx}, {maxx}, {maxy}, {miny}))"'
-                                        .format(minx=bbox['minx'], miny=bbox['miny'], maxx=bbox['maxx'], maxy=bbox['maxy']))
-
-        return search_params
-
-    def _params_for_postgis_search(self, bbox, search_params):
-        from ckanext.spatial.lib import   bbox_query, bbox_query_ordered
-        from ckan.lib.search import SearchError
-
-        # Note: This will be deprecated at some point in favour of the
-        # Solr 4 spatial sorting capabilities
-        if search_params.get('sort') == 'spatial desc' and \
-           tk.asbool(config.get('ckanext.spatial.use_postgis_sorting', 'False')):
-            if search_params['q'] or search_params['fq']:
-                raise SearchError('Spatial ranking cannot be mixed with other search parameters')
-                # ...because it is too inefficient to use SOLR to filter
-                # results and return the entire set to this class and
-                # after_search do the sorting and paging.
-            extents = bbox_query_ordered(bbox)
-            are_no_results = not extents
-            search_params['extras']['ext_rows'] = search_params['rows']
-            search_params['extras']['ext_start'] = search_params['start']
-            # this SOLR query needs to return no actual results since
-            # they are in the wrong order anyway. We just need this SOLR
-            # query to get the count and facet counts.
-            rows = 0
-            search_params['sort'] = None # SOLR should not sort.
-            # Store the rankings of the results for this page, so for
-            # after_search to construct the correctly sorted results
-            rows = search_params['extras']['ext_rows'] = search_params['rows']
-            start = search_params['extras']['ext_start'] = search_params['start']
-            search_params['extras']['ext_spatial'] = [
-                (extent.package_id, extent.spatial_ranking) \
-                for extent in extents[start:start+rows]]
-        else:
-            extents = bbox_query(bbox)
-            are_no_results = extents.count() == 0
-
-        if are_no_results:
-            # We don't need to perform the search
-            search_params['abort_search'] = True
-        else:
-            # We'll perform the existing search but also filtering by the ids
-            # of datasets within the bbox
-            bbox_query_ids = [extent.package_id for extent in extents]
-
-            q = search_params.get('q','').strip() or '""'
-            # Note: `"" AND` query doesn't work in github ci
-            new_q = '%s AND ' % q if q and q != '""' else ''
-            new_q += '(%s)' % ' OR '.join(['id:%s' % id for id in bbox_query_ids])
-
-            search_params['q'] = new_q
+            if self.backend:
+                search_params = self.backend.query(bbox, search_params)
 
         return search_params
 
     def after_search(self, search_results, search_params):
-        from ckan.lib.search import PackageSearchQuery
 
         # Note: This will be deprecated at some point in favour of the
         # Solr 4 spatial sorting capabilities
+        if 'spatial_count' in search_params.get('extras', {}) and \
+           tk.asbool(config.get('ckanext.spatial.use_postgis_sorting', 'False')):
+            # The search only covers the datasets of the page (or none)
+            search_results['count'] = search_params['extras']['spatial_count']
         if search_params.get('extras', {}).get('ext_spatial') and \
            tk.asbool(config.get('ckanext.spatial.use_postgis_sorting', 'False')):
             # Apply the spatial sort
-            querier = PackageSearchQuery()
-            pkgs = []
-            for package_id, spatial_ranking in search_params['extras']['ext_spatial']:
-                # get package from SOLR
-                pkg = querier.get_index(package_id)['data_dict']
-                pkgs.append(json.loads(pkg))
-            search_results['results'] = pkgs
+            package_ids = [package_id for package_id, spatial_ranking
+                           in search_params['extras']['ext_spatial']]
+            pkgs = self._get_packages_from_index(package_ids)
+            search_results['results'] = [
+                pkgs[package_id] for package_id in package_ids
+                if package_id in pkgs]
         return search_results
 
+    def _get_packages_from_index(self, package_ids):
+        '''
+        Returns a dict with the package dicts stored in the search index for
+        the provided ids, retrieved with a single Solr request.
+
+        If `ckanext.spatial.postgis_sorting.cache_ttl` is set, the decoded
+        package dicts are kept in memory for that number of seconds.
+        '''
+        from ckanext.spatial.search_backends import _terms_filter, _solr_search
+
+        cache = self._get_index_cache()
+
+        pkgs = {}
+        missing = []
+        for package_id in package_ids:
+            pkg = cache.get(package_id) if cache else None
+            if pkg is not None:
+                pkgs[package_id] = copy.deepcopy(pkg)
+            else:
+                missing.append(package_id)
+
+        if not missing:
+            return pkgs
+
+        solr_response = _solr_search({
+            'fq': [_terms_filter('id', missing)],
+            'fl': 'id,data_dict',
+            'rows': len(missing),
+        })
+
+        for doc in solr_response.docs:
+            pkg = json.loads(doc['data_dict'])
+            if cache:
+                cache.set(doc['id'], pkg)
+                pkg = copy.deepcopy(pkg)
+            pkgs[doc['id']] = pkg
+
+        return pkgs
+
+    def _get_index_cache(self):
+        ttl = int(config.get('ckanext.spatial.postgis_sorting.cache_ttl', 0))
+        if not ttl:
+            return None
+        if getattr(self, '_index_cache', None) is None or self._index_cache.ttl != ttl:
+            from ckanext.spatial.lib.cache import TTLCache
+            self._index_cache = TTLCache(
+                max_size=int(config.get(
+                    'ckanext.spatial.postgis_sorting.cache_size', 1000)),
+                ttl=ttl)
+        return self._index_cache
+
 
 class HarvestMetadataApi(HarvestMetadataApiMixin, p.SingletonPlugin):
     '''
@@ -0,0 +1,574 @@
+'''
+Spatial search backends
+
+Each backend is responsible for indexing the dataset extents and for
+restricting (and optionally ranking) the dataset search to the datasets
+intersecting a bounding box. The backend used by the `spatial_query` plugin is
+selected with the `ckanext.spatial.search_backend` configuration option, and
+can be either one of the built-in backends defined here or one provided by a
+plugin implementing `ISpatialSearchBackend`.
+'''
+import logging
+
+import ckantoolkit as tk
+from ckan import plugins as p
+
+from ckan.lib.helpers import json
+
+from ckanext.spatial.interfaces import ISpatialSearchBackend
+
+config = tk.config
+
+log = logging.getLogger(__name__)
+
+# Maximum number of dataset ids matched by PostGIS that will be sent to Solr
+# as a terms filter before falling back to the overflow strategy
+DEFAULT_POSTGIS_MAX_FILTER_IDS = 5000
+
+
+def _terms_filter(field, values):
+    '''
+    Returns a Solr filter query matching any of the provided values using
+    the terms query parser, which is not subject to the maxBooleanClauses
+    limit and is much lighter to parse than a long list of OR clauses.
+    '''
+    return '{!terms f=%s}%s' % (field, ','.join(values))
+
+
+def _solr_search(query):
+    '''
+    Runs a query directly against the Solr index of this site, returning the
+    pysolr results object.
+    '''
+    import pysolr
+    from ckan.lib.search import SearchError
+    from ckan.lib.search.common import make_connection
+
+    query = dict(query)
+    query['fq'] = ['+site_id:"%s"' % config.get('ckan.site_id')] + \
+        list(query.get('fq', []))
+    query.setdefault('q', '*:*')
+    query.setdefault('wt', 'json')
+
+    conn = make_connection(decode_dates=False)
+    log.debug('Package query: %r', query)
+    try:
+        return conn.search(**query)
+    except pysolr.SolrError as e:
+        raise SearchError('SOLR returned an error running query: %r Error: %r' %
+                          (query, e))
+
+
+class SpatialSearchBackend(object):
+    '''
+    Base class for the spatial search backends.
+
+    Plugins implementing `ISpatialSearchBackend` can extend it (or
+    `IdsSearchBackend`) to reuse the default behaviour. The `configure`
+    method is called with the CKAN config when the built-in backends are
+    created, plugins can get it called by implementing `IConfigurable`.
+    '''
+
+    backend_name = None
+
+    def configure(self, config):
+        pass
+
+    def name(self):
+        return self.backend_name
+
+    def index(self, pkg_dict):
+        return pkg_dict
+
+    def query(self, bbox, search_params):
+        raise NotImplementedError
+
+    def rank(self, bbox, limit=None, offset=0):
+        raise NotImplementedError(
+            'The {0} backend does not support spatial ranking'.format(self.name()))
+
+    def count(self, bbox):
+        raise NotImplementedError
+
+
+class SolrSearchBackend(SpatialSearchBackend):
+    '''
+    Indexes the bounding box of each dataset as four numeric fields and
+    filters and ranks the datasets with a Solr function query. Only
+    bounding boxes (Polygons with 5 points) are supported.
+    '''
+
+    backend_name = 'solr'
+
+    def index(self, pkg_dict):
+        try:
+            geometry = json.loads(pkg_dict['extras_spatial'])
+        except ValueError as e:
+            log.error('Geometry not valid GeoJSON, not indexing')
+            return pkg_dict
+
+        # Only bbox supported for this backend
+        if not (geometry['type'] == 'Polygon'
+           and len(geometry['coordinates']) == 1
+           and len(geometry['coordinates'][0]) == 5):
+            log.error('Solr backend only supports bboxes (Polygons with 5 points), ignoring geometry {0}'.format(pkg_dict['extras_spatial']))
+            return pkg_dict
+
+        coords = geometry['coordinates']
+        pkg_dict['maxy'] = max(coords[0][2][1], coords[0][0][1])
+        pkg_dict['miny'] = min(coords[0][2][1], coords[0][0][1])
+        pkg_dict['maxx'] = max(coords[0][2][0], coords[0][0][0])
+        pkg_dict['minx'] = min(coords[0][2][0], coords[0][0][0])
+        pkg_dict['bbox_area'] = (pkg_dict['maxx'] - pkg_dict['minx']) * \
+                                (pkg_dict['maxy'] - pkg_dict['miny'])
+
+        return pkg_dict
+
+    def query(self, bbox, search_params):
+        '''
+        This will add the following parameters to the query:
+
+            defType - edismax (We need to define EDisMax to use bf)
+            bf - {function} A boost function to influence the score (thus
+                 influencing the sorting). The algorithm can be basically defined as:
+
+                    2 * X / Q + T
+
+                 Where X is the intersection between the query area Q and the
+                 target geometry T. It gives a ratio from 0 to 1 where 0 means
+                 no overlap at all and 1 a perfect fit
+
+             fq - Adds a filter that force the value returned by the previous
+                  function to be between 0 and 1, effectively applying the
+                  spatial filter.
+
+        '''
+        bf = self._boost_function(bbox)
+
+        search_params['fq_list'] = [self._filter(bf)]
+
+        search_params['bf'] = bf
+        search_params['defType'] = 'edismax'
+
+        return search_params
+
+    def rank(self, bbox, limit=None, offset=0):
+        bf = self._boost_function(bbox)
+        if limit is None:
+            limit = max(self.count(bbox) - offset, 0)
+
+        results = _solr_search({
+            'fq': [self._filter(bf)],
+            'fl': 'id,spatial_ranking:%s' % bf,
+            'sort': '%s desc,id asc' % bf,
+            'rows': limit,
+            'start': offset,
+        })
+        return [(doc['id'], doc['spatial_ranking']) for doc in results.docs]
+
+    def count(self, bbox):
+        return _solr_search({
+            'fq': [self._filter(self._boost_function(bbox))],
+            'rows': 0,
+        }).hits
+
+    def _boost_function(self, bbox):
+        variables =dict(
+            x11=bbox['minx'],
+            x12=bbox['maxx'],
+            y11=bbox['miny'],
+            y12=bbox['maxy'],
+            x21='minx',
+            x22='maxx',
+            y21='miny',
+            y22='maxy',
+            area_search = abs(bbox['maxx'] - bbox['minx']) * abs(bbox['maxy'] - bbox['miny'])
+        )
+
+        return '''div(
+                   mul(
+                   mul(max(0, sub(min({x12},{x22}) , max({x11},{x21}))),
+                       max(0, sub(min({y12},{y22}) , max({y11},{y21})))
+                       ),
+                   2),
+                   add({area_search}, mul(sub({y22}, {y21}), sub({x22}, {x21})))
+                )'''.format(**variables).replace('\n','').replace(' ','')
+
+    def _filter(self, bf):
+        return '{!frange incl=false l=0 u=1}%s' % bf
+
+
+class SolrSpatialFieldSearchBackend(SpatialSearchBackend):
+    '''
+    Indexes the dataset geometries in a Solr spatial field (`spatial_geom`)
+    and filters the datasets with an `Intersects` query. Ranking is not
+    supported.
+    '''
+
+    backend_name = 'solr-spatial-field'
+
+    def index(self, pkg_dict):
+        import shapely
+        import shapely.geometry
+
+        try:
+            geometry = json.loads(pkg_dict['extras_spatial'])
+        except ValueError as e:
+            log.error('Geometry not valid GeoJSON, not indexing')
+            return pkg_dict
+
+        wkt = None
+
+        # Check potential problems with bboxes
+        if geometry['type'] == 'Polygon' \
+           and len(geometry['coordinates']) == 1 \
+           and len(geometry['coordinates'][0]) == 5:
+
+            # Check wrong bboxes (4 same points)
+            xs = [p[0] for p in geometry['coordinates'][0]]
+            ys = [p[1] for p in geometry['coordinates'][0]]
+
+            if xs.count(xs[0]) == 5 and ys.count(ys[0]) == 5:
+                wkt = 'POINT({x} {y})'.format(x=xs[0], y=ys[0])
+            else:
+                # Check if coordinates are defined counter-clockwise,
+                # otherwise we'll get wrong results from Solr
+                lr = shapely.geometry.polygon.LinearRing(geometry['coordinates'][0])
+                if not lr.is_ccw:
+                    lr.coords = list(lr.coords)[::-1]
+                polygon = shapely.geometry.polygon.Polygon(lr)
+                wkt = polygon.wkt
+
+        if not wkt:
+            shape = shapely.geometry.asShape(geometry)
+            if not shape.is_valid:
+                log.error('Wrong geometry, not indexing')
+                return pkg_dict
+            wkt = shape.wkt
+
+        pkg_dict['spatial_geom'] = wkt
+
+        return pkg_dict
+
+    def query(self, bbox, search_params):
+        '''
+        This will add an fq filter with the form:
+
+            +spatial_geom:"Intersects(ENVELOPE({minx}, {miny}, {maxx}, {maxy}))
+
+        '''
+        search_params['fq_list'] = search_params.get('fq_list', [])
+        search_params['fq_list'].append(self._filter(bbox))
+
+        return search_params
+
+    def count(self, bbox):
+        return _solr_search({'fq': [self._filter(bbox)], 'rows': 0}).hits
+
+    def _filter(self, bbox):
+        return '+spatial_geom:"Intersects(ENVELOPE({minx}, {maxx}, {maxy}, {miny}))"'.format(
+            minx=bbox['minx'], miny=bbox['miny'], maxx=bbox['maxx'], maxy=bbox['maxy'])
+
+
+class IdsSearchBackend(SpatialSearchBackend):
+    '''
+    Base class for the backends that perform the spatial query outside Solr.
+
+    The search is filtered by the ids of the datasets within the bbox
+    returned by `ids`, and when spatial sorting is requested the results page
+    is built from `rank`. Subclasses need to implement these two methods.
+
+    Up to `ckanext.spatial.postgis.max_filter_ids` ids are sent to Solr as a
+    terms filter. Larger candidate sets are handled according to
+    `ckanext.spatial.postgis.overflow_filter`:
+
+        chunked - Intersect the candidates with the user query (q and fq),
+                  sending them to Solr in chunks of `max_filter_ids` ids,
+                  and only send the ones matched. If there is no user query
+                  all the candidates are sent.
+        envelope - Filter on the dataset envelope fields (minx, miny, maxx,
+                   maxy) instead of sending the ids. These must be defined
+                   as float fields in the Solr schema, as for the `solr`
+                   backend, so it is only used if configured explicitly.
+    '''
+
+    max_filter_ids = DEFAULT_POSTGIS_MAX_FILTER_IDS
+
+    overflow_filter = 'chunked'
+
+    def configure(self, config):
+        self.max_filter_ids = int(config.get(
+            'ckanext.spatial.postgis.max_filter_ids',
+            DEFAULT_POSTGIS_MAX_FILTER_IDS))
+        self.overflow_filter = config.get(
+            'ckanext.spatial.postgis.overflow_filter', 'chunked')
+        if self.overflow_filter not in ('chunked', 'envelope'):
+            raise ValueError(
+                'Unknown value for ckanext.spatial.postgis.overflow_filter: '
+                '{0}. Supported values are "chunked" and "envelope"'.format(
+                    self.overflow_filter))
+
+    def ids(self, bbox):
+        '''
+        Returns the ids of all the active datasets within the bbox
+        '''
+        raise NotImplementedError
+
+    def count(self, bbox):
+        return len(self.ids(bbox))
+
+    def normalize_bbox(self, bbox):
+        return bbox
+
+    def index(self, pkg_dict):
+        import shapely.geometry
+
+        # Index the geometry envelope so it can be used as a filter when
+        # the backend returns too many results. The stock Solr schema
+        # would index the fields as strings, so only if configured.
+        if self.overflow_filter != 'envelope':
+            return pkg_dict
+
+        try:
+            geometry = json.loads(pkg_dict['extras_spatial'])
+            bounds = shapely.geometry.asShape(geometry).bounds
+        except (ValueError, TypeError, KeyError) as e:
+            log.error('Geometry not valid GeoJSON, not indexing')
+            return pkg_dict
+
+        pkg_dict['minx'], pkg_dict['miny'], pkg_dict['maxx'], pkg_dict['maxy'] = bounds
+        pkg_dict['bbox_area'] = (pkg_dict['maxx'] - pkg_dict['minx']) * \
+                                (pkg_dict['maxy'] - pkg_dict['miny'])
+        return pkg_dict
+
+    def query(self, bbox, search_params):
+        from ckan.lib.search import SearchError
+
+        bbox = self.normalize_bbox(bbox)
+
+        # Note: This will be deprecated at some point in favour of the
+        # Solr 4 spatial sorting capabilities
+        if search_params.get('sort') == 'spatial desc' and \
+           tk.asbool(config.get('ckanext.spatial.use_postgis_sorting', 'False')):
+            if search_params['q'] or search_params['fq']:
+                raise SearchError('Spatial ranking cannot be mixed with other search parameters')
+                # ...because it is too inefficient to use SOLR to filter
+                # results and return the entire set to this class and
+                # after_search do the sorting and paging.
+            return self._ranked_query(bbox, search_params)
+
+        # A single query is run to get the ids of all the datasets within
+        # the bbox. Solr needs all of them to return the count and facets.
+        package_ids = self.ids(bbox)
+
+        if not package_ids:
+            # We don't need to perform the search
+            search_params['abort_search'] = True
+        else:
+            # We'll perform the existing search but also filtering by the ids
+            # of datasets within the bbox. The user query (q and fq) is kept
+            # untouched so relevance, paging and faceting work as usual.
+            search_params['fq_list'] = search_params.get('fq_list', [])
+            search_params['fq_list'].append(
+                self._ids_filter(bbox, package_ids, search_params))
+
+        return search_params
+
+    def _ranked_query(self, bbox, search_params):
+        '''
+        Sets up a search sorted by the spatial ranking. Only the datasets
+        of the requested page are ranked and fetched (see `after_search` in
+        the `spatial_query` plugin), and the total is the one returned by
+        `count`, so the ids of all the datasets within the bbox are only
+        worked out if they can be sent to Solr to get the facet counts.
+        '''
+        count = self.count(bbox)
+
+        search_params['sort'] = None # SOLR should not sort.
+        # Store the rankings of the results for this page, so for
+        # after_search to construct the correctly sorted results
+        rows = search_params['extras']['ext_rows'] = search_params['rows']
+        start = search_params['extras']['ext_start'] = search_params['start']
+        search_params['extras']['ext_spatial'] = \
+            self.rank(bbox, limit=rows, offset=start) if count else []
+        # Not prefixed with ext_, so it can not be set from the request
+        search_params['extras']['spatial_count'] = count
+        # this SOLR query needs to return no actual results since
+        # they are in the wrong order anyway. We just need this SOLR
+        # query to get the facet counts.
+        search_params['rows'] = 0
+
+        if not count:
+            # We don't need to perform the search
+            search_params['abort_search'] = True
+            return search_params
+
+        if count <= self.max_filter_ids:
+            package_ids = self.ids(bbox)
+        else:
+            # Too many datasets to send, the facet counts only cover the
+            # datasets of the page
+            package_ids = [package_id for package_id, ranking
+                           in search_params['extras']['ext_spatial']]
+        search_params['fq_list'] = search_params.get('fq_list', [])
+        search_params['fq_list'].append(
+            _terms_filter('id', package_ids) if package_ids else '-id:*')
+
+        return search_params
+
+    def _ids_filter(self, bbox, package_ids, search_params):
+        if len(package_ids) <= self.max_filter_ids:
+            return _terms_filter('id', package_ids)
+
+        if self.overflow_filter == 'envelope':
+            log.debug('%i datasets matched the bbox, using the Solr envelope '
+                      'filter', len(package_ids))
+            return self._envelope_filter(bbox)
+
+        matched = self._intersect_with_search(package_ids, search_params)
+        if matched is None:
+            return _terms_filter('id', package_ids)
+        return _terms_filter('id', matched) if matched else '-id:*'
+
+    def _envelope_filter(self, bbox):
+        return '+minx:[* TO {maxx}] +maxx:[{minx} TO *] ' \
+               '+miny:[* TO {maxy}] +maxy:[{miny} TO *]'.format(**bbox)
+
+    def _intersect_with_search(self, package_ids, search_params):
+        '''
+        Returns the subset of the provided dataset ids that also match the
+        q and fq parameters of the search. The ids are sent to Solr in
+        chunks of `max_filter_ids` (or the maximum number of rows allowed)
+        ids, with one terms filter query per chunk.
+
+        Returns None if there is no query to intersect with.
+        '''
+        from ckan.lib.search import PackageSearchQuery
+
+        q = search_params.get('q', '').strip()
+        fq = search_params.get('fq', '').strip()
+        if (not q or q in ('""', '*:*')) and not fq \
+           and not search_params.get('fq_list'):
+            return None
+
+        chunk_size = min(self.max_filter_ids,
+                         int(config.get('ckan.search.rows_max', 1000)))
+        matched = []
+        for i in range(0, len(package_ids), chunk_size):
+            chunk = package_ids[i:i + chunk_size]
+            results = PackageSearchQuery().run({
+                'q': q or '*:*',
+                'fq': fq,
+                'fq_list': search_params.get('fq_list', []) + [
+                    _terms_filter('id', chunk)],
+                'fl': 'id',
+                'rows': len(chunk),
+                'start': 0,
+            })
+            matched.extend(r['id'] if isinstance(r, dict) else r
+                           for r in results['results'])
+
+        log.debug('Intersected %i bbox candidates down to %i', len(package_ids),
+                  len(matched))
+        return matched
+
+
+class PostgisSearchBackend(IdsSearchBackend):
+    '''
+    Queries the `package_extent` table in PostGIS. Results are cached
+    according to the `ckanext.spatial.query_cache.*` options.
+    '''
+
+    backend_name = 'postgis'
+
+    exact_ranking = False
+
+    def configure(self, config):
+        super(PostgisSearchBackend, self).configure(config)
+        self.exact_ranking = tk.asbool(config.get(
+            'ckanext.spatial.postgis_sorting.exact', False))
+
+    def normalize_bbox(self, bbox):
+        from ckanext.spatial.lib.cache import get_spatial_query_cache
+        return get_spatial_query_cache().normalize_bbox(bbox)
+
+    def ids(self, bbox):
+        from ckanext.spatial.lib import bbox_query_ids
+        from ckanext.spatial.lib.cache import get_spatial_query_cache
+
+        return get_spatial_query_cache().get_or_run(
+            bbox, None, 'ids', lambda: list(bbox_query_ids(bbox)))
+
+    def rank(self, bbox, limit=None, offset=0):
+        from ckanext.spatial.lib import bbox_query_ordered
+        from ckanext.spatial.lib.cache import get_spatial_query_cache
+
+        mode = 'ranked:{0}:{1}'.format(limit, offset)
+        if self.exact_ranking:
+            mode += ':exact'
+
+        return get_spatial_query_cache().get_or_run(
+            bbox, None, mode,
+            lambda: [(extent.package_id, extent.spatial_ranking)
+                     for extent in bbox_query_ordered(
+                         bbox, limit=limit, offset=offset, exact=self.exact_ranking)])
+
+    def count(self, bbox):
+        from ckanext.spatial.lib import bbox_count
+        from ckanext.spatial.lib.cache import get_spatial_query_cache
+
+        return get_spatial_query_cache().get_or_run(
+            bbox, None, 'count', lambda: bbox_count(bbox))
+
+
+class MemorySearchBackend(IdsSearchBackend):
+    '''
+    Queries the in-memory spatial index of the current process (see
+    `ckanext.spatial.lib.memory_index`).
+    '''
+
+    backend_name = 'memory'
+
+    def ids(self, bbox):
+        from ckanext.spatial.lib.memory_index import get_memory_index
+        return get_memory_index().query(bbox)
+
+    def rank(self, bbox, limit=None, offset=0):
+        from ckanext.spatial.lib.memory_index import get_memory_index
+        return get_memory_index().rank(bbox, limit=limit, offset=offset)
+
+    def count(self, bbox):
+        from ckanext.spatial.lib.memory_index import get_memory_index
+        return get_memory_index().count(bbox)
+
+
+search_backends = dict(
+    (backend.backend_name, backend) for backend in (
+        SolrSearchBackend,
+        SolrSpatialFieldSearchBackend,
+        PostgisSearchBackend,
+        MemorySearchBackend,
+    )
+)
+
+
+def get_search_backend(name, config=None):
+    '''
+    Returns the spatial search backend with the provided name.
+
+    Backends provided by plugins implementing `ISpatialSearchBackend` take
+    precedence over the built-in ones, so they can be replaced.
+    '''
+    for plugin in p.PluginImplementations(ISpatialSearchBackend):
+        if plugin.name() == name:
+            return plugin
+
+    if name not in search_backends:
+        raise ValueError(
+            'Unknown spatial search backend: {0}. Supported values are {1} or '
+            'the name of a backend provided by a plugin'.format(
+                name, ', '.join(sorted(search_backends))))
+
+    backend = search_backends[name]()
+    backend.configure(config if config is not None else tk.config)
+    return backend
@@ -0,0 +1,62 @@
+import pytest
+
+from ckan import model
+
+import ckan.tests.factories as factories
+
+from ckanext.spatial.model import PackageExtent
+from ckanext.spatial.lib.bulk_extents import rebuild_extents, _parse_extent
+from ckanext.spatial.tests.base import SpatialTestBase
+
+
+class TestParseExtent(SpatialTestBase):
+    def test_polygon(self):
+        package_id, values, error = _parse_extent(
+            ("xxx", self.geojson_examples["polygon"], 4326))
+        assert(package_id == "xxx")
+        assert(error is None)
+        assert((values["minx"], values["miny"], values["maxx"], values["maxy"]) ==
+               (100.0, 0.0, 101.0, 1.0))
+        assert(values["area"] == 1.0)
+
+    def test_empty(self):
+        assert(_parse_extent(("xxx", "", 4326)) == ("xxx", None, None))
+
+    def test_wrong(self):
+        package_id, values, error = _parse_extent(("xxx", "{not json", 4326))
+        assert(values is None)
+        assert(error)
+
+
+@pytest.mark.usefixtures('with_plugins', 'clean_postgis', 'clean_db', 'clean_index', 'harvest_setup', 'spatial_setup')
+class TestBulkExtentsRebuild(SpatialTestBase):
+    def test_rebuild(self):
+        dataset1 = factories.Dataset(
+            extras=[{"key": "spatial", "value": self.geojson_examples["polygon"]}]
+        )
+        dataset2 = factories.Dataset(
+            extras=[{"key": "spatial", "value": self.geojson_examples["point"]}]
+        )
+
+        # Extents out of sync with the extras
+        model.Session.execute("DELETE FROM package_extent WHERE package_id = :id",
+                              {"id": dataset1["id"]})
+        model.Session.add(PackageExtent(package_id="orphan"))
+        model.Session.commit()
+
+        progress = []
+        rebuild = rebuild_extents(
+            workers=1, chunk_size=1,
+            progress=lambda processed, elapsed: progress.append(processed))
+
+        assert(rebuild.processed == 2)
+        assert(rebuild.errors == [])
+        assert(progress == [1, 2])
+
+        extents = dict(
+            (extent.package_id, extent)
+            for extent in model.Session.query(PackageExtent)
+        )
+        assert(set(extents.keys()) == {dataset1["id"], dataset2["id"]})
+        assert(extents[dataset1["id"]].maxx == 101.0)
+        assert(extents[dataset1["id"]].area == 1.0)
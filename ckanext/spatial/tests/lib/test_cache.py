@@ -0,0 +1,149 @@
+import time
+
+import pytest
+
+from ckan import model
+
+from ckanext.spatial.lib import cache as cache_module
+from ckanext.spatial.lib.cache import (
+    TTLCache,
+    MemoryCacheBackend,
+    NullCacheBackend,
+    SpatialQueryCache,
+    invalidate_on_commit,
+    get_spatial_query_cache,
+)
+
+
+class TestTTLCache(object):
+    def test_get_set(self):
+        cache = TTLCache(max_size=10, ttl=60)
+        cache.set("a", 1)
+        assert(cache.get("a") == 1)
+        assert(cache.get("b") is None)
+
+    def test_lru_eviction(self):
+        cache = TTLCache(max_size=2, ttl=60)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        # Flag "a" as the most recently used one
+        cache.get("a")
+        cache.set("c", 3)
+        assert("a" in cache)
+        assert("b" not in cache)
+        assert("c" in cache)
+
+    def test_expiration(self):
+        cache = TTLCache(max_size=10, ttl=0.01)
+        cache.set("a", 1)
+        time.sleep(0.02)
+        assert(cache.get("a") is None)
+
+
+class TestSpatialQueryCache(object):
+    bbox = {"minx": -4.96, "miny": 55.70, "maxx": -3.78, "maxy": 56.43}
+
+    def test_cached(self):
+        cache = SpatialQueryCache(MemoryCacheBackend())
+        calls = []
+
+        def query():
+            calls.append(1)
+            return ["id1", "id2"]
+
+        assert(cache.get_or_run(self.bbox, None, "ids", query) == ["id1", "id2"])
+        assert(cache.get_or_run(self.bbox, None, "ids", query) == ["id1", "id2"])
+        assert(len(calls) == 1)
+
+        # Different mode or srid
+        cache.get_or_run(self.bbox, None, "ranked:10:0", query)
+        cache.get_or_run(self.bbox, 27700, "ids", query)
+        assert(len(calls) == 3)
+
+    def test_invalidate(self):
+        cache = SpatialQueryCache(MemoryCacheBackend())
+        cache.get_or_run(self.bbox, None, "ids", lambda: ["id1"])
+        cache.invalidate()
+        assert(
+            cache.get_or_run(self.bbox, None, "ids", lambda: ["id2"]) == ["id2"]
+        )
+
+    def test_precision(self):
+        cache = SpatialQueryCache(MemoryCacheBackend(), precision=1)
+        cache.get_or_run(self.bbox, None, "ids", lambda: ["id1"])
+        other_bbox = {"minx": -4.99, "miny": 55.66, "maxx": -3.81, "maxy": 56.41}
+        assert(cache.normalize_bbox(other_bbox) == cache.normalize_bbox(self.bbox))
+        assert(
+            cache.get_or_run(other_bbox, None, "ids", lambda: ["id2"]) == ["id1"]
+        )
+
+    def test_disabled(self):
+        cache = SpatialQueryCache(NullCacheBackend())
+        cache.get_or_run(self.bbox, None, "ids", lambda: ["id1"])
+        assert(
+            cache.get_or_run(self.bbox, None, "ids", lambda: ["id2"]) == ["id2"]
+        )
+
+
+class TestInvalidateOnCommit(object):
+    bbox = {"minx": -4.96, "miny": 55.70, "maxx": -3.78, "maxy": 56.43}
+
+    @pytest.fixture
+    def query_cache(self, monkeypatch):
+        query_cache = SpatialQueryCache(MemoryCacheBackend())
+        monkeypatch.setattr(cache_module, "_query_cache", query_cache)
+        query_cache.get_or_run(self.bbox, None, "ids", lambda: ["id1"])
+        yield query_cache
+        model.Session.rollback()
+
+    def _cached(self, query_cache):
+        return query_cache.get_or_run(self.bbox, None, "ids", lambda: ["id2"])
+
+    def test_invalidated_after_commit(self, query_cache):
+        model.Session.execute("SELECT 1")
+        invalidate_on_commit()
+
+        # Not invalidated until the transaction is committed
+        assert(self._cached(query_cache) == ["id1"])
+
+        model.Session.commit()
+        assert(self._cached(query_cache) == ["id2"])
+
+    def test_not_invalidated_on_savepoint_commit(self, query_cache):
+        model.Session.execute("SELECT 1")
+        savepoint = model.Session.begin_nested()
+        invalidate_on_commit()
+        savepoint.commit()
+        assert(self._cached(query_cache) == ["id1"])
+
+        model.Session.commit()
+        assert(self._cached(query_cache) == ["id2"])
+
+    def test_only_invalidated_once(self, query_cache):
+        invalidate_on_commit()
+        model.Session.commit()
+        assert(self._cached(query_cache) == ["id2"])
+
+        model.Session.commit()
+        assert(self._cached(query_cache) == ["id2"])
+
+
+class TestGetSpatialQueryCache(object):
+    def test_memory_backend_refused_with_several_workers(self, monkeypatch):
+        from ckantoolkit import config
+
+        monkeypatch.setattr(cache_module, "_query_cache", None)
+        monkeypatch.setattr(cache_module, "_worker_processes", lambda: 4)
+        monkeypatch.setitem(config, "ckanext.spatial.query_cache.backend", "memory")
+
+        with pytest.raises(ValueError):
+            get_spatial_query_cache()
+
+    def test_memory_backend(self, monkeypatch):
+        from ckantoolkit import config
+
+        monkeypatch.setattr(cache_module, "_query_cache", None)
+        monkeypatch.setattr(cache_module, "_worker_processes", lambda: None)
+        monkeypatch.setitem(config, "ckanext.spatial.query_cache.backend", "memory")
+
+        assert(isinstance(get_spatial_query_cache().backend, MemoryCacheBackend))
@@ -0,0 +1,242 @@
+from collections import OrderedDict
+
+import pytest
+
+from ckanext.spatial.lib.csw_client import (
+    CswError,
+    CswService,
+    get_csw_service,
+    clear_csw_services,
+)
+
+
+class FakeCatalogueServiceWeb(object):
+    '''
+    Stands for the OWSLib client, keeping the state of the last request
+    like it does
+    '''
+
+    capabilities_requests = []
+
+    def __init__(self, url):
+        FakeCatalogueServiceWeb.capabilities_requests.append(url)
+        self.url = url
+        self.identification = {"title": "Test CSW"}
+        self.request = "GetCapabilities"
+        self.response = b"<csw:Capabilities/>"
+        self.exceptionreport = None
+        self._exml = "capabilities tree"
+
+    def getrecords2(self, startposition=0, maxrecords=10, **kwargs):
+        self.request = "GetRecords %i" % startposition
+        self.response = b"<csw:GetRecordsResponse/>"
+        self.records = OrderedDict(
+            (str(i), i) for i in range(startposition, startposition + maxrecords))
+        self.results = {"matches": 100, "returned": maxrecords, "nextrecord": 0}
+
+
+@pytest.fixture
+def fake_csw(monkeypatch):
+    monkeypatch.setattr(CswService, "_Implementation", FakeCatalogueServiceWeb)
+    FakeCatalogueServiceWeb.capabilities_requests = []
+    clear_csw_services()
+    yield FakeCatalogueServiceWeb
+    clear_csw_services()
+
+
+class TestGetCswService(object):
+    def test_capabilities_reused(self, fake_csw):
+        service1 = get_csw_service("http://csw1", ttl=60)
+        service2 = get_csw_service("http://csw1", ttl=60)
+        get_csw_service("http://csw2", ttl=60)
+
+        assert fake_csw.capabilities_requests == ["http://csw1", "http://csw2"]
+        assert service1 is not service2
+        assert service1._ows() is not service2._ows()
+        assert service2._ows().identification == {"title": "Test CSW"}
+
+    def test_state_not_shared(self, fake_csw):
+        service1 = get_csw_service("http://csw1", ttl=60)
+        service1._ows().getrecords2(startposition=1, maxrecords=2)
+
+        csw = get_csw_service("http://csw1", ttl=60)._ows()
+
+        assert service1._ows().request == "GetRecords 1"
+        assert list(service1._ows().records.keys()) == ["1", "2"]
+        assert csw.request is None
+        assert csw.response is None
+        assert csw.records == OrderedDict()
+        assert csw.results == {}
+        assert csw._exml is None
+
+    def test_capabilities_requested_again_after_ttl(self, fake_csw):
+        get_csw_service("http://csw1", ttl=60)
+        get_csw_service("http://csw1", ttl=0)
+        get_csw_service("http://csw1", ttl=60)
+
+        assert fake_csw.capabilities_requests == ["http://csw1", "http://csw1"]
+
+    def test_clear(self, fake_csw):
+        get_csw_service("http://csw1", ttl=60)
+        clear_csw_services()
+        get_csw_service("http://csw1", ttl=60)
+
+        assert len(fake_csw.capabilities_requests) == 2
+
+
+class FakeCatalogueServer(object):
+    '''
+    Answers GetRecords requests for `matches` records with 1-based
+    positions, returning at most `max_records` records per request and an
+    error for requests of more than `fail_above` records or starting at
+    `fail_at`. `nextrecord` is a function returning the nextRecord value
+    from the position of the next record.
+    '''
+
+    def __init__(self, matches=25, max_records=None, fail_above=None,
+                 fail_at=None, nextrecord=lambda position: position):
+        self.matches = matches
+        self.max_records = max_records
+        self.fail_above = fail_above
+        self.fail_at = fail_at
+        self.nextrecord = nextrecord
+        self.exceptionreport = None
+        self.requests = []
+
+    def getrecords2(self, startposition=0, maxrecords=10, **kwargs):
+        self.requests.append((startposition, maxrecords))
+        if (self.fail_above and maxrecords > self.fail_above) or \
+                startposition == self.fail_at:
+            class ExceptionReport(object):
+                exceptions = ["Error"]
+            self.exceptionreport = ExceptionReport()
+            return
+        self.exceptionreport = None
+        start = max(startposition, 1)
+        count = min(maxrecords, self.max_records or maxrecords)
+        positions = list(range(start, min(start + count, self.matches + 1)))
+        self.records = OrderedDict((str(i), i) for i in positions)
+        next_position = positions[-1] + 1 if positions else 0
+        self.results = {
+            "matches": self.matches,
+            "returned": len(positions),
+            "nextrecord": self.nextrecord(next_position)
+            if next_position <= self.matches else 0,
+        }
+
+
+def _pages(server, **kwargs):
+    service = CswService()
+    service.__ows_obj__ = server
+    return [list(records.keys())
+            for records in service._getrecords_pages(**kwargs)]
+
+
+def _ids(start, end):
+    return [str(i) for i in range(start, end + 1)]
+
+
+class TestGetRecordsPages(object):
+    def test_pages(self):
+        server = FakeCatalogueServer(matches=25)
+
+        pages = _pages(server, page=10)
+
+        assert pages == [_ids(1, 10), _ids(11, 20), _ids(21, 25)]
+        assert server.requests == [(0, 10), (11, 10), (21, 10)]
+
+    def test_page_size_doubled(self):
+        server = FakeCatalogueServer(matches=100)
+
+        pages = _pages(server, page=10, max_page=40)
+
+        assert sum(pages, []) == _ids(1, 100)
+        assert [size for start, size in server.requests] == [10, 20, 40, 40]
+
+    def test_short_pages(self):
+        # The server returns less records than requested
+        server = FakeCatalogueServer(matches=25, max_records=4)
+
+        pages = _pages(server, page=10, max_page=40)
+
+        assert sum(pages, []) == _ids(1, 25)
+        assert server.requests[0] == (0, 10)
+        assert set(size for start, size in server.requests[1:]) == set([4])
+
+    @pytest.mark.parametrize("nextrecord", [
+        lambda position: 0,
+        lambda position: None,
+    ])
+    def test_bad_nextrecord(self, nextrecord):
+        server = FakeCatalogueServer(matches=25, nextrecord=nextrecord)
+
+        pages = _pages(server, page=10)
+
+        # Paged with the number of records returned, so the record at the
+        # start of each page is requested twice but only returned once
+        assert sum(pages, []) == _ids(1, 25)
+        assert server.requests == [(0, 10), (10, 10), (20, 10)]
+
+    def test_nextrecord_going_backwards(self):
+        server = FakeCatalogueServer(matches=25, nextrecord=lambda position: 1)
+
+        pages = _pages(server, page=10)
+
+        assert sum(pages, []) == _ids(1, 25)
+        assert len(server.requests) < 6
+
+    def test_page_too_large(self):
+        server = FakeCatalogueServer(matches=100, fail_above=20)
+
+        pages = _pages(server, page=10, max_page=80)
+
+        assert sum(pages, []) == _ids(1, 100)
+        assert server.requests[:3] == [(0, 10), (11, 20), (31, 40)]
+        assert set(size for start, size in server.requests[3:]) == set([20])
+
+    def test_error(self):
+        server = FakeCatalogueServer(matches=25, fail_at=11)
+        service = CswService()
+        service.__ows_obj__ = server
+        pages = service._getrecords_pages(page=10)
+
+        assert list(next(pages).keys()) == _ids(1, 10)
+        with pytest.raises(CswError):
+            next(pages)
+
+    def test_error_on_first_page(self):
+        server = FakeCatalogueServer(matches=25, fail_above=5)
+
+        with pytest.raises(CswError):
+            _pages(server, page=10, max_page=40)
+
+    def test_limit(self):
+        server = FakeCatalogueServer(matches=100)
+
+        pages = _pages(server, page=10, limit=15)
+
+        assert sum(pages, []) == _ids(1, 15)
+        assert len(server.requests) == 2
+
+    def test_progress(self):
+        server = FakeCatalogueServer(matches=25)
+        positions = []
+
+        _pages(server, page=10, progress=positions.append)
+
+        assert positions == [11, 21, 26]
+
+    def test_resume(self):
+        server = FakeCatalogueServer(matches=25)
+
+        pages = _pages(server, page=10, startposition=21)
+
+        assert pages == [_ids(21, 25)]
+
+    def test_workers(self):
+        server = FakeCatalogueServer(matches=95)
+
+        pages = _pages(server, page=10, workers=3)
+
+        assert sum(pages, []) == _ids(1, 95)
+        assert len(server.requests) == 10
@@ -0,0 +1,79 @@
+import time
+
+import requests
+
+from ckanext.spatial.lib import http_client
+
+
+class MockResponse(object):
+    def __init__(self, status_code, content=b"<xml/>"):
+        self.status_code = status_code
+        self.content = content
+
+
+def _mock_get(monkeypatch, responses):
+    requested = []
+
+    def get(session, url, timeout=None, **kwargs):
+        requested.append(url)
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    monkeypatch.setattr(requests.Session, "get", get)
+    return requested
+
+
+class TestHttpClient(object):
+    def test_session_is_reused(self):
+        assert http_client.get_session() is http_client.get_session()
+
+    def test_retries(self, monkeypatch):
+        requested = _mock_get(monkeypatch, [
+            requests.exceptions.ConnectionError(),
+            MockResponse(503),
+            MockResponse(200),
+        ])
+
+        response = http_client.get("http://example.com/a.xml", retries=2, backoff=0)
+
+        assert response.status_code == 200
+        assert len(requested) == 3
+
+    def test_retries_exhausted(self, monkeypatch):
+        _mock_get(monkeypatch, [MockResponse(500), MockResponse(502)])
+
+        response = http_client.get("http://example.com/a.xml", retries=1, backoff=0)
+
+        assert response.status_code == 502
+
+    def test_client_errors_are_not_retried(self, monkeypatch):
+        requested = _mock_get(monkeypatch, [MockResponse(404), MockResponse(200)])
+
+        response = http_client.get("http://example.com/a.xml", retries=2, backoff=0)
+
+        assert response.status_code == 404
+        assert len(requested) == 1
+
+    def test_stats(self, monkeypatch):
+        _mock_get(monkeypatch, [MockResponse(200, b"12345"), MockResponse(200, b"123")])
+        http_client.stats.reset()
+
+        http_client.get("http://example.com/a.xml")
+        http_client.get("http://example.com/b.xml")
+
+        stats = http_client.get_stats()
+        assert stats["example.com"]["requests"] == 2
+        assert stats["example.com"]["bytes"] == 8
+        assert stats["total"]["requests"] == 2
+
+    def test_rate_limit(self, monkeypatch):
+        _mock_get(monkeypatch, [MockResponse(200)] * 3)
+
+        started = time.time()
+        for i in range(3):
+            http_client.get("http://rate-limited.example.com/", rate_limit=20)
+
+        # The second and third requests wait 1/20 s each
+        assert time.time() - started >= 0.09
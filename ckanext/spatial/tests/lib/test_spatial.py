@@ -14,7 +14,14 @@ from ckan.logic.action.create import package_create
 from ckan.lib.munge import munge_title_to_name
 
 from ckanext.spatial.model import PackageExtent
-from ckanext.spatial.lib import validate_bbox, bbox_query, bbox_query_ordered
+from ckanext.spatial.lib import (
+    validate_bbox,
+    bbox_query,
+    bbox_query_ids,
+    bbox_query_ordered,
+    bbox_count,
+)
+from ckanext.spatial.lib.memory_index import SpatialMemoryIndex
 from ckanext.spatial.geoalchemy_common import (
     WKTElement,
     compare_geometry_fields,
@@ -130,6 +137,13 @@ class TestBboxQuery(SpatialQueryTestBase):
         package_titles = [model.Package.get(id_).title for id_ in package_ids]
         assert(set(package_titles) == {"(0, 3)", "(0, 4)", "(4, 5)"})
 
+    def test_query_ids(self):
+        self.initial_data()
+        bbox_dict = self.x_values_to_bbox((2, 5))
+        package_ids = list(bbox_query_ids(bbox_dict))
+        package_titles = [model.Package.get(id_).title for id_ in package_ids]
+        assert(set(package_titles) == {"(0, 3)", "(0, 4)", "(4, 5)"})
+
 
 @pytest.mark.usefixtures('with_plugins',  'clean_postgis', 'clean_db', 'clean_index', 'harvest_setup', 'spatial_setup')
 class TestBboxQueryOrdered(SpatialQueryTestBase):
@@ -152,6 +166,92 @@ class TestBboxQueryOrdered(SpatialQueryTestBase):
             package_titles == ["(2, 7)", "(1, 8)", "(3, 6)", "(0, 9)", "(4, 5)"]
         )
 
+    def test_query_exact(self):
+        self.initial_data()
+        bbox_dict = self.x_values_to_bbox((2, 7))
+        q = bbox_query_ordered(bbox_dict, exact=True)
+        package_titles = [model.Package.get(res.package_id).title for res in q]
+        assert(
+            package_titles == ["(2, 7)", "(1, 8)", "(3, 6)", "(0, 9)", "(4, 5)"]
+        )
+
+    def test_query_paged(self):
+        self.initial_data()
+        bbox_dict = self.x_values_to_bbox((2, 7))
+        q = bbox_query_ordered(bbox_dict, limit=2, offset=1)
+        package_titles = [model.Package.get(res.package_id).title for res in q]
+        assert(package_titles == ["(1, 8)", "(3, 6)"])
+
+    def test_count(self):
+        self.initial_data()
+        bbox_dict = self.x_values_to_bbox((2, 7))
+        assert(bbox_count(bbox_dict) == 5)
+
+
+@pytest.mark.usefixtures('with_plugins',  'clean_postgis', 'clean_db', 'clean_index', 'harvest_setup', 'spatial_setup')
+class TestMemoryIndex(SpatialQueryTestBase):
+    # x values for the fixtures
+    fixtures_x = [(0, 9), (1, 8), (2, 7), (3, 6), (4, 5), (8, 9)]
+
+    def test_query(self):
+        self.initial_data()
+        index = SpatialMemoryIndex()
+        bbox_dict = self.x_values_to_bbox((2, 7))
+        package_titles = [
+            model.Package.get(id_).title for id_ in index.query(bbox_dict)
+        ]
+        assert(
+            set(package_titles) ==
+            set(("(0, 9)", "(1, 8)", "(2, 7)", "(3, 6)", "(4, 5)"))
+        )
+
+    def test_rank(self):
+        self.initial_data()
+        index = SpatialMemoryIndex()
+        bbox_dict = self.x_values_to_bbox((2, 7))
+        expected = [
+            (res.package_id, res.spatial_ranking)
+            for res in bbox_query_ordered(bbox_dict)
+        ]
+        ranked = index.rank(bbox_dict)
+        assert([r[0] for r in ranked] == [r[0] for r in expected])
+        for result, expected_result in zip(ranked, expected):
+            assert(abs(result[1] - expected_result[1]) < 1e-9)
+
+    def test_refresh(self):
+        self.initial_data()
+        index = SpatialMemoryIndex()
+        bbox_dict = self.x_values_to_bbox((20, 21))
+        assert(index.query(bbox_dict) == [])
+
+        create_package(
+            name="new-extent",
+            extras=[
+                {"key": "spatial",
+                 "value": bbox_2_geojson(self.x_values_to_bbox((20, 21)))}
+            ],
+        )
+        index.refresh(force=True)
+        assert(len(index.query(bbox_dict)) == 1)
+
+    def test_refresh_removes_deleted_and_purged(self):
+        self.initial_data()
+        index = SpatialMemoryIndex()
+        bbox_dict = self.x_values_to_bbox((2, 7))
+        package_ids = index.query(bbox_dict)
+        deleted_id, purged_id = package_ids[:2]
+
+        # Change the database directly, without updating the modification
+        # date of the packages
+        model.Session.execute(
+            "UPDATE package SET state = 'deleted' WHERE id = :id", {"id": deleted_id})
+        model.Session.execute(
+            "DELETE FROM package_extent WHERE package_id = :id", {"id": purged_id})
+        model.Session.commit()
+
+        index.refresh(force=True)
+        assert(set(index.query(bbox_dict)) == set(package_ids) - set([deleted_id, purged_id]))
+
 
 @pytest.mark.usefixtures('with_plugins',  'clean_postgis', 'clean_db', 'clean_index', 'harvest_setup', 'spatial_setup')
 class TestBboxQueryPerformance(SpatialQueryTestBase):
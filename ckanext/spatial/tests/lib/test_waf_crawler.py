@@ -0,0 +1,91 @@
+import requests
+
+from ckanext.spatial.lib.waf_crawler import WafCrawler
+
+
+TREE = {
+    "http://waf/": (["http://waf/a/", "http://waf/b/"], ["http://waf/1.xml"]),
+    "http://waf/a/": (
+        ["http://waf/a/x/", "http://waf/b/"],
+        ["http://waf/a/2.xml"],
+    ),
+    "http://waf/b/": ([], ["http://waf/b/3.xml"]),
+    "http://waf/a/x/": ([], ["http://waf/a/x/4.xml"]),
+}
+
+
+def _parse(content, url):
+    directories, documents = TREE[url]
+    return directories, [(document, None) for document in documents]
+
+
+class MockResponse(object):
+    status_code = 200
+
+    def __init__(self, content):
+        self.content = content
+
+    def raise_for_status(self):
+        pass
+
+
+class TestWafCrawler(object):
+    def _crawler(self, monkeypatch, **kwargs):
+        requested = []
+
+        def get(session, url, timeout=None):
+            requested.append(url)
+            return MockResponse(url)
+
+        monkeypatch.setattr(requests.Session, "get", get)
+        kwargs.setdefault("workers", 4)
+        return WafCrawler(_parse, **kwargs), requested
+
+    def test_crawl(self, monkeypatch):
+        crawler, requested = self._crawler(monkeypatch)
+        results = crawler.crawl("http://waf/", "http://waf/")
+
+        assert [url for url, date in results] == [
+            "http://waf/1.xml",
+            "http://waf/a/2.xml",
+            "http://waf/a/x/4.xml",
+            "http://waf/b/3.xml",
+        ]
+        # Each directory is only requested once
+        assert sorted(requested) == [
+            "http://waf/a/", "http://waf/a/x/", "http://waf/b/"]
+
+    def test_max_depth(self, monkeypatch):
+        crawler, requested = self._crawler(monkeypatch, max_depth=0)
+        results = crawler.crawl("http://waf/", "http://waf/")
+
+        assert "http://waf/a/x/4.xml" not in [url for url, date in results]
+        assert "http://waf/a/x/" not in requested
+
+    def test_retries(self, monkeypatch):
+        attempts = []
+
+        def get(session, url, timeout=None):
+            attempts.append(url)
+            if len(attempts) < 3:
+                raise requests.exceptions.ConnectionError()
+            return MockResponse(url)
+
+        monkeypatch.setattr(requests.Session, "get", get)
+        crawler = WafCrawler(_parse, retries=2, backoff=0)
+
+        assert crawler.fetch("http://waf/").content == "http://waf/"
+        assert len(attempts) == 3
+
+    def test_failed_directory_is_skipped(self, monkeypatch):
+        def get(session, url, timeout=None):
+            if url == "http://waf/b/":
+                raise requests.exceptions.Timeout()
+            return MockResponse(url)
+
+        monkeypatch.setattr(requests.Session, "get", get)
+        crawler = WafCrawler(_parse, workers=4, retries=1, backoff=0)
+        results = crawler.crawl("http://waf/", "http://waf/")
+
+        assert "http://waf/b/3.xml" not in [url for url, date in results]
+        assert "http://waf/a/x/4.xml" in [url for url, date in results]
@@ -0,0 +1,66 @@
+import time
+
+from ckanext.spatial.lib.wms_verifier import WmsVerifier, normalize_wms_url
+
+
+class MockCheck(object):
+    def __init__(self, wms_urls=(), delay=0):
+        self.wms_urls = wms_urls
+        self.delay = delay
+        self.checked = []
+
+    def __call__(self, url):
+        self.checked.append(url)
+        time.sleep(self.delay)
+        if url == "http://broken.example.com/wms":
+            raise ValueError("Broken")
+        return url in self.wms_urls
+
+
+class TestWmsVerifier(object):
+    def test_normalize_wms_url(self):
+        assert (normalize_wms_url("HTTP://Example.com/wms/?service=WMS") ==
+                "http://example.com/wms")
+
+    def test_cached(self):
+        check = MockCheck(["http://example.com/wms"])
+        verifier = WmsVerifier(check)
+
+        assert verifier.is_wms("http://example.com/wms")
+        assert verifier.is_wms("http://EXAMPLE.com/wms/")
+        assert check.checked == ["http://example.com/wms"]
+
+    def test_negative_cache(self):
+        check = MockCheck()
+        verifier = WmsVerifier(check, negative_ttl=0.01)
+
+        assert not verifier.is_wms("http://example.com/wms")
+        assert not verifier.is_wms("http://example.com/wms")
+        assert len(check.checked) == 1
+
+        time.sleep(0.02)
+        assert not verifier.is_wms("http://example.com/wms")
+        assert len(check.checked) == 2
+
+    def test_errors_are_failed_checks(self):
+        verifier = WmsVerifier(MockCheck())
+
+        assert not verifier.is_wms("http://broken.example.com/wms")
+
+    def test_verify_concurrently(self):
+        urls = ["http://example.com/wms%i" % i for i in range(4)]
+        check = MockCheck(urls[:2], delay=0.1)
+        verifier = WmsVerifier(check, workers=4)
+
+        started = time.time()
+        results = verifier.verify(urls + ["http://example.com/wms0/"])
+
+        assert time.time() - started < 0.3
+        assert results == {
+            "http://example.com/wms0": True,
+            "http://example.com/wms0/": True,
+            "http://example.com/wms1": True,
+            "http://example.com/wms2": False,
+            "http://example.com/wms3": False,
+        }
+        assert len(check.checked) == 4
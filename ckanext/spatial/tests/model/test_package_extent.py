@@ -9,6 +9,8 @@ import ckan.tests.helpers as helpers
 import ckan.tests.factories as factories
 
 from ckanext.spatial.model import PackageExtent
+from ckanext.spatial.model.package_extent import setup as spatial_db_setup
+from ckanext.spatial.lib import save_package_extent, extent_fingerprint
 from ckanext.spatial.geoalchemy_common import WKTElement, legacy_geoalchemy
 from ckanext.spatial.tests.base import SpatialTestBase
 
@@ -106,3 +108,82 @@ class TestPackageExtent(SpatialTestBase):
             )
             assert(package_extent.the_geom.srid == self.db_srid)
 
+
+    def test_save_extent_envelope(self):
+
+        package = factories.Dataset()
+
+        geojson = json.loads(self.geojson_examples["multipolygon"])
+        save_package_extent(package["id"], geojson)
+        Session.commit()
+
+        package_extent = Session.query(PackageExtent).get(package["id"])
+        assert(package_extent.minx == 100.0)
+        assert(package_extent.miny == 0.0)
+        assert(package_extent.maxx == 103.0)
+        assert(package_extent.maxy == 3.0)
+        assert(abs(package_extent.area - 1.64) < 1e-9)
+
+        # Update the geometry
+        geojson = json.loads(self.geojson_examples["point"])
+        save_package_extent(package["id"], geojson)
+        Session.commit()
+
+        package_extent = Session.query(PackageExtent).get(package["id"])
+        assert(package_extent.minx == package_extent.maxx == 100.0)
+        assert(package_extent.area == 0)
+
+    def test_save_extent_fingerprint(self):
+
+        package = factories.Dataset()
+
+        geojson = json.loads(self.geojson_examples["polygon"])
+        save_package_extent(package["id"], geojson)
+        Session.commit()
+
+        package_extent = Session.query(PackageExtent).get(package["id"])
+        fingerprint = package_extent.fingerprint
+        assert(fingerprint == extent_fingerprint(asShape(geojson), self.db_srid))
+
+        # Same geometry, nothing is written
+        save_package_extent(package["id"], geojson)
+        assert(not Session.dirty and not Session.new)
+
+        geojson = json.loads(self.geojson_examples["polygon_holes"])
+        save_package_extent(package["id"], geojson)
+        Session.commit()
+
+        package_extent = Session.query(PackageExtent).get(package["id"])
+        assert(package_extent.fingerprint != fingerprint)
+        assert(abs(package_extent.area - 0.64) < 1e-9)
+
+
+@pytest.mark.usefixtures('with_plugins', 'clean_db', 'clean_index', 'harvest_setup', 'spatial_setup')
+class TestPackageExtentMigration(SpatialTestBase):
+    def test_migrate_bounds_columns(self):
+        package = factories.Dataset()
+        geojson = json.loads(self.geojson_examples["multipolygon"])
+        save_package_extent(package["id"], geojson)
+        Session.commit()
+
+        # Table created by a previous version
+        Session.execute(
+            "ALTER TABLE package_extent DROP COLUMN minx, DROP COLUMN miny, "
+            "DROP COLUMN maxx, DROP COLUMN maxy, DROP COLUMN area, "
+            "DROP COLUMN fingerprint")
+        Session.commit()
+
+        # The table is not migrated on startup
+        with pytest.raises(Exception):
+            spatial_db_setup()
+
+        spatial_db_setup(migrate=True)
+
+        package_extent = Session.query(PackageExtent).get(package["id"])
+        assert(package_extent.minx == 100.0)
+        assert(package_extent.maxy == 3.0)
+        assert(abs(package_extent.area - 1.64) < 1e-9)
+        assert(package_extent.fingerprint is None)
+
+        # Already migrated
+        spatial_db_setup()
@@ -163,6 +163,171 @@ class TestAction(SpatialTestBase):
         assert(result["count"] == 1)
         assert(result["results"][0]["id"] == dataset["id"])
 
+    @pytest.mark.usefixtures('clean_postgis', 'clean_db', 'clean_index', 'harvest_setup', 'spatial_setup')
+    def test_spatial_query_keeps_q(self):
+        dataset = factories.Dataset(
+            title="Rivers of New Zealand",
+            extras=[{"key": "spatial", "value": extents["nz"]}]
+        )
+        factories.Dataset(
+            title="Roads",
+            extras=[{"key": "spatial", "value": extents["nz"]}]
+        )
+
+        result = helpers.call_action(
+            "package_search", q="Rivers", extras={"ext_bbox": "56,-54,189,-28"}
+        )
+
+        assert(result["count"] == 1)
+        assert(result["results"][0]["id"] == dataset["id"])
+
+    @pytest.mark.usefixtures('clean_postgis', 'clean_db', 'clean_index', 'harvest_setup', 'spatial_setup')
+    def test_spatial_query_cache_delete_and_reactivate(self, monkeypatch):
+        from ckanext.spatial.lib import cache as cache_module
+        from ckanext.spatial.lib.cache import SpatialQueryCache, MemoryCacheBackend
+        monkeypatch.setattr(
+            cache_module, "_query_cache", SpatialQueryCache(MemoryCacheBackend()))
+
+        sysadmin = factories.Sysadmin()
+        context = {"user": sysadmin["name"]}
+        dataset = factories.Dataset(
+            extras=[{"key": "spatial", "value": extents["nz"]}]
+        )
+
+        def search():
+            return helpers.call_action(
+                "package_search", extras={"ext_bbox": "56,-54,189,-28"}
+            )["count"]
+
+        assert(search() == 1)
+
+        # The extent is kept while the dataset is deleted
+        helpers.call_action("package_patch", context=dict(context),
+                            id=dataset["id"], state="deleted")
+        assert(search() == 0)
+
+        helpers.call_action("package_patch", context=dict(context),
+                            id=dataset["id"], state="active")
+        assert(search() == 1)
+
+    def _overflow_backend(self, overflow_filter="chunked"):
+        from ckanext.spatial.search_backends import PostgisSearchBackend
+        backend = PostgisSearchBackend()
+        backend.configure({
+            "ckanext.spatial.postgis.max_filter_ids": "1",
+            "ckanext.spatial.postgis.overflow_filter": overflow_filter,
+        })
+        return backend
+
+    def _overflow_search(self, backend, **search_params):
+        search_params.setdefault("q", "")
+        search_params.setdefault("fq", "")
+        search_params.setdefault("extras", {})
+        search_params = backend.query(
+            {"minx": 56, "miny": -54, "maxx": 189, "maxy": -28}, search_params)
+        return search_params["fq_list"][-1]
+
+    @pytest.mark.usefixtures('clean_postgis', 'clean_db', 'clean_index', 'harvest_setup', 'spatial_setup')
+    def test_spatial_query_chunked_overflow(self):
+        dataset = factories.Dataset(
+            title="Rivers of New Zealand",
+            extras=[{"key": "spatial", "value": extents["nz"]}]
+        )
+        factories.Dataset(
+            title="Roads",
+            extras=[{"key": "spatial", "value": extents["nz"]}]
+        )
+
+        fq = self._overflow_search(self._overflow_backend(), q="Rivers")
+
+        # Only the candidates matching the query are sent
+        assert(fq == "{!terms f=id}%s" % dataset["id"])
+
+    @pytest.mark.usefixtures('clean_postgis', 'clean_db', 'clean_index', 'harvest_setup', 'spatial_setup')
+    def test_spatial_query_chunked_overflow_several_chunks(self):
+        rivers = [
+            factories.Dataset(
+                title="Rivers %i" % i,
+                extras=[{"key": "spatial", "value": extents["nz"]}]
+            )["id"]
+            for i in range(3)
+        ]
+        factories.Dataset(
+            title="Roads",
+            extras=[{"key": "spatial", "value": extents["nz"]}]
+        )
+
+        fq = self._overflow_search(self._overflow_backend(), q="Rivers")
+
+        # The candidates are intersected one chunk at a time
+        assert(fq.startswith("{!terms f=id}"))
+        assert(sorted(fq[len("{!terms f=id}"):].split(",")) == sorted(rivers))
+
+    @pytest.mark.usefixtures('clean_postgis', 'clean_db', 'clean_index', 'harvest_setup', 'spatial_setup')
+    def test_spatial_query_chunked_overflow_no_query(self):
+        for title in ("Rivers", "Roads"):
+            factories.Dataset(
+                title=title,
+                extras=[{"key": "spatial", "value": extents["nz"]}]
+            )
+        factories.Dataset(extras=[{"key": "spatial", "value": extents["ohio"]}])
+
+        fq = self._overflow_search(self._overflow_backend())
+
+        # There is nothing to intersect the candidates with, so all of them
+        # are sent
+        assert(fq.startswith("{!terms f=id}"))
+        result = helpers.call_action("package_search", fq=fq)
+        assert(result["count"] == 2)
+
+    @pytest.mark.usefixtures('clean_postgis', 'clean_db', 'clean_index', 'harvest_setup', 'spatial_setup')
+    def test_spatial_query_envelope_overflow(self):
+        for title in ("Rivers", "Roads"):
+            factories.Dataset(
+                title=title,
+                extras=[{"key": "spatial", "value": extents["nz"]}]
+            )
+
+        fq = self._overflow_search(self._overflow_backend("envelope"), q="Rivers")
+
+        # Searching with it requires the envelope fields in the Solr schema
+        assert(fq == "+minx:[* TO 189.0] +maxx:[56.0 TO *] "
+                     "+miny:[* TO -28.0] +maxy:[-54.0 TO *]")
+
+    def test_envelope_indexed_only_if_configured(self):
+        pkg_dict = {"extras_spatial": extents["nz"]}
+
+        assert("minx" not in self._overflow_backend().index(dict(pkg_dict)))
+        indexed = self._overflow_backend("envelope").index(dict(pkg_dict))
+        assert(indexed["minx"] < indexed["maxx"])
+
+    @pytest.mark.usefixtures('clean_postgis', 'clean_db', 'clean_index', 'harvest_setup', 'spatial_setup')
+    def test_spatial_query_memory_backend(self, monkeypatch):
+        from ckanext.spatial.plugin import SpatialQuery
+        from ckanext.spatial.lib import memory_index
+        from ckanext.spatial.search_backends import get_search_backend
+        monkeypatch.setattr(memory_index, "_memory_index", None)
+        monkeypatch.setattr(SpatialQuery(), "backend", get_search_backend("memory"))
+
+        dataset = factories.Dataset(
+            extras=[{"key": "spatial", "value": extents["nz"]}]
+        )
+        factories.Dataset(
+            extras=[{"key": "spatial", "value": extents["ohio"]}]
+        )
+
+        result = helpers.call_action(
+            "package_search", extras={"ext_bbox": "56,-54,189,-28"}
+        )
+
+        assert(result["count"] == 1)
+        assert(result["results"][0]["id"] == dataset["id"])
+
+    def test_unknown_search_backend(self):
+        from ckanext.spatial.search_backends import get_search_backend
+        with pytest.raises(ValueError):
+            get_search_backend("not-a-backend")
+
 
 @pytest.mark.usefixtures('with_plugins', 'clean_postgis', 'clean_db', 'clean_index', 'harvest_setup', 'spatial_setup')
 class TestHarvestedMetadataAPI(SpatialTestBase):
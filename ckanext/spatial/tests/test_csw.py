@@ -0,0 +1,370 @@
+import os
+import json
+import datetime
+
+import pytest
+
+from ckan import model
+
+from ckanext.harvest.model import HarvestSource, HarvestJob, HarvestObject
+
+import ckanext.spatial.harvesters.csw as csw_harvester
+from ckanext.spatial.harvesters.csw import CSWHarvester
+from ckanext.spatial.lib.csw_client import CswError
+from ckanext.spatial.model import CswListing
+
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+
+def _record(guid):
+    with open(os.path.join(here, "xml", "iso19139", "dataset.xml")) as f:
+        return f.read().replace("<gmd:MD_Metadata", "<!-- %s -->\n<gmd:MD_Metadata" % guid, 1)
+
+
+class FakeCswService(object):
+    '''
+    Lists the provided records in pages, like `CswService` does, failing
+    once the listing reaches the `fail_at` position. Only the `modified`
+    records are listed when the modified ones are requested.
+    '''
+
+    def __init__(self, guids, fail_at=None, modified=None):
+        self.records = [(guid, _record(guid)) for guid in guids]
+        self.fail_at = fail_at
+        self.modified = modified
+        self.listings = []
+        self.fetched = []
+
+    def _pages(self, startposition=0, page=10, progress=None,
+               modified_since=None, **kwargs):
+        self.listings.append(
+            {"startposition": startposition, "modified_since": modified_since}
+        )
+        records = self.records
+        if modified_since and self.modified is not None:
+            records = [(guid, xml) for guid, xml in records if guid in self.modified]
+        for start in range(startposition, len(records), page):
+            if self.fail_at is not None and start >= self.fail_at:
+                raise CswError("Error getting identifiers")
+            yield records[start:start + page]
+            if progress:
+                progress(start + page)
+
+    def getidentifiers(self, **kwargs):
+        for records in self._pages(**kwargs):
+            for guid, xml in records:
+                yield guid
+
+    def getrecordsfull(self, **kwargs):
+        for records in self._pages(**kwargs):
+            for guid, xml in records:
+                yield guid, xml
+
+    def getrecordbyid(self, ids, **kwargs):
+        self.fetched.extend(ids)
+        return {"xml": dict(self.records)[ids[0]]}
+
+
+@pytest.fixture
+def csw_service(monkeypatch):
+    services = []
+
+    def set_service(service):
+        services.append(service)
+        monkeypatch.setattr(csw_harvester, "get_csw_service", lambda url: services[-1])
+        return service
+
+    return set_service
+
+
+def _create_job(source=None, gather_started=None, **source_config):
+    if source is None:
+        source = HarvestSource(url=u"http://csw.example.com/csw", type=u"csw")
+    source.config = json.dumps(source_config)
+    source.save()
+    job = HarvestJob(source=source, gather_started=gather_started)
+    job.save()
+    return job
+
+
+def _finish_job(job, failed=()):
+    '''
+    Marks the objects of a job as imported (or as failed, for the `failed`
+    guids), as the fetch and import stages would
+    '''
+    for obj in model.Session.query(HarvestObject).filter_by(harvest_job_id=job.id):
+        if obj.guid in failed:
+            obj.state = u"ERROR"
+        else:
+            obj.state = u"COMPLETE"
+            obj.current = True
+    job.status = u"Finished"
+    model.Session.commit()
+
+
+def _objects(ids):
+    return [HarvestObject.get(id) for id in ids]
+
+
+def _extras(obj):
+    return dict((extra.key, extra.value) for extra in obj.extras)
+
+
+@pytest.mark.usefixtures('with_plugins', 'clean_db', 'clean_index', 'harvest_setup', 'spatial_setup')
+class TestBulkFetch(object):
+    def test_gather_stores_the_records(self, csw_service):
+        service = csw_service(FakeCswService(["a", "b", "c"]))
+        job = _create_job(bulk_fetch=True, page_size=2)
+
+        objects = _objects(CSWHarvester().gather_stage(job))
+
+        assert sorted(obj.guid for obj in objects) == ["a", "b", "c"]
+        for obj in objects:
+            assert "<!-- %s -->" % obj.guid in obj.content
+            assert not obj.content.startswith("<?xml")
+            assert _extras(obj) == {"status": "new", "bulk_fetched": "true"}
+        assert service.listings == [{"startposition": 0, "modified_since": None}]
+
+    def test_fetch_skips_the_records_fetched_in_bulk(self, csw_service):
+        service = csw_service(FakeCswService(["a"]))
+        job = _create_job(bulk_fetch=True)
+        harvester = CSWHarvester()
+        obj = _objects(harvester.gather_stage(job))[0]
+        content = obj.content
+
+        assert harvester.fetch_stage(obj) is True
+        assert service.fetched == []
+        assert obj.content == content
+
+    def test_gather_without_bulk_fetch(self, csw_service):
+        service = csw_service(FakeCswService(["a", "b"]))
+        job = _create_job()
+        harvester = CSWHarvester()
+
+        objects = _objects(harvester.gather_stage(job))
+
+        for obj in objects:
+            assert obj.content is None
+            assert _extras(obj) == {"status": "new"}
+            assert harvester.fetch_stage(obj) is True
+            assert "<!-- %s -->" % obj.guid in obj.content
+        assert sorted(service.fetched) == ["a", "b"]
+
+    def test_fetch_requests_content_not_fetched_in_bulk(self, csw_service):
+        service = csw_service(FakeCswService(["a"]))
+        job = _create_job()
+        harvester = CSWHarvester()
+        obj = _objects(harvester.gather_stage(job))[0]
+        # eg left by a previous attempt of the fetch stage
+        obj.content = u"<stale/>"
+        obj.save()
+
+        assert harvester.fetch_stage(obj) is True
+        assert service.fetched == ["a"]
+        assert "<!-- a -->" in obj.content
+
+
+@pytest.mark.usefixtures('with_plugins', 'clean_db', 'clean_index', 'harvest_setup', 'spatial_setup')
+class TestIncremental(object):
+    started = datetime.datetime(2020, 1, 1, 10, 0, 0)
+
+    def _run_job(self, harvester, source=None, gather_started=None, **source_config):
+        source_config.setdefault("incremental", True)
+        job = _create_job(source, gather_started, **source_config)
+        return job, _objects(harvester.gather_stage(job) or [])
+
+    def test_first_listing_is_full(self, csw_service):
+        service = csw_service(FakeCswService(["a", "b"]))
+
+        job, objects = self._run_job(CSWHarvester(), gather_started=self.started)
+
+        assert service.listings[0]["modified_since"] is None
+        assert sorted(obj.guid for obj in objects) == ["a", "b"]
+        listing = CswListing.get(job.source_id)
+        assert listing.last_listing == self.started
+        assert listing.last_full_listing == self.started
+
+    def test_modified_since_last_listing(self, csw_service):
+        harvester = CSWHarvester()
+        service = csw_service(FakeCswService(["a", "b", "c"], modified=["b"]))
+        now = datetime.datetime.utcnow().replace(microsecond=0)
+        job, objects = self._run_job(harvester, gather_started=now - datetime.timedelta(hours=1))
+        _finish_job(job)
+
+        job, objects = self._run_job(harvester, job.source, now)
+
+        assert service.listings[1]["modified_since"] == \
+            (now - datetime.timedelta(hours=1)).strftime("%Y-%m-%dT%H:%M:%SZ")
+        # the records not listed are not deleted
+        assert [(obj.guid, _extras(obj)["status"]) for obj in objects] == [("b", "change")]
+        listing = CswListing.get(job.source_id)
+        assert listing.last_listing == now
+        assert listing.last_full_listing == now - datetime.timedelta(hours=1)
+
+    def test_full_listing_after_interval(self, csw_service):
+        harvester = CSWHarvester()
+        service = csw_service(FakeCswService(["a", "b"], modified=[]))
+        now = datetime.datetime.utcnow().replace(microsecond=0)
+        job, objects = self._run_job(
+            harvester, gather_started=now - datetime.timedelta(days=8))
+        _finish_job(job)
+
+        job, objects = self._run_job(harvester, job.source, now, full_listing_interval=7)
+
+        assert service.listings[1]["modified_since"] is None
+        assert sorted(obj.guid for obj in objects) == ["a", "b"]
+        assert CswListing.get(job.source_id).last_full_listing == now
+
+    def test_failed_records_listed_again(self, csw_service):
+        harvester = CSWHarvester()
+        service = csw_service(FakeCswService(["a", "b", "c"], modified=["c"]))
+        now = datetime.datetime.utcnow().replace(microsecond=0)
+        job, objects = self._run_job(harvester, gather_started=now - datetime.timedelta(hours=1))
+        _finish_job(job, failed=["a"])
+
+        job, objects = self._run_job(harvester, job.source, now)
+
+        assert service.listings[1]["modified_since"] is not None
+        assert sorted(obj.guid for obj in objects) == ["a", "c"]
+
+    def test_failed_records_listed_again_in_bulk(self, csw_service):
+        harvester = CSWHarvester()
+        service = csw_service(FakeCswService(["a", "b", "c"], modified=["c"]))
+        now = datetime.datetime.utcnow().replace(microsecond=0)
+        job, objects = self._run_job(
+            harvester, gather_started=now - datetime.timedelta(hours=1), bulk_fetch=True)
+        _finish_job(job, failed=["a"])
+
+        job, objects = self._run_job(harvester, job.source, now, bulk_fetch=True)
+
+        objects = dict((obj.guid, obj) for obj in objects)
+        assert sorted(objects.keys()) == ["a", "c"]
+        assert objects["c"].content
+        # the content of the failed record is requested on the fetch stage
+        assert objects["a"].content is None
+        assert harvester.fetch_stage(objects["a"]) is True
+        assert service.fetched == ["a"]
+
+    def test_failed_listing_does_not_advance(self, csw_service):
+        harvester = CSWHarvester()
+        csw_service(FakeCswService(["a", "b", "c"]))
+        now = datetime.datetime.utcnow().replace(microsecond=0)
+        first_started = now - datetime.timedelta(hours=2)
+        job, objects = self._run_job(harvester, gather_started=first_started)
+        _finish_job(job)
+
+        csw_service(FakeCswService(["a", "b", "c"], fail_at=0))
+        job, objects = self._run_job(harvester, job.source, now - datetime.timedelta(hours=1))
+        assert objects == []
+
+        service = csw_service(FakeCswService(["a", "b", "c"], modified=["a"]))
+        job, objects = self._run_job(harvester, job.source, now)
+
+        assert service.listings[0]["modified_since"] == \
+            first_started.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+@pytest.mark.usefixtures('with_plugins', 'clean_db', 'clean_index', 'harvest_setup', 'spatial_setup')
+class TestResume(object):
+    guids = ["a", "b", "c", "d", "e"]
+
+    def _run_job(self, harvester, source=None, gather_started=None, **source_config):
+        source_config.setdefault("page_size", 2)
+        source_config.setdefault("max_page_size", 2)
+        if gather_started is None:
+            gather_started = datetime.datetime.utcnow()
+        job = _create_job(source, gather_started, **source_config)
+        return job, _objects(harvester.gather_stage(job) or [])
+
+    def test_failed_listing(self, csw_service):
+        csw_service(FakeCswService(self.guids, fail_at=2))
+
+        job, objects = self._run_job(CSWHarvester())
+
+        # the records listed before the error are harvested
+        assert sorted(obj.guid for obj in objects) == ["a", "b"]
+        assert len(job.gather_errors) == 1
+        state = CswListing.get(job.source_id)
+        assert state.checkpoint_position == 2
+        assert state.checkpoint_started == job.gather_started
+        assert state.last_listing is None
+
+    def test_resume(self, csw_service):
+        harvester = CSWHarvester()
+        csw_service(FakeCswService(self.guids, fail_at=2))
+        job, objects = self._run_job(harvester)
+        _finish_job(job)
+        first_started = job.gather_started
+
+        service = csw_service(FakeCswService(self.guids))
+        job, objects = self._run_job(harvester, job.source)
+
+        assert service.listings == [{"startposition": 2, "modified_since": None}]
+        assert sorted(obj.guid for obj in objects) == ["c", "d", "e"]
+        # the records harvested by the previous job are not deleted
+        assert all(_extras(obj)["status"] == "new" for obj in objects)
+        state = CswListing.get(job.source_id)
+        assert state.checkpoint_listing is None
+        assert state.last_full_listing == first_started
+
+    def test_resume_deletes_records_once_complete(self, csw_service):
+        harvester = CSWHarvester()
+        csw_service(FakeCswService(self.guids + ["x"]))
+        job, objects = self._run_job(harvester)
+        _finish_job(job)
+
+        csw_service(FakeCswService(self.guids, fail_at=2))
+        job, objects = self._run_job(harvester, job.source)
+        assert not [obj for obj in objects if _extras(obj)["status"] == "delete"]
+        _finish_job(job)
+
+        csw_service(FakeCswService(self.guids))
+        job, objects = self._run_job(harvester, job.source)
+
+        assert sorted((obj.guid, _extras(obj)["status"]) for obj in objects) == [
+            ("c", "change"), ("d", "change"), ("e", "change"), ("x", "delete")]
+
+    def test_resume_bulk(self, csw_service):
+        harvester = CSWHarvester()
+        csw_service(FakeCswService(self.guids, fail_at=2))
+        job, objects = self._run_job(harvester, bulk_fetch=True)
+        assert all(obj.content for obj in objects)
+        _finish_job(job)
+
+        service = csw_service(FakeCswService(self.guids))
+        job, objects = self._run_job(harvester, job.source, bulk_fetch=True)
+
+        assert service.listings[0]["startposition"] == 2
+        assert sorted(obj.guid for obj in objects) == ["c", "d", "e"]
+        for obj in objects:
+            assert _extras(obj)["bulk_fetched"] == "true"
+            assert harvester.fetch_stage(obj) is True
+        assert service.fetched == []
+
+    def test_config_change_invalidates_checkpoint(self, csw_service):
+        harvester = CSWHarvester()
+        csw_service(FakeCswService(self.guids, fail_at=2))
+        job, objects = self._run_job(harvester)
+        _finish_job(job)
+
+        service = csw_service(FakeCswService(self.guids))
+        job, objects = self._run_job(harvester, job.source, cql="dc:type = 'dataset'")
+
+        assert service.listings[0]["startposition"] == 0
+        assert sorted(obj.guid for obj in objects) == self.guids
+
+    def test_old_checkpoint_ignored(self, csw_service):
+        harvester = CSWHarvester()
+        csw_service(FakeCswService(self.guids, fail_at=2))
+        job, objects = self._run_job(harvester)
+        _finish_job(job)
+        state = CswListing.get(job.source_id)
+        state.checkpoint_saved -= datetime.timedelta(days=2)
+        state.save()
+
+        service = csw_service(FakeCswService(self.guids))
+        job, objects = self._run_job(harvester, job.source)
+
+        assert service.listings[0]["startposition"] == 0
+        assert sorted(obj.guid for obj in objects) == self.guids
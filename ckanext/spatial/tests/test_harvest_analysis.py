@@ -0,0 +1,57 @@
+import os
+from multiprocessing import Pool
+
+from ckanext.spatial.harvesters.base import analyse_document, _analyse_document
+from ckanext.spatial.model import ISODocument
+from ckanext.spatial.validation import Validators
+
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+
+def _read(file_name):
+    with open(os.path.join(here, "xml", file_name)) as f:
+        # Remove the XML declaration, as lxml does not accept it on text
+        return f.read().split("?>", 1)[1]
+
+
+class TestAnalyseDocument(object):
+    def test_valid(self):
+        content = _read("iso19139/dataset.xml")
+        analysis = analyse_document(content, Validators(profiles=["iso19139"]))
+
+        assert analysis["validation"] == (None, True, None, [])
+        assert analysis["iso_values"] == ISODocument(content).read_values()
+
+    def test_invalid(self):
+        content = _read("iso19139/dataset-invalid.xml")
+        analysis = analyse_document(content, Validators(profiles=["iso19139"]))
+
+        xml_error, valid, profile, errors = analysis["validation"]
+        assert xml_error is None
+        assert not valid
+        assert profile == "iso19139"
+        assert errors
+
+    def test_syntax_error(self):
+        analysis = analyse_document("<gmd:MD_Metadata>", Validators(profiles=["iso19139"]))
+
+        assert analysis["validation"][0]
+        assert "iso_error" in analysis
+
+    def test_process_pool(self):
+        validator = Validators(profiles=["iso19139"])
+        documents = [
+            _read("iso19139/dataset.xml"),
+            _read("iso19139/dataset-invalid.xml"),
+        ]
+
+        pool = Pool(2)
+        try:
+            results = pool.map(
+                _analyse_document, [(content, validator) for content in documents]
+            )
+        finally:
+            pool.terminate()
+
+        assert results == [analyse_document(content, validator) for content in documents]
@@ -0,0 +1,375 @@
+import os
+import json
+
+import pytest
+
+from ckan import model
+import ckan.tests.factories as factories
+import ckan.tests.helpers as helpers
+
+from ckanext.harvest.model import HarvestSource, HarvestJob, HarvestObject
+from ckanext.harvest.model import HarvestObjectExtra as HOExtra
+from ckanext.harvest.model import HarvestObjectError
+
+import ckanext.spatial.harvesters.base as harvester_base
+from ckanext.spatial.harvesters.base import SpatialHarvester, content_digest
+from ckanext.spatial.model import IndexQueueEntry
+
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+
+def _read(file_name):
+    with open(os.path.join(here, "xml", file_name)) as f:
+        # Remove the XML declaration, as the harvesters do
+        return f.read().split("?>", 1)[1].strip()
+
+
+@pytest.fixture
+def harvester():
+    harvester = SpatialHarvester()
+    # The validator is kept by the harvester for the source configuration
+    # of the first object imported
+    harvester.__dict__.pop("_validator", None)
+    yield harvester
+    harvester.__dict__.pop("_validator", None)
+
+
+@pytest.fixture
+def source():
+    source = HarvestSource(
+        url=u"http://example.com/csw", type=u"csw",
+        config=json.dumps({"validator_profiles": ["iso19139"]})
+    )
+    source.save()
+    return source
+
+
+def _create_object(source, content, status="new", guid=u"test-dataset-1",
+                   extras=None, job=None, **kwargs):
+    if job is None:
+        job = HarvestJob(source=source)
+        job.save()
+    extras = dict(extras or {}, status=status)
+    obj = HarvestObject(
+        guid=guid, job=job, source=source, content=content,
+        extras=[HOExtra(key=key, value=value) for key, value in extras.items()],
+        **kwargs
+    )
+    obj.save()
+    return obj
+
+
+def _import(harvester, obj):
+    '''
+    Runs the import stage and updates the state of the object, as the
+    harvest queue does
+    '''
+    success = harvester.import_stage(obj)
+    obj.state = u"COMPLETE" if success else u"ERROR"
+    obj.save()
+    return success
+
+
+def _extras(obj):
+    return dict((extra.key, extra.value) for extra in obj.extras)
+
+
+@pytest.mark.usefixtures('with_plugins', 'clean_db', 'clean_index', 'harvest_setup', 'spatial_setup')
+class TestContentDigest(object):
+    def test_digest_stored_on_import(self, harvester, source):
+        content = _read("iso19139/dataset.xml")
+        obj = _create_object(source, content)
+
+        assert _import(harvester, obj)
+
+        assert obj.current
+        assert _extras(obj)["content_digest"] == content_digest(content)
+
+    def test_same_content_skipped(self, harvester, source):
+        content = _read("iso19139/dataset.xml")
+        first = _create_object(source, content)
+        assert _import(harvester, first)
+        first_job_id = first.harvest_job_id
+        package = model.Package.get(first.package_id)
+        metadata_modified = package.metadata_modified
+
+        second = _create_object(source, content, status="change",
+                                package_id=first.package_id)
+        assert _import(harvester, second)
+
+        assert second.current
+        assert _extras(second)["content_digest"] == content_digest(content)
+        # The previous object is replaced and the dataset left untouched
+        assert second.harvest_job_id == first_job_id
+        assert model.Session.query(HarvestObject).filter_by(
+            guid=u"test-dataset-1").count() == 1
+        assert model.Package.get(first.package_id).metadata_modified == metadata_modified
+
+    def test_failed_import_not_digested(self, harvester, source):
+        obj = _create_object(source, _read("iso19139/dataset-invalid.xml"),
+                             guid=u"test-dataset")
+
+        assert not _import(harvester, obj)
+
+        assert "content_digest" not in _extras(obj)
+
+    def test_same_content_as_failed_object_imported(self, harvester, source):
+        content = _read("iso19139/dataset-invalid.xml")
+        # A current object whose import failed, eg if the dataset could not
+        # be updated
+        _create_object(
+            source, content, guid=u"test-dataset", current=True, state=u"ERROR",
+            extras={"content_digest": content_digest(content)})
+
+        obj = _create_object(source, content, status="change", guid=u"test-dataset")
+
+        # The document is validated again instead of being skipped
+        assert not _import(harvester, obj)
+        assert obj.errors
+
+
+def _other_dataset(content):
+    return content.replace("test-dataset-1", "test-dataset-2") \
+        .replace("Country Parks (Scotland)", "Country Parks (Wales)")
+
+
+def _queued(source):
+    return sorted(entry.package_id for entry in model.Session.query(IndexQueueEntry)
+                  .filter_by(harvest_source_id=source.id))
+
+
+def _indexed(package_id):
+    return helpers.call_action("package_search", fq="id:%s" % package_id)["count"]
+
+
+@pytest.fixture
+def failing_create(monkeypatch):
+    '''
+    Makes package_create fail for the Wales dataset after writing it
+    '''
+    get_action = harvester_base.p.toolkit.get_action
+
+    def failing_get_action(name):
+        action = get_action(name)
+        if name != "package_create":
+            return action
+
+        def package_create(context, data_dict):
+            result = action(context, data_dict)
+            if data_dict["title"] == "Country Parks (Wales)":
+                raise harvester_base.p.toolkit.ValidationError({"name": ["Failed"]})
+            return result
+        return package_create
+
+    monkeypatch.setattr(harvester_base.p.toolkit, "get_action", failing_get_action)
+
+
+@pytest.mark.usefixtures('with_plugins', 'clean_db', 'clean_index', 'harvest_setup', 'spatial_setup')
+class TestImportObjects(object):
+    def test_failing_object_rolled_back(self, harvester, source, failing_create):
+        content = _read("iso19139/dataset.xml")
+        first = _create_object(source, content)
+        failing = _create_object(source, _other_dataset(content), guid=u"test-dataset-2")
+        last = _create_object(source, _read("iso19139/dataset-invalid.xml"),
+                              guid=u"test-dataset")
+
+        assert harvester.import_objects([first, failing, last]) == 1
+
+        assert first.state == u"COMPLETE"
+        assert model.Package.get(first.package_id).title == u"Country Parks (Scotland)"
+        # The dataset written before the failure is rolled back with the
+        # rest of the changes of the object
+        assert failing.state == u"ERROR"
+        assert not failing.package_id
+        assert not failing.current
+        assert not model.Session.query(model.Package).filter_by(
+            title=u"Country Parks (Wales)").count()
+        assert last.state == u"ERROR"
+
+    def test_errors_saved_after_commit(self, harvester, source, failing_create):
+        content = _read("iso19139/dataset.xml")
+        failing = _create_object(source, _other_dataset(content), guid=u"test-dataset-2")
+        invalid = _create_object(source, _read("iso19139/dataset-invalid.xml"),
+                                 guid=u"test-dataset")
+
+        harvester.import_objects([failing, invalid])
+        # Anything not committed is lost
+        model.Session.rollback()
+
+        for obj in (failing, invalid):
+            assert model.Session.query(HarvestObjectError).filter_by(
+                harvest_object_id=obj.id, stage=u"Import").count()
+        assert failing.state == invalid.state == u"ERROR"
+
+    def test_delete_ends_savepoint(self, harvester, source):
+        content = _read("iso19139/dataset.xml")
+        first = _create_object(source, content)
+        assert _import(harvester, first)
+
+        # package_delete commits the session, which ends the savepoint of
+        # the object before the chunk is done
+        deleted = _create_object(source, None, status="delete",
+                                 package_id=first.package_id)
+        invalid = _create_object(source, _read("iso19139/dataset-invalid.xml"),
+                                 guid=u"test-dataset")
+
+        assert harvester.import_objects([deleted, invalid]) == 1
+
+        assert deleted.state == u"COMPLETE"
+        assert model.Package.get(first.package_id).state == u"deleted"
+        assert invalid.state == u"ERROR"
+        assert invalid.errors
+
+    def test_chunks_read_in_turn(self, harvester, source):
+        content = _read("iso19139/dataset.xml")
+        objects = [_create_object(source, content),
+                   _create_object(source, _other_dataset(content), guid=u"test-dataset-2")]
+        read = []
+
+        def harvest_objects():
+            for obj in objects:
+                read.append(obj)
+                yield obj
+
+        chunks = []
+        import_chunk = harvester._import_chunk
+
+        def record_chunk(chunk, pool=None):
+            chunks.append(list(read))
+            return import_chunk(chunk, pool)
+        harvester._import_chunk = record_chunk
+
+        assert harvester.import_objects(harvest_objects(), chunk_size=1) == 2
+        # Each chunk is imported before the next one is read
+        assert chunks == [objects[:1], objects]
+
+    def test_process_pool(self, harvester, source):
+        content = _read("iso19139/dataset.xml")
+        objects = [_create_object(source, content),
+                   _create_object(source, _other_dataset(content), guid=u"test-dataset-2"),
+                   _create_object(source, _read("iso19139/dataset-invalid.xml"),
+                                  guid=u"test-dataset")]
+        analysed = []
+        analyse_objects = harvester._analyse_objects
+
+        def record_analysis(harvest_objects, pool):
+            analysis = analyse_objects(harvest_objects, pool)
+            analysed.extend(analysis.keys())
+            return analysis
+        harvester._analyse_objects = record_analysis
+
+        assert harvester.import_objects(objects, processes=2) == 2
+
+        # The documents are analysed by the pool and the datasets written by
+        # this process, whose connections are left untouched by the pool
+        assert sorted(analysed) == sorted(obj.id for obj in objects)
+        assert [obj.state for obj in objects] == [u"COMPLETE", u"COMPLETE", u"ERROR"]
+        for obj in objects[:2]:
+            assert model.Package.get(obj.package_id).state == u"active"
+            assert _indexed(obj.package_id)
+        assert objects[2].errors
+
+
+@pytest.mark.usefixtures('with_plugins', 'clean_db', 'clean_index', 'harvest_setup', 'spatial_setup')
+class TestDeferredIndexing(object):
+    def test_writes_of_the_session_not_indexed(self):
+        automatic_indexing = harvester_base.config.get("ckan.search.automatic_indexing")
+        with harvester_base._deferred_indexing():
+            deferred = factories.Dataset()
+            # The config is left untouched
+            assert harvester_base.config.get(
+                "ckan.search.automatic_indexing") == automatic_indexing
+        indexed = factories.Dataset()
+
+        assert not _indexed(deferred["id"])
+        assert _indexed(indexed["id"])
+        assert not model.Session().info.get(harvester_base.DEFER_INDEXING)
+
+
+@pytest.mark.usefixtures('with_plugins', 'clean_db', 'clean_index', 'harvest_setup', 'spatial_setup')
+class TestIndexing(object):
+    def test_import_stage_indexes_job_once_done(self, harvester, source):
+        content = _read("iso19139/dataset.xml")
+        job = HarvestJob(source=source)
+        job.save()
+        first = _create_object(source, content, job=job)
+        second = _create_object(source, _other_dataset(content),
+                                guid=u"test-dataset-2", job=job)
+
+        assert _import(harvester, first)
+
+        # Queued until the rest of the objects of the job are imported
+        assert not _indexed(first.package_id)
+        assert _queued(source) == [first.package_id]
+
+        assert _import(harvester, second)
+
+        assert _indexed(first.package_id)
+        assert _indexed(second.package_id)
+        assert _queued(source) == []
+
+    def test_failed_object_finishes_job(self, harvester, source):
+        job = HarvestJob(source=source)
+        job.save()
+        first = _create_object(source, _read("iso19139/dataset.xml"), job=job)
+        invalid = _create_object(source, _read("iso19139/dataset-invalid.xml"),
+                                 guid=u"test-dataset", job=job)
+
+        assert _import(harvester, first)
+        assert not _indexed(first.package_id)
+
+        assert not _import(harvester, invalid)
+
+        assert _indexed(first.package_id)
+
+    @pytest.mark.ckan_config("ckanext.spatial.harvest.index_batch_size", "1")
+    def test_indexed_when_batch_full(self, harvester, source, ckan_config):
+        content = _read("iso19139/dataset.xml")
+        job = HarvestJob(source=source)
+        job.save()
+        first = _create_object(source, content, job=job)
+        _create_object(source, _other_dataset(content), guid=u"test-dataset-2", job=job)
+
+        assert _import(harvester, first)
+
+        assert _indexed(first.package_id)
+        assert _queued(source) == []
+
+    def test_queue_left_indexed_with_next_job(self, harvester, source, monkeypatch):
+        first = _create_object(source, _read("iso19139/dataset.xml"))
+        # Eg the process stopped before indexing the datasets
+        with monkeypatch.context() as m:
+            m.setattr(harvester, "_flush_index", lambda job_id, source_id: None)
+            assert _import(harvester, first)
+        assert _queued(source) == [first.package_id]
+        assert not _indexed(first.package_id)
+
+        second = _create_object(source, _other_dataset(_read("iso19139/dataset.xml")),
+                                guid=u"test-dataset-2")
+        assert _import(harvester, second)
+
+        assert _indexed(first.package_id)
+        assert _indexed(second.package_id)
+        assert _queued(source) == []
+
+    def test_import_objects_indexes_chunk(self, harvester, source):
+        content = _read("iso19139/dataset.xml")
+        objects = [_create_object(source, content),
+                   _create_object(source, _other_dataset(content), guid=u"test-dataset-2")]
+
+        assert harvester.import_objects(objects, chunk_size=1) == 2
+
+        for obj in objects:
+            assert _indexed(obj.package_id)
+
+    def test_import_objects_removes_deleted(self, harvester, source):
+        first = _create_object(source, _read("iso19139/dataset.xml"))
+        assert _import(harvester, first)
+        assert _indexed(first.package_id)
+
+        deleted = _create_object(source, None, status="delete",
+                                 package_id=first.package_id)
+        assert harvester.import_objects([deleted]) == 1
+
+        assert not _indexed(first.package_id)
@@ -0,0 +1,78 @@
+import pytest
+
+import ckanext.spatial.harvesters.base as harvester_base
+from ckanext.spatial.harvesters.base import SpatialHarvester
+
+
+LICENSES = [
+    {"id": "CC-BY-4.0", "url": "https://creativecommons.org/licenses/by/4.0/"},
+    {"id": "odc-odbl", "url": "http://www.opendefinition.org/licenses/odc-odbl"},
+    {"id": "other-open", "url": ""},
+    # Same URL as the first one
+    {"id": "cc-by", "url": "https://creativecommons.org/licenses/by/4.0/"},
+]
+
+
+@pytest.fixture
+def license_list(monkeypatch):
+    calls = []
+
+    def get_action(name):
+        assert name == "license_list"
+
+        def license_list(context, data_dict):
+            calls.append(context)
+            return LICENSES
+        return license_list
+
+    monkeypatch.setattr(harvester_base, "_license_index", None)
+    monkeypatch.setattr(harvester_base.p.toolkit, "get_action", get_action)
+    return calls
+
+
+@pytest.fixture
+def harvester(monkeypatch):
+    harvester = SpatialHarvester()
+    monkeypatch.setattr(harvester, "_user_name", "harvest")
+    return harvester
+
+
+class TestLicenseIndex(object):
+    def test_lookup(self, harvester, license_list):
+        index = harvester._get_license_index()
+
+        assert index["cc-by-4.0"] == "CC-BY-4.0"
+        assert index["https://creativecommons.org/licenses/by/4.0/"] == "CC-BY-4.0"
+        assert index["http://www.opendefinition.org/licenses/odc-odbl"] == "odc-odbl"
+        assert index["other-open"] == "other-open"
+        assert "" not in index
+
+    def test_lookup_case_insensitive(self, harvester, license_list):
+        index = harvester._get_license_index()
+
+        for constraint in ("ODC-ODBL", "HTTP://WWW.OPENDEFINITION.ORG/LICENSES/ODC-ODBL"):
+            assert index.get(constraint.lower()) == "odc-odbl"
+
+    def test_first_license_wins(self, harvester, license_list):
+        index = harvester._get_license_index()
+
+        assert index["https://creativecommons.org/licenses/by/4.0/"] == "CC-BY-4.0"
+        assert index["cc-by"] == "cc-by"
+
+    def test_built_once(self, harvester, license_list):
+        harvester._get_license_index()
+        harvester._get_license_index()
+        SpatialHarvester()._get_license_index()
+
+        assert len(license_list) == 1
+
+    def test_rebuilt_when_licenses_group_url_changes(
+            self, harvester, license_list, monkeypatch):
+        monkeypatch.setitem(harvester_base.config, "licenses_group_url", "file:///a.json")
+        harvester._get_license_index()
+        harvester._get_license_index()
+
+        monkeypatch.setitem(harvester_base.config, "licenses_group_url", "file:///b.json")
+        harvester._get_license_index()
+
+        assert len(license_list) == 2
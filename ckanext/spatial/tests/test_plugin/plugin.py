@@ -1,5 +1,8 @@
 from ckan import plugins as p
 
+from ckanext.spatial.interfaces import ISpatialSearchBackend
+from ckanext.spatial.search_backends import IdsSearchBackend
+
 
 class TestSpatialPlugin(p.SingletonPlugin):
 
@@ -7,3 +10,20 @@ class TestSpatialPlugin(p.SingletonPlugin):
 
     def update_config(self, config):
         p.toolkit.add_template_directory(config, "templates")
+
+
+class TestSearchBackendPlugin(p.SingletonPlugin, IdsSearchBackend):
+    '''
+    Spatial search backend provided by a plugin, named `test-backend`
+    unless `backend_name` is changed
+    '''
+
+    p.implements(ISpatialSearchBackend)
+
+    backend_name = "test-backend"
+
+    def ids(self, bbox):
+        return []
+
+    def rank(self, bbox, limit=None, offset=0):
+        return []
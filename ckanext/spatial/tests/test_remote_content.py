@@ -0,0 +1,130 @@
+import os
+import email.utils
+
+import pytest
+
+from ckanext.harvest.model import HarvestObject
+from ckanext.harvest.model import HarvestObjectExtra as HOExtra
+
+from ckanext.spatial.harvesters.base import SpatialHarvester
+from ckanext.spatial.tests import xml_file_server
+
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+DOCUMENT = "iso19139/dataset.xml"
+
+
+@pytest.fixture(scope="module")
+def xml_server():
+    if not getattr(xml_file_server, "started", False):
+        xml_file_server.serve()
+        xml_file_server.started = True
+    return "http://127.0.0.1:%i/" % xml_file_server.PORT
+
+
+def _last_modified(path):
+    mtime = os.path.getmtime(os.path.join(here, "xml", path))
+    return email.utils.formatdate(mtime, usegmt=True)
+
+
+def _object(content=None, **extras):
+    return HarvestObject(
+        guid=u"test", content=content,
+        extras=[HOExtra(key=key, value=value) for key, value in extras.items()]
+    )
+
+
+def _extras(obj):
+    return dict((extra.key, extra.value) for extra in obj.extras)
+
+
+class TestGetRemoteContent(object):
+    def test_content_and_validators(self, xml_server):
+        content, validators = SpatialHarvester()._get_remote_content(
+            xml_server + DOCUMENT)
+
+        assert content.startswith("<gmd:MD_Metadata")
+        assert validators == {"http_last_modified": _last_modified(DOCUMENT)}
+
+    def test_not_modified(self, xml_server):
+        previous_object = _object(
+            u"<gmd:MD_Metadata/>", http_last_modified=_last_modified(DOCUMENT))
+
+        content, validators = SpatialHarvester()._get_remote_content(
+            xml_server + DOCUMENT, previous_object)
+
+        assert content is None
+        assert validators == {"http_last_modified": _last_modified(DOCUMENT)}
+
+    def test_modified(self, xml_server):
+        previous_object = _object(
+            u"<gmd:MD_Metadata/>", http_last_modified="Thu, 01 Jan 1970 00:00:00 GMT")
+
+        content, validators = SpatialHarvester()._get_remote_content(
+            xml_server + DOCUMENT, previous_object)
+
+        assert content.startswith("<gmd:MD_Metadata")
+
+    def test_previous_object_without_content(self, xml_server):
+        # The document is requested again if there is no content to reuse
+        previous_object = _object(http_last_modified=_last_modified(DOCUMENT))
+
+        content, validators = SpatialHarvester()._get_remote_content(
+            xml_server + DOCUMENT, previous_object)
+
+        assert content.startswith("<gmd:MD_Metadata")
+
+    def test_conditional_headers(self, monkeypatch):
+        requests = []
+
+        class Response(object):
+            status_code = 304
+            headers = {"etag": '"v1"'}
+
+        def get(url, **kwargs):
+            requests.append(kwargs["headers"])
+            return Response()
+
+        harvester = SpatialHarvester()
+        monkeypatch.setattr(harvester, "_http_get", get)
+        previous_object = _object(
+            u"<gmd:MD_Metadata/>", http_etag='"v1"',
+            http_last_modified="Thu, 01 Jan 1970 00:00:00 GMT")
+
+        content, validators = harvester._get_remote_content(
+            "http://example.com/doc.xml", previous_object)
+
+        assert requests == [{
+            "If-None-Match": '"v1"',
+            "If-Modified-Since": "Thu, 01 Jan 1970 00:00:00 GMT",
+        }]
+        assert content is None
+        assert validators == {"http_etag": '"v1"'}
+
+
+class TestReusePreviousContent(object):
+    def test_reuse(self):
+        previous_object = _object(
+            u"<gmd:MD_Metadata/>",
+            status="change",
+            original_document=u"<original/>",
+            original_format="fgdc",
+            http_etag='"v1"',
+            http_last_modified="Thu, 01 Jan 1970 00:00:00 GMT",
+            content_digest="abc",
+        )
+        harvest_object = _object(status="change")
+
+        SpatialHarvester()._reuse_previous_content(
+            harvest_object, previous_object, {"http_etag": '"v2"'})
+
+        assert harvest_object.content == u"<gmd:MD_Metadata/>"
+        assert _extras(harvest_object) == {
+            "status": "change",
+            "unchanged": "true",
+            "original_document": u"<original/>",
+            "original_format": "fgdc",
+            "http_etag": '"v2"',
+            "http_last_modified": "Thu, 01 Jan 1970 00:00:00 GMT",
+        }
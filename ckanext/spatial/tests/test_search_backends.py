@@ -0,0 +1,30 @@
+import pytest
+
+from ckan import plugins as p
+
+from ckanext.spatial.search_backends import (
+    get_search_backend,
+    MemorySearchBackend,
+    PostgisSearchBackend,
+)
+from ckanext.spatial.tests.test_plugin import plugin as test_plugin
+
+
+@pytest.mark.ckan_config("ckan.plugins", "test_spatial_search_backend")
+@pytest.mark.usefixtures("with_plugins")
+class TestPluginSearchBackend(object):
+    def test_resolved_by_name(self):
+        backend = get_search_backend("test-backend")
+
+        assert backend is p.get_plugin("test_spatial_search_backend")
+        assert backend.ids({"minx": 0, "miny": 0, "maxx": 1, "maxy": 1}) == []
+
+    def test_overrides_built_in(self, monkeypatch):
+        assert isinstance(get_search_backend("postgis"), PostgisSearchBackend)
+
+        monkeypatch.setattr(test_plugin.TestSearchBackendPlugin, "backend_name", "postgis")
+
+        assert get_search_backend("postgis") is p.get_plugin("test_spatial_search_backend")
+        # The rest of the built-in backends are still available
+        assert isinstance(get_search_backend("memory"), MemorySearchBackend)
+
@@ -0,0 +1,149 @@
+import pytest
+
+from ckan.lib.helpers import json
+
+from ckanext.spatial import search_backends
+from ckanext.spatial.plugin import SpatialQuery
+
+
+class MockSolrResponse(object):
+    def __init__(self, docs):
+        self.docs = docs
+
+
+class TestGetPackagesFromIndex(object):
+    @pytest.fixture
+    def plugin(self, monkeypatch):
+        plugin = SpatialQuery()
+        monkeypatch.setattr(plugin, "_index_cache", None, raising=False)
+        return plugin
+
+    @pytest.fixture
+    def solr_queries(self, monkeypatch):
+        queries = []
+
+        def _solr_search(query):
+            queries.append(query)
+            ids = query["fq"][0].split("}", 1)[1].split(",")
+            return MockSolrResponse([
+                {"id": id_, "data_dict": json.dumps({"id": id_, "name": "name-" + id_})}
+                for id_ in ids if id_ != "missing"
+            ])
+
+        monkeypatch.setattr(search_backends, "_solr_search", _solr_search)
+        return queries
+
+    def test_single_request(self, plugin, solr_queries):
+        pkgs = plugin._get_packages_from_index(["a", "b", "c"])
+
+        assert len(solr_queries) == 1
+        assert solr_queries[0]["rows"] == 3
+        assert sorted(pkgs.keys()) == ["a", "b", "c"]
+        assert pkgs["b"]["name"] == "name-b"
+
+    @pytest.mark.ckan_config("ckanext.spatial.use_postgis_sorting", "true")
+    def test_after_search_keeps_ranking_order(self, plugin, solr_queries, ckan_config):
+        search_params = {"extras": {"ext_spatial": [
+            ("c", 0.9), ("missing", 0.8), ("a", 0.5), ("b", 0.1)]}}
+
+        results = plugin.after_search({"results": []}, search_params)
+
+        assert [pkg["id"] for pkg in results["results"]] == ["c", "a", "b"]
+
+    def test_no_cache_by_default(self, plugin, solr_queries):
+        plugin._get_packages_from_index(["a"])
+        plugin._get_packages_from_index(["a"])
+
+        assert len(solr_queries) == 2
+
+    @pytest.mark.ckan_config("ckanext.spatial.postgis_sorting.cache_ttl", "60")
+    def test_cache(self, plugin, solr_queries, ckan_config):
+        plugin._get_packages_from_index(["a", "b"])
+        pkgs = plugin._get_packages_from_index(["b", "c"])
+
+        # Only the package not cached is requested
+        assert len(solr_queries) == 2
+        assert solr_queries[1]["fq"] == ["{!terms f=id}c"]
+        assert sorted(pkgs.keys()) == ["b", "c"]
+
+        # Cached packages are returned as copies
+        pkgs["b"]["name"] = "changed"
+        assert plugin._get_packages_from_index(["b"])["b"]["name"] == "name-b"
+
+    def test_cache_ttl_change(self, plugin, solr_queries, monkeypatch):
+        from ckantoolkit import config
+
+        monkeypatch.setitem(config, "ckanext.spatial.postgis_sorting.cache_ttl", "60")
+        cache = plugin._get_index_cache()
+        assert cache.ttl == 60
+        assert plugin._get_index_cache() is cache
+
+        monkeypatch.setitem(config, "ckanext.spatial.postgis_sorting.cache_ttl", "120")
+        new_cache = plugin._get_index_cache()
+        assert new_cache is not cache
+        assert new_cache.ttl == 120
+
+
+class RankingBackend(search_backends.IdsSearchBackend):
+    def __init__(self, package_ids):
+        self.package_ids = package_ids
+        self.calls = []
+
+    def ids(self, bbox):
+        self.calls.append("ids")
+        return self.package_ids
+
+    def count(self, bbox):
+        self.calls.append("count")
+        return len(self.package_ids)
+
+    def rank(self, bbox, limit=None, offset=0):
+        self.calls.append("rank")
+        return [(package_id, 1.0) for package_id
+                in self.package_ids[offset:offset + limit]]
+
+
+@pytest.mark.ckan_config("ckanext.spatial.use_postgis_sorting", "true")
+@pytest.mark.usefixtures("ckan_config")
+class TestRankedQuery(object):
+    bbox = {"minx": -10, "miny": -10, "maxx": 10, "maxy": 10}
+
+    def _search_params(self):
+        return {"q": "", "fq": "", "sort": "spatial desc", "rows": 2,
+                "start": 2, "extras": {}}
+
+    def test_only_page_built(self):
+        backend = RankingBackend(["a", "b", "c", "d", "e"])
+        backend.max_filter_ids = 3
+
+        search_params = backend.query(self.bbox, self._search_params())
+
+        # The ids within the bbox are not listed, only counted
+        assert backend.calls == ["count", "rank"]
+        assert search_params["extras"]["ext_spatial"] == [("c", 1.0), ("d", 1.0)]
+        assert search_params["extras"]["spatial_count"] == 5
+        assert search_params["fq_list"] == ["{!terms f=id}c,d"]
+        assert search_params["rows"] == 0
+
+    def test_ids_sent_for_the_facets(self):
+        backend = RankingBackend(["a", "b", "c"])
+
+        search_params = backend.query(self.bbox, self._search_params())
+
+        assert backend.calls == ["count", "rank", "ids"]
+        assert search_params["fq_list"] == ["{!terms f=id}a,b,c"]
+
+    def test_no_results(self):
+        backend = RankingBackend([])
+
+        search_params = backend.query(self.bbox, self._search_params())
+
+        assert backend.calls == ["count"]
+        assert search_params["abort_search"]
+
+    def test_after_search_count(self):
+        results = SpatialQuery().after_search(
+            {"results": [], "count": 2},
+            {"extras": {"ext_spatial": [], "spatial_count": 5}})
+
+        assert results["count"] == 5
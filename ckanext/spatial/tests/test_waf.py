@@ -0,0 +1,78 @@
+import os
+
+import pytest
+
+from ckanext.spatial.harvesters.waf import _parse_listing, _parse_waf
+
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+APACHE_TABLE = (
+    '<table><tr><td><a href="/">Parent Directory</a></td>'
+    '<td align="right">  - </td></tr>\n'
+    '<tr><td><a href="record1.xml">record1.xml</a></td>'
+    '<td align="right">2013-03-12 10:21  </td><td align="right">12K</td></tr>\n'
+    '<tr><td><a href="sub/">sub/</a></td>'
+    '<td align="right">2013-03-13 11:05  </td><td align="right"> - </td></tr>'
+    '</table>'
+)
+
+APACHE_PRE = (
+    '<pre><a href="?C=N;O=D">Name</a>  <a href="/">Parent Directory</a>   -\n'
+    '<a href="record1.xml">record1.xml</a>      12-Mar-2013 10:21  1.2K\n'
+    '<a href="sub/">sub/</a>     13-Mar-2013 11:05    -\n</pre>'
+)
+
+IIS = (
+    '<pre><A HREF="/">[To Parent Directory]</A><br><br>'
+    ' 3/12/2013 10:21 AM        12345 <A HREF="/waf/record1.xml">record1.xml</A><br>'
+    ' 3/13/2013 11:05 AM        54321 <A HREF="/waf/record2.xml">record2.xml</A><br></pre>'
+)
+
+
+# The expected results are the ones returned by the pyparsing grammars used
+# previously (see bin/waf_listing_benchmark.py)
+@pytest.mark.parametrize("content,scraper,expected", [
+    (APACHE_TABLE, "apache", [
+        ("/", None),
+        ("record1.xml", "2013-03-12 10:21"),
+        ("sub/", "2013-03-13 11:05"),
+    ]),
+    (APACHE_PRE, "apache", [
+        ("?C=N;O=D", None),
+        ("/", None),
+        ("record1.xml", "12-Mar-2013 10:21"),
+        ("sub/", "13-Mar-2013 11:05"),
+    ]),
+    (IIS, "iis", [
+        ("/waf/record1.xml", "3/12/2013 10:21 AM"),
+        ("/waf/record2.xml", "3/13/2013 11:05 AM"),
+    ]),
+    (APACHE_PRE, "other", [
+        ("?C=N;O=D", None),
+        ("/", None),
+        ("record1.xml", None),
+        ("sub/", None),
+    ]),
+])
+def test_parse_listing(content, scraper, expected):
+    assert _parse_listing(content, scraper) == expected
+
+
+@pytest.mark.parametrize("scraper", ["apache", "iis", "other"])
+def test_parse_listing_fixture(scraper):
+    with open(os.path.join(here, "xml", "gemini2.1-waf", "index.html"), "rb") as f:
+        content = f.read()
+
+    # IIS falls back to the generic listing format
+    assert _parse_listing(content, scraper) == [
+        ("wales1.xml", None),
+        ("wales2.xml", None),
+    ]
+
+
+def test_parse_waf():
+    directories, records = _parse_waf(APACHE_TABLE, "http://waf/index.html", "apache")
+
+    assert directories == ["http://waf/sub/"]
+    assert records == [("http://waf/record1.xml", "2013-03-12 10:21:00")]
@@ -3,6 +3,7 @@
 from __future__ import print_function
 import os
 import sys
+import itertools
 
 import six
 
@@ -11,6 +12,7 @@ import logging
 from ckan.lib.helpers import json
 from lxml import etree
 from pprint import pprint
+from sqlalchemy import orm
 
 from ckan import model
 from ckanext.spatial.lib import save_package_extent
@@ -95,12 +97,15 @@ def initdb(srid=None):
 
     from ckanext.spatial.model import setup as db_setup
 
-    db_setup(srid)
+    db_setup(srid, migrate=True)
 
-    print('DB tables created')
+    print('DB tables created or upgraded')
 
 
-def update_extents():
+def update_extents(bulk=False, workers=None, chunk_size=None):
+    if bulk:
+        return bulk_update_extents(workers=workers, chunk_size=chunk_size)
+
     from ckan.model import PackageExtra, Package, Session
     conn = Session.connection()
     packages = [extra.package \
@@ -137,6 +142,84 @@ def update_extents():
     print(msg)
 
 
+def bulk_update_extents(workers=None, chunk_size=None):
+    from ckanext.spatial.lib.bulk_extents import (rebuild_extents,
+                                                  DEFAULT_CHUNK_SIZE)
+
+    def progress(processed, elapsed):
+        print('Processed %i extras in %.1fs (%.0f/s)' % (
+            processed, elapsed, processed / elapsed if elapsed else 0))
+
+    rebuild = rebuild_extents(workers=workers,
+                              chunk_size=chunk_size or DEFAULT_CHUNK_SIZE,
+                              progress=progress)
+
+    if rebuild.errors:
+        msg = 'Errors were found:\n%s' % '\n'.join(rebuild.errors)
+        print(msg)
+
+    msg = "Done. %i extents created or updated and %i deleted, " \
+          "out of %i packages" % (rebuild.upserted, rebuild.deleted,
+                                  rebuild.processed)
+
+    print(msg)
+
+
+def import_harvest_objects(source_id, chunk_size=None, processes=None):
+    from ckan.plugins import PluginImplementations
+    from ckanext.harvest.interfaces import IHarvester
+    from ckanext.harvest.model import HarvestObject, HarvestSource
+
+    source = HarvestSource.get(source_id)
+    if not source:
+        print('Harvest source "%s" not found' % source_id)
+        sys.exit(1)
+
+    harvester = None
+    for plugin in PluginImplementations(IHarvester):
+        if plugin.info()['name'] == source.type:
+            harvester = plugin
+            break
+    if not isinstance(harvester, SpatialHarvester):
+        print('Harvest source "%s" does not use a spatial harvester' % source_id)
+        sys.exit(1)
+
+    chunk_size = chunk_size or harvester.import_chunk_size
+
+    # The ids are streamed from their own session, as the harvester commits
+    # the main one after each chunk
+    id_session = orm.Session(bind=model.meta.engine)
+    try:
+        query = id_session.query(HarvestObject.id) \
+            .filter(HarvestObject.harvest_source_id == source.id) \
+            .filter(HarvestObject.current == True)
+        total = query.count()
+
+        def harvest_objects():
+            # Load the objects of each chunk in turn
+            ids = query.yield_per(chunk_size)
+            while True:
+                chunk = [row[0] for row in itertools.islice(ids, chunk_size)]
+                if not chunk:
+                    break
+                for harvest_object in model.Session.query(HarvestObject) \
+                        .filter(HarvestObject.id.in_(chunk)):
+                    yield harvest_object
+
+        # Import the objects even if they have not changed, as the harvest
+        # import command does
+        harvester.force_import = True
+        try:
+            imported = harvester.import_objects(harvest_objects(), chunk_size,
+                                                processes=processes)
+        finally:
+            harvester.force_import = False
+    finally:
+        id_session.close()
+
+    print('Done. %i out of %i objects imported' % (imported, total))
+
+
 def get_xslt(original=False):
     if original:
         config_option = \
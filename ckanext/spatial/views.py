@@ -9,7 +9,8 @@ import ckan.plugins.toolkit as tk
 from ckantoolkit import request
 from ckan.views.api import _finish_ok, _finish_bad_request
 
-from ckanext.spatial.lib import get_srid, validate_bbox, bbox_query
+from ckanext.spatial.lib import get_srid, validate_bbox, bbox_query_ids
+from ckanext.spatial.lib.cache import get_spatial_query_cache
 from ckanext.spatial import util
 
 
@@ -33,9 +34,10 @@ def spatial_query(register):
     srid = get_srid(request.args.get('crs')) if 'crs' in \
         request.args else None
 
-    extents = bbox_query(bbox, srid)
-
-    ids = [extent.package_id for extent in extents]
+    query_cache = get_spatial_query_cache()
+    bbox = query_cache.normalize_bbox(bbox)
+    ids = query_cache.get_or_run(
+        bbox, srid, 'ids', lambda: list(bbox_query_ids(bbox, srid)))
     output = dict(count=len(ids), results=ids)
 
     return _finish_ok(output)
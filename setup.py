@@ -67,5 +67,6 @@ https://docs.ckan.org/projects/ckanext-spatial/en/latest/
 
     [ckan.test_plugins]
     test_spatial_plugin = ckanext.spatial.tests.test_plugin.plugin:TestSpatialPlugin
+    test_spatial_search_backend = ckanext.spatial.tests.test_plugin.plugin:TestSearchBackendPlugin
 """,
 )